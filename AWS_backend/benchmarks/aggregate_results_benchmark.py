@@ -0,0 +1,168 @@
+"""
+Benchmark for AggregateResultsLambda.
+
+Generates synthetic study summaries (each with three citation lists, like
+SummarizeSingleStudyLambda writes them), serves them from an in-memory S3
+stand-in that adds a fixed per-request latency, and compares:
+
+  * legacy    - sequential get_object, every document held in a list, one
+                json.dumps(..., indent=2) blob uploaded with put_object
+  * streaming - the current handler: bounded concurrent fetch and a streaming
+                multipart upload with indentation off
+
+Usage (needs boto3 installed, as in the Lambda runtime):
+
+    python AWS_backend/benchmarks/aggregate_results_benchmark.py --summaries 500 --latency-ms 20
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+os.environ.setdefault('S3_BUCKET_NAME', 'benchmark-bucket')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_functions'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'docrag_shared', 'python'))
+
+import AggregateResultsLambda  # noqa: E402
+
+
+class _Body:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class LatencyS3Client:
+    """get_object/put_object/multipart stand-in. Uploaded bytes are counted, not kept."""
+
+    def __init__(self, objects, latency_seconds):
+        self.objects = objects
+        self.latency = latency_seconds
+        self.uploaded_bytes = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def get_object(self, Bucket, Key):
+        self._call()
+        return {'Body': _Body(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call()
+        self.uploaded_bytes += len(Body)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call()
+        return {'UploadId': str(uuid.uuid4())}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call()
+        self.uploaded_bytes += len(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        self._call()
+
+    def abort_multipart_upload(self, **kwargs):
+        self._call()
+
+
+def synthetic_summary(idx, refs_per_citation, chunk_words):
+    chunk_text = " ".join(f"word{n}" for n in range(chunk_words))
+
+    def citation_list():
+        return [{
+            "generatedResponsePart": {"textResponsePart": {"text": f"Extracted span {c}", "span": {"start": 0, "end": 20}}},
+            "retrievedReferences": [{
+                "content": {"text": chunk_text},
+                "location": {"type": "S3", "s3Location": {"uri": f"s3://bucket/kb-data-source/study{idx}/chunk_{r:04d}.txt"}},
+                "metadata": {
+                    "file_name": f"study{idx}.pdf",
+                    "page_numbers": str(r % 12 + 1),
+                    "bounding_boxes": json.dumps([{"page": 1, "top": 0.1, "left": 0.1, "width": 0.8, "height": 0.2}])
+                }
+            } for r in range(refs_per_citation)]
+        } for c in range(4)]
+
+    return {
+        "ProductOverview": {"DrugName": "Drug X", "Company": "Company Y", "MechanismOfAction": "Inhibitor"},
+        "StudyDetails": {"StudyType": f"Phase 3 Study {idx}", "NumberOfPatients": "120"},
+        "AttackRates": {"MeanHAEAttacksPerMonth": "0.42", "PercentReductionMeanFromBaseline": "87%"},
+        "trialMetadataSummary": {"NCT": f"NCT{idx:08d}", "TrialName": f"TRIAL-{idx}"},
+        "__citations__": {
+            "clinical_part1_citations": citation_list(),
+            "clinical_part2_citations": citation_list(),
+            "metadata_citations": citation_list()
+        }
+    }
+
+
+def legacy_aggregate(s3, event):
+    structured = []
+    for ptr in event:
+        obj = s3.get_object(Bucket=AggregateResultsLambda.S3_BUCKET_NAME, Key=ptr['s3_key'])
+        structured.append(json.loads(obj['Body'].read().decode('utf-8')))
+    s3.put_object(
+        Bucket=AggregateResultsLambda.S3_BUCKET_NAME,
+        Key="aggregated.json",
+        Body=json.dumps(structured, indent=2).encode('utf-8'),
+        ContentType="application/json"
+    )
+    return len(structured)
+
+
+def measure(label, fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return label, count, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--summaries', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="simulated S3 request latency")
+    parser.add_argument('--refs-per-citation', type=int, default=5)
+    parser.add_argument('--chunk-words', type=int, default=200)
+    args = parser.parse_args()
+
+    objects, event = {}, []
+    for idx in range(args.summaries):
+        key = f"folder-summaries/user/session/folder/summary_study{idx}.json"
+        objects[key] = json.dumps(synthetic_summary(idx, args.refs_per_citation, args.chunk_words), indent=2).encode('utf-8')
+        event.append({"s3_key": key, "studyName": f"Study {idx}"})
+    source_mb = sum(len(v) for v in objects.values()) / 2**20
+    print(f"{args.summaries} synthetic summaries, {source_mb:.1f} MiB in S3, {args.latency_ms:.0f} ms per request\n")
+
+    results = []
+    legacy_s3 = LatencyS3Client(objects, args.latency_ms / 1000)
+    results.append(measure("legacy", lambda: legacy_aggregate(legacy_s3, event)) + (legacy_s3,))
+
+    streaming_s3 = LatencyS3Client(objects, args.latency_ms / 1000)
+    AggregateResultsLambda.s3_client = streaming_s3
+    results.append(measure(
+        f"streaming (concurrency={AggregateResultsLambda.AGGREGATE_FETCH_CONCURRENCY})",
+        lambda: AggregateResultsLambda.lambda_handler(event, None)["summaryCount"]
+    ) + (streaming_s3,))
+
+    print(f"\n{'variant':<28}{'summaries':>10}{'seconds':>10}{'peak MiB':>10}{'output MiB':>12}")
+    for label, count, elapsed, peak, s3 in results:
+        print(f"{label:<28}{count:>10}{elapsed:>10.2f}{peak / 2**20:>10.1f}{s3.uploaded_bytes / 2**20:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
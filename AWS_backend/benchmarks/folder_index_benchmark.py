@@ -0,0 +1,162 @@
+"""
+Benchmark for folder reads against the metadata table (moto, no AWS account needed).
+
+Loads one user with --folders folders of --files uploaded files each, plus an
+ingestion record per file and a folder item per folder, written the way
+RecordS3FileMetadata, IngestFileToBedrockKB and InitiateFolderProcessing
+write them. Then compares, for the same answer:
+
+  folder statuses    whole partition + filter   vs  __FOLDER_INFO__# prefix
+  one folder's rows  session prefix + filter    vs  FolderIndex (folderKey)
+
+DynamoDB charges a query for every item the key condition reads, before the
+filter, at 0.5 RCU per 4 KB (eventually consistent). moto does not meter
+that, so read units are computed from the sizes of the items each key
+condition selects; scanned/returned come from the query responses and the
+latency is moto's, which only shows the relative cost of reading more items.
+
+Usage:
+
+    python AWS_backend/benchmarks/folder_index_benchmark.py --folders 20 --files 50
+"""
+import argparse
+import math
+import os
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+import boto3  # noqa: E402
+from boto3.dynamodb.conditions import Attr, Key  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+TABLE_NAME = "folder-index-benchmark"
+SORT_KEY = "sessionId#fileName"
+USER_ID = "user-0001"
+SESSION_ID = "1760000000"
+RCU_BLOCK_BYTES = 4096
+
+
+def item_size(item):
+    """DynamoDB item size: attribute name lengths plus value sizes (strings and numbers approximated)."""
+    return sum(len(name.encode()) + len(str(value).encode()) for name, value in item.items())
+
+
+def create_table(dynamodb):
+    return dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'userId', 'KeyType': 'HASH'}, {'AttributeName': SORT_KEY, 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'userId', 'AttributeType': 'S'},
+            {'AttributeName': SORT_KEY, 'AttributeType': 'S'},
+            {'AttributeName': 'folderKey', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'FolderIndex',
+            'KeySchema': [{'AttributeName': 'folderKey', 'KeyType': 'HASH'}, {'AttributeName': SORT_KEY, 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'},
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def load(table, folders, files):
+    sizes = []
+    with table.batch_writer() as batch:
+        for f in range(folders):
+            user_folder = f"folder-{f:03d}"
+            folder_id = f"{SESSION_ID}/{user_folder}"
+            for n in range(files):
+                file_name = f"{user_folder}-study-{n:04d}.pdf"
+                s3_key = f"{USER_ID}/{folder_id}/{file_name}"
+                rows = [
+                    {
+                        'userId': USER_ID, SORT_KEY: f"{SESSION_ID}#{user_folder}#{file_name}",
+                        'folderKey': f"{USER_ID}#{folder_id}",
+                        'sessionId': SESSION_ID, 'userFolder': user_folder, 'fileName': file_name,
+                        's3Key': s3_key, 'contentType': 'application/pdf', 'size': 1_250_000,
+                        'uploadTimestamp': '2026-10-19T10:00:00Z', 'status': 'UPLOADED',
+                    },
+                    {
+                        'userId': USER_ID, SORT_KEY: f"{SESSION_ID}#{file_name}",
+                        'folderKey': f"{USER_ID}#{folder_id}", 'folderId': folder_id,
+                        'sourceS3Key': s3_key, 'ingestionJobId': f"JOB{f:03d}{n:04d}",
+                        'status': 'COMPLETE', 'lastUpdated': '2026-10-19T10:05:00Z',
+                    },
+                ]
+                for row in rows:
+                    batch.put_item(Item=row)
+                    sizes.append((row[SORT_KEY], row.get('folderKey'), item_size(row)))
+            folder_item = {
+                'userId': USER_ID, SORT_KEY: f"__FOLDER_INFO__#{folder_id}#__METADATA__",
+                'folderId': folder_id, 'folderName': user_folder, 'status': 'COMPLETED',
+                'totalFiles': files, 'lastUpdated': '2026-10-19T10:10:00Z',
+            }
+            batch.put_item(Item=folder_item)
+            sizes.append((folder_item[SORT_KEY], None, item_size(folder_item)))
+    return sizes
+
+
+def read_units(sizes):
+    """Eventually consistent query cost: the summed item sizes rounded up to 4 KB, half an RCU each."""
+    return math.ceil(sum(sizes) / RCU_BLOCK_BYTES) * 0.5
+
+
+def run_query(table, repeat, **kwargs):
+    scanned = returned = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        scanned = returned = 0
+        query_kwargs = dict(kwargs)
+        while True:
+            response = table.query(**query_kwargs)
+            scanned += response['ScannedCount']
+            returned += response['Count']
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return scanned, returned, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with mock_aws():
+        table = create_table(boto3.resource('dynamodb'))
+        sizes = load(table, args.folders, args.files)
+        target_folder = f"folder-{args.folders // 2:03d}"
+        target_key = f"{USER_ID}#{SESSION_ID}/{target_folder}"
+
+        cases = [
+            ("folder statuses", "partition + filter",
+             [s for _, _, s in sizes],
+             dict(KeyConditionExpression=Key('userId').eq(USER_ID),
+                  FilterExpression=Attr(SORT_KEY).begins_with("__FOLDER_INFO__#"))),
+            ("folder statuses", "__FOLDER_INFO__# prefix",
+             [s for sk, _, s in sizes if sk.startswith("__FOLDER_INFO__#")],
+             dict(KeyConditionExpression=Key('userId').eq(USER_ID) & Key(SORT_KEY).begins_with("__FOLDER_INFO__#"))),
+            ("one folder's rows", "session prefix + filter",
+             [s for sk, _, s in sizes if sk.startswith(f"{SESSION_ID}#")],
+             dict(KeyConditionExpression=Key('userId').eq(USER_ID) & Key(SORT_KEY).begins_with(f"{SESSION_ID}#"),
+                  FilterExpression=Attr('folderKey').eq(target_key))),
+            ("one folder's rows", "FolderIndex",
+             [s for _, fk, s in sizes if fk == target_key],
+             dict(IndexName='FolderIndex', KeyConditionExpression=Key('folderKey').eq(target_key))),
+        ]
+
+        print(f"{len(sizes)} items for one user ({args.folders} folders x {args.files} files, "
+              f"each with an ingestion record); mean of {args.repeat} runs\n")
+        print(f"{'read':<19}{'access path':<26}{'scanned':>9}{'returned':>10}{'RCU':>8}{'ms':>9}")
+        for read, path, read_sizes, kwargs in cases:
+            scanned, returned, elapsed = run_query(table, args.repeat, **kwargs)
+            print(f"{read:<19}{path:<26}{scanned:>9}{returned:>10}{read_units(read_sizes):>8.1f}{elapsed * 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark for request hedging in SummarizeSingleStudyLambda.
+
+Replaces the Bedrock client with a local stub that injects latency: most calls
+take a lognormal time around --median-ms, and --slow-fraction of them are
+--slow-factor times slower (the stalls seen on retrieve_and_generate). The
+same prompt stream is pushed through invoke_bedrock_with_retry with hedging
+off and on, using the Lambda's rate limiter and a stand-in for the folder item
+that holds the hedge budget, and the call latency percentiles are compared.
+
+Usage (needs boto3 installed, as in the Lambda runtime):
+
+    python AWS_backend/benchmarks/hedged_bedrock_benchmark.py --calls 600 --slow-fraction 0.02 --budget 50
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('S3_BUCKET_NAME', 'benchmark-bucket')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('KB_ID', 'benchmark-kb')
+os.environ.setdefault('BEDROCK_SUMMARY_MODEL_ID', 'anthropic.claude-3-sonnet-20240229-v1:0')
+os.environ.setdefault('BEDROCK_MAX_CONCURRENCY', '3')
+os.environ.setdefault('BEDROCK_REQUESTS_PER_SECOND', '200')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_functions'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'docrag_shared', 'python'))
+
+import SummarizeSingleStudyLambda as study_lambda  # noqa: E402
+
+
+class LatencyBedrockStub:
+    """retrieve_and_generate stand-in with a heavy latency tail."""
+
+    class exceptions:
+        class ThrottlingException(Exception):
+            pass
+
+    def __init__(self, median_seconds, slow_fraction, slow_factor, seed):
+        self.median = median_seconds
+        self.slow_fraction = slow_fraction
+        self.slow_factor = slow_factor
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def retrieve_and_generate(self, input, retrieveAndGenerateConfiguration):
+        with self._lock:
+            self.requests += 1
+            latency = self.median * self.rng.lognormvariate(0, 0.25)
+            if self.rng.random() < self.slow_fraction:
+                latency *= self.slow_factor
+        time.sleep(latency)
+        return {'output': {'text': '{}'}, 'citations': []}
+
+
+class FolderItemStub:
+    """Holds the hedgesIssued/hedgesWon counters that live on the folder item."""
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None, **kwargs):
+        name = UpdateExpression.split()[1]
+        with self._lock:
+            value = self.counters.get(name, 0)
+            if ConditionExpression and value >= ExpressionAttributeValues[':limit']:
+                raise study_lambda.dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException(
+                    {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'budget'}}, 'UpdateItem'
+                )
+            self.counters[name] = value + 1
+
+
+def run(calls, hedging, stub):
+    study_lambda.BEDROCK_HEDGING = hedging
+    study_lambda.bedrock_agent_runtime_client = stub
+    study_lambda.bedrock_router = study_lambda.ModelRouter(stub, routes={}, default_model=study_lambda.SUMMARY_MODEL_ID)
+    study_lambda.bedrock_latency = study_lambda.LatencyTracker(study_lambda.HEDGE_WINDOW_SIZE)
+    study_lambda.hedge_budget = study_lambda.HedgeBudget(study_lambda.HEDGE_BUDGET_PER_FOLDER)
+    study_lambda.file_metadata_table = FolderItemStub()
+    scope = ('benchmark-user', 'session/folder')
+    latencies = []
+
+    def one(idx):
+        start = time.perf_counter()
+        study_lambda.invoke_bedrock_with_retry("prompt", {}, f"call {idx}", scope)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=study_lambda.BEDROCK_MAX_CONCURRENCY) as executor:
+        list(executor.map(one, range(calls)))
+    return time.perf_counter() - start, sorted(latencies), study_lambda.hedge_budget.stats()
+
+
+def pct(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=600)
+    parser.add_argument('--median-ms', type=float, default=40.0)
+    parser.add_argument('--slow-fraction', type=float, default=0.02)
+    parser.add_argument('--slow-factor', type=float, default=8.0)
+    parser.add_argument('--budget', type=int, default=study_lambda.HEDGE_BUDGET_PER_FOLDER)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+    study_lambda.HEDGE_BUDGET_PER_FOLDER = args.budget
+
+    print(f"{args.calls} calls, median {args.median_ms:.0f} ms, {args.slow_fraction:.0%} slowed {args.slow_factor:g}x, "
+          f"concurrency {study_lambda.BEDROCK_MAX_CONCURRENCY}, hedge budget {args.budget}\n")
+    print(f"{'variant':<10}{'seconds':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'requests':>10}{'hedges':>8}{'won':>6}")
+    for hedging in (False, True):
+        stub = LatencyBedrockStub(args.median_ms / 1000, args.slow_fraction, args.slow_factor, args.seed)
+        elapsed, latencies, stats = run(args.calls, hedging, stub)
+        print(f"{'hedged' if hedging else 'baseline':<10}{elapsed:>9.2f}"
+              + "".join(f"{pct(latencies, p) * 1000:>9.0f}" for p in (50, 95, 99, 100))
+              + f"{stub.requests:>10}{stats['hedgesIssued']:>8}{stats['hedgesWon']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark for the JSON parse cascade (docrag_shared/json_extraction.py).
+
+Builds a Part1-sized extraction answer from the hae schema and the usual ways
+a model mangles it (code fence, prose around it, trailing commas, output cut
+off by the token limit, no JSON at all), then times parse_json_object on each
+and reports which stage recovered it and how many sections came back. The
+repair stage needs json_repair importable (unzip the json_repair layer and
+add its site-packages to PYTHONPATH); without it those cases fall through.
+
+Usage:
+
+    python AWS_backend/benchmarks/json_extraction_benchmark.py --repeat 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'docrag_shared', 'python'))
+
+import json_extraction  # noqa: E402
+from schema_registry import get_schema  # noqa: E402
+
+
+def build_cases():
+    sections = get_schema("hae")["parts"]["Part1"]
+    answer = json.dumps(
+        {sec: {k: f"value reported for {k.lower()} (95% CI {{x}})" for k in keys} for sec, keys in sections.items()},
+        indent=2
+    )
+    return sections, {
+        "valid":          answer,
+        "code fence":     f"```json\n{answer}\n```",
+        "prose":          f"Based on the passages, here is the JSON:\n{answer}\nLet me know if you need more.",
+        "trailing comma": answer.replace('"\n  }', '",\n  }'),
+        "truncated":      answer[:int(len(answer) * 0.8)],
+        "no json":        "I could not find this information in the provided documents.",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    sections, cases = build_cases()
+    print(f"json_repair {'available' if json_extraction.json_repair else 'not installed'}; "
+          f"{len(sections)} sections, answer {len(cases['valid'])} chars, {args.repeat} runs per case\n")
+    print(f"{'case':<16}{'stage':>8}{'sections':>10}{'mean ms':>10}")
+    for name, text in cases.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            data, stage = json_extraction.parse_json_object(text)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        found = len(sections) - len(json_extraction.missing_sections(data, sections))
+        print(f"{name:<16}{stage:>8}{found:>7}/{len(sections):<2}{elapsed * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark for batched S3 event handling in RecordS3FileMetadata (moto, no AWS account needed).
+
+Simulates a bulk upload of --files objects for one user and feeds the
+notifications to the Lambda two ways:
+
+  per object   one invocation per S3 notification (the old direct trigger)
+  sqs batches  SQS batches of --batch-size messages (the event source mapping)
+
+and reports Lambda invocations, DynamoDB requests (by operation), log bytes
+and wall time for each. Both runs end with the same rows in the table.
+
+Usage:
+
+    python AWS_backend/benchmarks/s3_event_batch_benchmark.py --files 2000 --batch-size 100
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('DYNAMODB_TABLE_NAME', 's3-event-batch-benchmark')
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, '..', 'lambda_layers', 'docrag_shared', 'python'))
+sys.path.insert(0, os.path.join(HERE, '..', 'lambda_functions'))
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+
+def s3_notification(key):
+    return {
+        'eventVersion': '2.1', 'eventSource': 'aws:s3', 'awsRegion': 'us-east-1',
+        'eventName': 'ObjectCreated:Put',
+        's3': {'bucket': {'name': 'bkt', 'arn': 'arn:aws:s3:::bkt'},
+               'object': {'key': key, 'size': 1_250_000, 'eTag': '0' * 32, 'sequencer': '0062E99A88DC407460'}}
+    }
+
+
+def create_table():
+    return boto3.resource('dynamodb').create_table(
+        TableName=os.environ['DYNAMODB_TABLE_NAME'],
+        KeySchema=[{'AttributeName': 'userId', 'KeyType': 'HASH'}, {'AttributeName': 'sessionId#fileName', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'userId', 'AttributeType': 'S'},
+                              {'AttributeName': 'sessionId#fileName', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def run(handler, events, requests):
+    requests.clear()
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        for event in events:
+            handler(event, None)
+    return len(events), dict(requests), len(log.getvalue().encode('utf-8')), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    notifications = [s3_notification(f"user-0001/1760000000/bulk/study-{n:05d}.pdf") for n in range(args.files)]
+    per_object = [{'Records': [n]} for n in notifications]
+    messages = [{'eventSource': 'aws:sqs', 'messageId': f"msg-{i}", 'body': json.dumps({'Records': [n]})}
+                for i, n in enumerate(notifications)]
+    batched = [{'Records': messages[i:i + args.batch_size]} for i in range(0, len(messages), args.batch_size)]
+
+    with mock_aws():
+        table = create_table()
+        import RecordS3FileMetadataToDynamoDB as record_lambda
+
+        requests = Counter()
+        record_lambda.table.meta.client.meta.events.register(
+            'before-call.dynamodb', lambda model, **kwargs: requests.update([model.name])
+        )
+
+        print(f"{args.files} uploaded files, SQS batches of {args.batch_size}\n")
+        print(f"{'delivery':<14}{'invocations':>12}{'DDB requests':>14}  {'by operation':<40}{'log KB':>8}{'s':>7}")
+        for name, events in (("per object", per_object), ("sqs batches", batched)):
+            invocations, by_op, log_bytes, elapsed = run(record_lambda.lambda_handler, events, requests)
+            ops = ", ".join(f"{op} {count}" for op, count in sorted(by_op.items()))
+            print(f"{name:<14}{invocations:>12}{sum(by_op.values()):>14}  {ops:<40}{log_bytes / 1024:>8.1f}{elapsed:>7.2f}")
+        print(f"\nrows in table: {table.scan(Select='COUNT')['Count']} (files + the user's change version item)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import os
+import json
+import boto3
+from admission import TERMINAL_STATUSES, admit_runs, reconcile_running, release_run  # docrag_shared layer
+
+# --- Configuration (Environment Variables) ---
+STATE_MACHINE_ARN          = os.environ['STATE_MACHINE_ARN']
+DYNAMODB_TABLE_NAME        = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+# The same caps as InitiateFolderProcessing
+TENANT_MAX_RUNNING_FOLDERS = int(os.environ.get('TENANT_MAX_RUNNING_FOLDERS', 2))
+MAX_RUNNING_FOLDERS        = int(os.environ.get('MAX_RUNNING_FOLDERS', 10))  # 0: no global cap
+ADMISSION_MAX_WAIT_SECONDS = int(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', 900))
+
+# --- Initialize AWS Clients ---
+stepfunctions_client = boto3.client('stepfunctions')
+dynamodb_resource    = boto3.resource('dynamodb')
+file_metadata_table  = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+
+def lambda_handler(event, context):
+    """
+    Admits queued folder runs (see admission in the docrag_shared layer).
+    Invoked by EventBridge with either
+
+      a Step Functions execution status change  frees the finished execution's
+                                                slot, then admits the next runs
+      {"task": "reconcile"}                     (scheduled) frees the slots of
+                                                executions whose event was missed
+    """
+    event = event or {}
+    released = 0
+    detail = event.get('detail') or {}
+    if event.get('source') == 'aws.states':
+        if detail.get('status') in TERMINAL_STATUSES:
+            user_id = json.loads(detail.get('input') or '{}').get('userId')
+            if user_id and release_run(file_metadata_table, user_id, detail['name']):
+                released += 1
+                print(f"Execution {detail['name']} of user {user_id} ended {detail['status']}; slot freed.")
+    elif event.get('task') == 'reconcile':
+        released += reconcile_running(file_metadata_table, stepfunctions_client, STATE_MACHINE_ARN)
+    else:
+        raise ValueError(f"Unknown event: {json.dumps(event)[:200]}")
+
+    admitted = admit_runs(file_metadata_table, stepfunctions_client, STATE_MACHINE_ARN,
+                          TENANT_MAX_RUNNING_FOLDERS, MAX_RUNNING_FOLDERS, ADMISSION_MAX_WAIT_SECONDS * 1000)
+    report = {"released": released, "admitted": [run["executionName"] for run in admitted]}
+    print("Admission report:", json.dumps(report))
+    return report
@@ -1,47 +1,283 @@
 import os
 import json
+import shutil
+import tempfile
 import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from summary_pointers import AGGREGATE_SCOPE, record_summary  # docrag_shared layer
 
 # AWS client
 s3_client = boto3.client('s3')
 
 # Environment
-S3_BUCKET_NAME    = os.environ['S3_BUCKET_NAME']
-S3_SUMMARY_PREFIX = os.environ.get('S3_SUMMARY_PREFIX', 'folder-summaries')
+S3_BUCKET_NAME      = os.environ['S3_BUCKET_NAME']
+S3_SUMMARY_PREFIX   = os.environ.get('S3_SUMMARY_PREFIX', 'folder-summaries')
+DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME')
+metadata_table      = boto3.resource('dynamodb').Table(DYNAMODB_TABLE_NAME) if DYNAMODB_TABLE_NAME else None
+
+# Configuration
+AGGREGATE_FETCH_CONCURRENCY = int(os.environ.get('AGGREGATE_FETCH_CONCURRENCY', 8))
+AGGREGATE_OUTPUT_FORMAT     = os.environ.get('AGGREGATE_OUTPUT_FORMAT', 'json').lower()   # json | jsonl
+AGGREGATE_JSON_INDENT       = int(os.environ['AGGREGATE_JSON_INDENT']) if os.environ.get('AGGREGATE_JSON_INDENT') else None
+UPLOAD_PART_SIZE_BYTES      = int(os.environ.get('UPLOAD_PART_SIZE_BYTES', 8 * 1024 * 1024))  # S3 minimum part size is 5 MiB
+AGGREGATE_SECTION_INDEX     = os.environ.get('AGGREGATE_SECTION_INDEX', 'true').lower() == 'true'
+
+# Section store: one JSONL record per (section, study), grouped by section so a
+# single-section query is one contiguous byte range. Citation sections are large
+# and are spooled to one temporary file each (in memory up to a part, then /tmp);
+# every other section is small extracted data and is buffered in memory. Both are
+# written out section by section once all summaries have been read.
+SECTION_STORE_FORMAT = "sections-jsonl/v1"
+STREAMED_SECTIONS    = ("__citations__", "__references__")
+
+
+class S3StreamingUpload:
+    """
+    Buffers written bytes and ships them to S3 as multipart parts of
+    UPLOAD_PART_SIZE_BYTES, so only one part is held in memory at a time.
+    Outputs smaller than one part are written with a single put_object.
+    """
+
+    def __init__(self, bucket, key, content_type):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= UPLOAD_PART_SIZE_BYTES:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )['UploadId']
+        part_number = len(self._parts) + 1
+        resp = s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer)
+        )
+        self._parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+        self._buffer.clear()
+
+    def close(self):
+        if self._upload_id is None:
+            s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), ContentType=self.content_type
+            )
+        else:
+            if self._buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+        self._buffer.clear()
+
+    def abort(self):
+        if self._upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer.clear()
+
+
+def iter_summary_pointers(event):
+    """Flattens the Map output: plain pointers, or one list of pointers per summarized batch."""
+    for entry in event:
+        if isinstance(entry, list):
+            yield from entry
+        elif isinstance(entry, dict) and 'summaries' in entry:
+            yield from entry['summaries']
+        else:
+            yield entry
+
+def fetch_summary(key):
+    obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    return json.loads(obj['Body'].read().decode('utf-8'))
+
+def iter_summaries(keys):
+    """
+    Fetches summaries with a bounded pool and yields them in input order.
+    At most 2 x AGGREGATE_FETCH_CONCURRENCY documents are in flight or
+    waiting to be written, whatever the number of keys.
+    """
+    window = max(1, AGGREGATE_FETCH_CONCURRENCY) * 2
+    with ThreadPoolExecutor(max_workers=max(1, AGGREGATE_FETCH_CONCURRENCY)) as executor:
+        in_flight = deque()
+        for key in keys:
+            in_flight.append(executor.submit(fetch_summary, key))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+class SectionStoreWriter:
+    """
+    Writes the section store and its byte-offset index:
+
+      <base>.sections.jsonl        {"study": ..., "section": ..., "data": ...} per line
+      <base>.sections.index.json   {"studies": [...], "sections": {name: {"offset", "length", "studies": {idx: [offset, length]}}}}
+
+    Each section's records are one contiguous range, in study order.
+    """
+
+    def __init__(self, bucket, base_key):
+        self.bucket = bucket
+        self.data_key = f"{base_key}.sections.jsonl"
+        self.index_key = f"{base_key}.sections.index.json"
+        self.upload = S3StreamingUpload(bucket, self.data_key, "application/jsonl")
+        self.studies = []
+        self.sections = {}
+        self._buffered = {}
+        # section: (spool file, {study idx: [offset in the spool, length]})
+        self._spooled = {}
+
+    def add(self, doc, study_name):
+        study_idx = len(self.studies)
+        self.studies.append(study_name)
+        for section, data in doc.items():
+            line = json.dumps({"study": study_name, "section": section, "data": data},
+                              separators=(',', ':')).encode('utf-8') + b'\n'
+            if section in STREAMED_SECTIONS:
+                self._spool(section, study_idx, line)
+            else:
+                self._buffered.setdefault(section, []).append((study_idx, line))
+
+    def _spool(self, section, study_idx, line):
+        if section not in self._spooled:
+            self._spooled[section] = (tempfile.SpooledTemporaryFile(max_size=UPLOAD_PART_SIZE_BYTES), {})
+        spool, studies = self._spooled[section]
+        studies[str(study_idx)] = [spool.tell(), len(line)]
+        spool.write(line)
+
+    def _write(self, section, study_idx, line):
+        entry = self.sections.setdefault(section, {"offset": self.upload.bytes_written, "length": 0, "studies": {}})
+        entry["studies"][str(study_idx)] = [self.upload.bytes_written, len(line)]
+        entry["length"] = self.upload.bytes_written + len(line) - entry["offset"]
+        self.upload.write(line)
+
+    def close(self):
+        for section, lines in self._buffered.items():
+            for study_idx, line in lines:
+                self._write(section, study_idx, line)
+        self._buffered.clear()
+        for section, (spool, studies) in self._spooled.items():
+            offset, length = self.upload.bytes_written, spool.tell()
+            spool.seek(0)
+            shutil.copyfileobj(spool, self.upload, UPLOAD_PART_SIZE_BYTES)
+            spool.close()
+            self.sections[section] = {
+                "offset": offset, "length": length,
+                "studies": {idx: [offset + start, size] for idx, (start, size) in studies.items()}
+            }
+        self._spooled.clear()
+        self.upload.close()
+        index = {
+            "format":   SECTION_STORE_FORMAT,
+            "dataKey":  self.data_key,
+            "size":     self.upload.bytes_written,
+            "studies":  self.studies,
+            "sections": self.sections
+        }
+        s3_client.put_object(
+            Bucket=self.bucket, Key=self.index_key,
+            Body=json.dumps(index, separators=(',', ':')).encode('utf-8'), ContentType="application/json"
+        )
+
+    def abort(self):
+        self.upload.abort()
+        self._buffered.clear()
+        for spool, _ in self._spooled.values():
+            spool.close()
+        self._spooled.clear()
+
 
 def lambda_handler(event, context):
     """
-    event == [
+    event == { "userId", "folderId", "summaryRefs": [
       { "s3_key": "folder-summaries/…/summary_studyA_20250622T...Z.json", "studyName": "Study A" },
       …
-    ]
-    """
-    structured = []
+    ] }
+    where summaryRefs may also be, from the batched study Map, a list of such
+    lists. A bare summaryRefs list is accepted too.
 
-    for ptr in event:
+    With userId and folderId the aggregate is recorded as the folder's latest
+    summary (see summary_pointers).
+    """
+    refs = event.get('summaryRefs', []) if isinstance(event, dict) else event
+    keys, study_names = [], []
+    for ptr in iter_summary_pointers(refs):
         key = ptr.get('s3_key')
         if not key:
             print(f"⚠️ Missing s3_key in {ptr}")
             continue
-        obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-        structured.append(json.loads(obj['Body'].read().decode('utf-8')))
+        keys.append(key)
+        study_names.append(ptr.get('studyName'))
 
-    # Write the aggregated list back to S3
+    # Stream the aggregated list back to S3
     ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-    agg_key = f"{S3_SUMMARY_PREFIX}/aggregated-summaries/{ts}.json"
+    jsonl = AGGREGATE_OUTPUT_FORMAT == 'jsonl'
+    agg_key = f"{S3_SUMMARY_PREFIX}/aggregated-summaries/{ts}.{'jsonl' if jsonl else 'json'}"
+    separators = (',', ': ') if AGGREGATE_JSON_INDENT is not None else (',', ':')
+
+    upload = S3StreamingUpload(S3_BUCKET_NAME, agg_key, "application/jsonl" if jsonl else "application/json")
+    sections = SectionStoreWriter(S3_BUCKET_NAME, agg_key.rsplit('.', 1)[0]) if AGGREGATE_SECTION_INDEX else None
+    count = 0
+    try:
+        if not jsonl:
+            upload.write(b'[')
+        for doc in iter_summaries(keys):
+            if sections:
+                study_name = study_names[count] or doc.get("StudyDetails", {}).get("StudyType") or f"study_{count}"
+                sections.add(doc, study_name)
+            if jsonl:
+                upload.write(json.dumps(doc, separators=(',', ':')).encode('utf-8') + b'\n')
+            else:
+                upload.write((b',' if count else b'') +
+                             json.dumps(doc, indent=AGGREGATE_JSON_INDENT, separators=separators).encode('utf-8'))
+            count += 1
+        if not jsonl:
+            upload.write(b']')
+        upload.close()
+        if sections:
+            sections.close()
+    except Exception:
+        upload.abort()
+        if sections:
+            sections.abort()
+        raise
+    print(f"✅ Wrote {count} aggregated summaries ({upload.bytes_written} bytes) to s3://{S3_BUCKET_NAME}/{agg_key}")
+    if sections:
+        print(f"✅ Wrote section store ({sections.upload.bytes_written} bytes, {len(sections.sections)} sections) "
+              f"indexed at s3://{S3_BUCKET_NAME}/{sections.index_key}")
 
-    s3_client.put_object(
-        Bucket=S3_BUCKET_NAME,
-        Key=agg_key,
-        Body=json.dumps(structured, indent=2).encode('utf-8'),
-        ContentType="application/json"
-    )
-    print(f"✅ Wrote aggregated summaries to s3://{S3_BUCKET_NAME}/{agg_key}")
+    version = None
+    if metadata_table is not None and isinstance(event, dict) and event.get('userId') and event.get('folderId'):
+        attributes = {"summaryCount": count}
+        if sections:
+            attributes["sectionIndexS3Key"] = sections.index_key
+        try:
+            version = record_summary(metadata_table, event['userId'], event['folderId'], AGGREGATE_SCOPE,
+                                     agg_key, upload.bytes_written, attributes)
+            print(f"Recorded as version {version} of the summary of folder {event['folderId']}.")
+        except Exception as e:
+            # UpdateFolderMetadata records it when no version comes with the key
+            print(f"⚠️ Could not record the summary pointer: {e}")
 
     # ←── **Return only a small pointer + count** ──→
     return {
-        "summaryCount":     len(structured),
+        "summaryCount":     count,
         "aggregatedS3Key": agg_key,
-        "message":          f"Aggregated {len(structured)} summaries"
+        "sectionIndexS3Key": sections.index_key if sections else None,
+        "aggregatedSizeBytes": upload.bytes_written,
+        "summaryVersion":   version,
+        "message":          f"Aggregated {count} summaries"
     }
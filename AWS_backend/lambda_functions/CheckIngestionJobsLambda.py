@@ -0,0 +1,209 @@
+import boto3
+import os
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key, Attr
+from file_status import INGEST_FAILED, INGESTED, INGESTING, StatusWriter  # docrag_shared layer
+from kb_cleanup import covering_sync_job  # docrag_shared layer
+
+# --- Configuration (Environment Variables) ---
+DYNAMODB_TABLE_NAME   = os.environ['DYNAMODB_TABLE_NAME']
+BEDROCK_REGION        = os.environ.get('BEDROCK_REGION', 'us-east-1')
+KNOWLEDGE_BASE_ID     = os.environ.get('KNOWLEDGE_BASE_ID')
+DATA_SOURCE_ID        = os.environ.get('DATA_SOURCE_ID')
+POLL_MIN_SECONDS      = int(os.environ.get('INGESTION_POLL_MIN_SECONDS', 10))
+POLL_MAX_SECONDS      = int(os.environ.get('INGESTION_POLL_MAX_SECONDS', 120))
+BARRIER_MAX_ATTEMPTS  = int(os.environ.get('INGESTION_BARRIER_MAX_ATTEMPTS', 60))
+FOLDER_INDEX_NAME     = os.environ.get('FOLDER_INDEX_NAME', '')  # sparse GSI on folderKey = "<userId>#<folderId>"
+
+TERMINAL_STATUSES = ("COMPLETE", "FAILED", "STOPPED")
+ACTIVE_STATUSES   = ("STARTING", "IN_PROGRESS", "STOPPING")
+
+# --- Initialize AWS Clients ---
+bedrock_agent_client = boto3.client('bedrock-agent', region_name=BEDROCK_REGION)
+dynamodb_resource    = boto3.resource('dynamodb')
+file_metadata_table  = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+
+class IngestionBarrierTimeout(Exception):
+    pass
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+
+def load_pending_records(user_id, folder_id, since):
+    """
+    Returns {ingestionJobId: [file row keys]} for files of this folder whose
+    ingestion started during the current execution and whose job has not been
+    seen finishing yet (status "ingesting", see file_status). Files whose
+    chunks wait for a sync job (no ingestionJobId yet) are under None.
+    """
+    pending = {}
+    query_kwargs = {
+        # The folder's file rows are "<session>#<userFolder>#<path>"
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key('sessionId#fileName').begins_with(f"{folder_id.replace('/', '#', 1)}#"),
+        'FilterExpression': Attr('status').eq(INGESTING),
+        'ProjectionExpression': 'userId, #sk, ingestionJobId, startedAtUtc',
+        'ExpressionAttributeNames': {'#sk': 'sessionId#fileName'}
+    }
+    if FOLDER_INDEX_NAME:
+        query_kwargs.update({
+            'IndexName': FOLDER_INDEX_NAME,
+            'KeyConditionExpression': Key('folderKey').eq(f"{user_id}#{folder_id}")
+        })
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        for item in response.get('Items', []):
+            if since and item.get('startedAtUtc') and parse_timestamp(item['startedAtUtc']) < since:
+                continue
+            pending.setdefault(item.get('ingestionJobId'), []).append({
+                'userId': item['userId'], 'sessionId#fileName': item['sessionId#fileName']
+            })
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return pending
+
+
+def find_active_job_ids(since):
+    """Active jobs on the data source started by this execution, e.g. by file removals that leave no record."""
+    active = set()
+    paginator = bedrock_agent_client.get_paginator('list_ingestion_jobs')
+    for page in paginator.paginate(knowledgeBaseId=KNOWLEDGE_BASE_ID, dataSourceId=DATA_SOURCE_ID):
+        for job in page.get("ingestionJobSummaries", []):
+            if job.get("status") not in ACTIVE_STATUSES:
+                continue
+            if since and job.get("startedAt") and parse_timestamp(job["startedAt"]) < since:
+                continue
+            active.add(job["ingestionJobId"])
+    return active
+
+
+def record_job_status(writer, record_keys, status, reasons=None):
+    """Moves a finished job's files to ingested or ingest_failed, so later polls skip them."""
+    now = datetime.now(timezone.utc).isoformat()
+    for key in record_keys:
+        if status == "COMPLETE":
+            writer.emit(key, INGESTED, attributes={'ingestionJobStatus': status, 'completedAtUtc': now})
+        else:
+            error = f"Ingestion job {status}" + (f": {'; '.join(reasons)}" if reasons else "")
+            writer.emit(key, INGEST_FAILED, attributes={
+                'ingestionJobStatus': status, 'completedAtUtc': now, 'processingError': error
+            })
+
+
+def next_wait_seconds(attempt, pending_count):
+    """Short waits while jobs may be about to finish, backing off for long-running ones."""
+    wait = POLL_MIN_SECONDS * (2 ** min(attempt, 6))
+    if pending_count > 1:
+        wait = max(wait, POLL_MIN_SECONDS * pending_count)
+    return int(min(wait, POLL_MAX_SECONDS))
+
+
+def sync_job_id():
+    """The sync job covering chunks whose batch could not start its own job, once one could be started."""
+    return covering_sync_job(file_metadata_table, bedrock_agent_client, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID)
+
+
+def check_job_ids(job_ids, attempt, sync_pending=False):
+    if sync_pending:
+        sync_job = sync_job_id()
+        if sync_job:
+            job_ids, sync_pending = [*job_ids, sync_job], False
+    pending_job_ids, failed_job_ids = [], []
+    for job_id in job_ids:
+        status = bedrock_agent_client.get_ingestion_job(
+            knowledgeBaseId=KNOWLEDGE_BASE_ID, dataSourceId=DATA_SOURCE_ID, ingestionJobId=job_id
+        )["ingestionJob"]["status"]
+        if status not in TERMINAL_STATUSES:
+            pending_job_ids.append(job_id)
+        elif status != "COMPLETE":
+            failed_job_ids.append(job_id)
+    waiting = len(pending_job_ids) + (1 if sync_pending else 0)
+    if waiting and attempt + 1 >= BARRIER_MAX_ATTEMPTS:
+        raise IngestionBarrierTimeout(
+            f"Ingestion jobs {pending_job_ids} still running after {attempt + 1} checks"
+            + (" and the batch's sync job was never started." if sync_pending else ".")
+        )
+    return {
+        "allComplete":     not waiting,
+        "attempt":         attempt + 1,
+        "waitSeconds":     0 if not waiting else next_wait_seconds(attempt, waiting),
+        "ingestionJobIds": job_ids,
+        "syncPending":     sync_pending,
+        "pendingJobIds":   pending_job_ids,
+        "failedJobIds":    failed_job_ids
+    }
+
+
+def lambda_handler(event, context):
+    """
+    One poll of the ingestion barrier. Step Functions loops
+    CheckIngestionJobs -> Choice -> Wait(SecondsPath=waitSeconds) until
+    allComplete is true, so no Lambda time is spent sleeping.
+
+    event == { "userId", "folderId", "executionStartTime", "attempt" }
+    or, to wait for specific jobs only (one pipelined batch),
+    event == { "ingestionJobIds": [...], "syncPending", "attempt" }
+
+    Changes whose job could not be started because another job was running
+    (syncPending, or file rows without an ingestionJobId) get their job here,
+    once the data source is free.
+    """
+    if 'ingestionJobIds' in event:
+        return check_job_ids([j for j in event['ingestionJobIds'] if j], int(event.get('attempt') or 0),
+                             bool(event.get('syncPending')))
+
+    user_id = event['userId']
+    folder_id = event['folderId']
+    attempt = int(event.get('attempt') or 0)
+    since = parse_timestamp(event['executionStartTime']) if event.get('executionStartTime') else None
+
+    pending_records = load_pending_records(user_id, folder_id, since)
+    pending_job_ids, failed_job_ids = set(), []
+    unsynced = pending_records.pop(None, [])
+    with StatusWriter(file_metadata_table) as writer:
+        sync_job = sync_job_id() if unsynced else None
+        if sync_job:
+            for key in unsynced:
+                writer.emit(key, INGESTING, attributes={'ingestionJobId': sync_job, 'ingestionJobStatus': "STARTED"},
+                            from_statuses=(INGESTING,))
+            pending_job_ids.add(sync_job)
+        elif unsynced:
+            print(f"{len(unsynced)} file(s) wait for a sync job; another ingestion job is running.")
+        for polled_job_id, record_keys in pending_records.items():
+            job = bedrock_agent_client.get_ingestion_job(
+                knowledgeBaseId=KNOWLEDGE_BASE_ID, dataSourceId=DATA_SOURCE_ID, ingestionJobId=polled_job_id
+            )["ingestionJob"]
+            status = job["status"]
+            if status in TERMINAL_STATUSES:
+                record_job_status(writer, record_keys, status, job.get('failureReasons'))
+                if status != "COMPLETE":
+                    failed_job_ids.append(polled_job_id)
+                    print(f"⚠️ Ingestion job {polled_job_id} ended with status {status}: {job.get('failureReasons')}")
+            else:
+                pending_job_ids.add(polled_job_id)
+
+    pending_job_ids |= find_active_job_ids(since)
+    # Files still waiting for a sync job hold the barrier like a running job
+    sync_waiting = bool(unsynced) and not sync_job
+    waiting = len(pending_job_ids) + (1 if sync_waiting else 0)
+    all_complete = not waiting
+    print(f"Barrier attempt {attempt}: {len(pending_job_ids)} ingestion job(s) pending, {len(failed_job_ids)} failed.")
+
+    if not all_complete and attempt + 1 >= BARRIER_MAX_ATTEMPTS:
+        raise IngestionBarrierTimeout(
+            f"Ingestion jobs {sorted(pending_job_ids)} still running after {attempt + 1} checks"
+            + (f"; {len(unsynced)} file(s) never got a sync job." if sync_waiting else ".")
+        )
+
+    return {
+        "allComplete":   all_complete,
+        "attempt":       attempt + 1,
+        "waitSeconds":   0 if all_complete else next_wait_seconds(attempt, waiting),
+        "pendingJobIds": sorted(pending_job_ids),
+        "failedJobIds":  failed_job_ids
+    }
@@ -0,0 +1,174 @@
+import json
+import boto3
+import os
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key
+from change_version import bump_change_version  # docrag_shared layer
+
+# --- Configuration (Environment Variables) ---
+DYNAMODB_TABLE_NAME           = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+SUMMARIZE_STUDY_FUNCTION_NAME = os.environ.get('SUMMARIZE_STUDY_FUNCTION_NAME')
+POLL_MIN_SECONDS              = int(os.environ.get('STUDY_POLL_MIN_SECONDS', 15))
+POLL_MAX_SECONDS              = int(os.environ.get('STUDY_POLL_MAX_SECONDS', 120))
+REDISPATCH_AFTER_SECONDS      = int(os.environ.get('STUDY_REDISPATCH_AFTER_SECONDS', 1800))
+BARRIER_MAX_ATTEMPTS          = int(os.environ.get('STUDY_BARRIER_MAX_ATTEMPTS', 120))
+
+STUDY_ITEM_MARKER = "__STUDY__"
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+
+# --- Initialize AWS Clients ---
+lambda_client       = boto3.client('lambda')
+dynamodb_resource   = boto3.resource('dynamodb')
+file_metadata_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+
+class StudySummariesTimeout(Exception):
+    pass
+
+
+def load_study_registry(user_id, folder_id):
+    items = []
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key('sessionId#fileName').begins_with(f"{STUDY_ITEM_MARKER}#{folder_id}#")
+    }
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+def dispatch_study_summary(study_item):
+    """
+    Starts SummarizeSingleStudyLambda asynchronously for the study's current
+    version, unless the version moved on in the meantime.
+    """
+    version = int(study_item['version'])
+    try:
+        file_metadata_table.update_item(
+            Key={'userId': study_item['userId'], 'sessionId#fileName': study_item['sessionId#fileName']},
+            UpdateExpression="SET dispatchedVersion = :v, dispatchedAtUtc = :now",
+            ConditionExpression="version = :v",
+            ExpressionAttributeValues={':v': version, ':now': datetime.now(timezone.utc).isoformat()}
+        )
+    except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+    study_event = {
+        "userId": study_item['userId'], "folderId": study_item['folderId'],
+        "drugName": study_item.get('drugName', ''), "companyName": study_item.get('companyName', ''),
+        "mechanismOfAction": study_item.get('mechanismOfAction', ''),
+        "studyName": study_item['studyName'], "sourceFiles": sorted(study_item.get('sourceFiles', [])),
+        "registryKey": study_item['sessionId#fileName'], "registryVersion": version
+    }
+    lambda_client.invoke(
+        FunctionName=SUMMARIZE_STUDY_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps(study_event).encode('utf-8')
+    )
+    print(f"Re-dispatched summary of '{study_item['studyName']}' v{version}.")
+    return True
+
+
+def dispatch_is_stale(item, version):
+    """True when the current version was never dispatched, or its summary has not reported back in time."""
+    if int(item.get('dispatchedVersion', 0)) != version:
+        return True
+    dispatched_at = item.get('dispatchedAtUtc')
+    if not dispatched_at:
+        return True
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(dispatched_at)
+    return age.total_seconds() > REDISPATCH_AFTER_SECONDS
+
+
+def sync_progressive_summary(user_id, folder_id, summary_refs, total):
+    """
+    Studies whose current version was already summarized by an earlier run are
+    never re-dispatched, so they are added to the folder's progressive aggregate
+    here. Studies summarized during this run were added by SummarizeSingleStudyLambda.
+    """
+    folder_key = {'userId': user_id, 'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"}
+    folder_item = file_metadata_table.get_item(
+        Key=folder_key, ProjectionExpression="progressiveSummaries, studiesTotal"
+    ).get('Item') or {}
+    published = folder_item.get('progressiveSummaries')
+    if published is None:
+        return
+    changed = False
+    if folder_item.get('studiesTotal') != total:
+        file_metadata_table.update_item(
+            Key=folder_key, UpdateExpression="SET studiesTotal = :total", ExpressionAttributeValues={':total': total}
+        )
+        changed = True
+    for ref in summary_refs:
+        if ref['studyName'] in published:
+            continue
+        try:
+            file_metadata_table.update_item(
+                Key=folder_key,
+                UpdateExpression="SET #ps.#study = :entry ADD studiesCompleted :one",
+                ConditionExpression="attribute_not_exists(#ps.#study)",
+                ExpressionAttributeNames={'#ps': 'progressiveSummaries', '#study': ref['studyName']},
+                ExpressionAttributeValues={
+                    ':entry': {**ref, "completedAtUtc": datetime.now(timezone.utc).isoformat()}, ':one': 1
+                }
+            )
+            changed = True
+        except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+    if changed:
+        bump_change_version(file_metadata_table, user_id)
+
+
+def lambda_handler(event, context):
+    """
+    Pipelined mode barrier: one poll of the folder's study registry.
+    Step Functions loops CheckStudyRegistry -> Choice -> Wait(SecondsPath=waitSeconds)
+    until every study's current version is summarized or has failed. Studies
+    whose current version was never dispatched, or whose summary went missing,
+    are (re)dispatched here.
+
+    event == { "userId", "folderId", "attempt" }
+    """
+    user_id = event['userId']
+    folder_id = event['folderId']
+    attempt = int(event.get('attempt') or 0)
+
+    summary_refs, failed_studies, pending = [], [], 0
+    for item in load_study_registry(user_id, folder_id):
+        version = int(item.get('version', 0))
+        if not item.get('sourceFiles'):
+            continue  # every file of this study was removed
+        if int(item.get('summarizedVersion', 0)) == version and item.get('summaryS3Key'):
+            summary_refs.append({"s3_key": item['summaryS3Key'], "studyName": item['studyName']})
+        elif int(item.get('failedVersion', 0)) == version:
+            failed_studies.append({"studyName": item['studyName'], "error": item.get('lastError')})
+        else:
+            pending += 1
+            if dispatch_is_stale(item, version):
+                dispatch_study_summary(item)
+
+    all_complete = pending == 0
+    try:
+        sync_progressive_summary(user_id, folder_id, summary_refs, len(summary_refs) + len(failed_studies) + pending)
+    except Exception as e:
+        print(f"Could not sync progressive summary for folder {folder_id}: {e}")
+    print(f"Study barrier attempt {attempt}: {len(summary_refs)} summarized, {pending} pending, {len(failed_studies)} failed.")
+
+    if not all_complete and attempt + 1 >= BARRIER_MAX_ATTEMPTS:
+        raise StudySummariesTimeout(f"{pending} study summaries still pending after {attempt + 1} checks.")
+
+    if all_complete and not summary_refs:
+        raise RuntimeError(f"No study summaries were produced for folder '{folder_id}'.")
+
+    return {
+        "allComplete":   all_complete,
+        "attempt":       attempt + 1,
+        "waitSeconds":   0 if all_complete else int(min(POLL_MIN_SECONDS * (2 ** min(attempt, 6)), POLL_MAX_SECONDS)),
+        "pendingCount":  pending,
+        "failedStudies": failed_studies,
+        "summaryRefs":   summary_refs if all_complete else []
+    }
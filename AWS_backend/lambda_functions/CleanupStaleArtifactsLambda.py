@@ -0,0 +1,223 @@
+import os
+import re
+import json
+import boto3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from boto3.dynamodb.conditions import Key
+from admission import RUN_TENANT_MARKER, SYSTEM_USER  # docrag_shared layer
+from kb_cleanup import DEFAULT_KB_SOURCE_PREFIX, delete_keys, list_keys, request_kb_sync, run_pending_kb_sync  # docrag_shared layer
+from summary_pointers import SUMMARY_ITEM_MARKER, SUMMARY_VERSION_MARKER  # docrag_shared layer
+
+# --- Configuration (Environment Variables) ---
+S3_BUCKET_NAME        = os.environ['S3_BUCKET_NAME']
+DYNAMODB_TABLE_NAME   = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+S3_SUMMARY_PREFIX     = os.environ.get('S3_SUMMARY_PREFIX', 'folder-summaries').strip('/')
+KB_SOURCE_PREFIX      = os.environ.get('KB_S3_SOURCE_PREFIX', DEFAULT_KB_SOURCE_PREFIX).strip('/')
+KNOWLEDGE_BASE_ID     = os.environ.get('KNOWLEDGE_BASE_ID')
+DATA_SOURCE_ID        = os.environ.get('DATA_SOURCE_ID')
+BEDROCK_REGION        = os.environ.get('BEDROCK_REGION', 'us-east-1')
+
+# Retention policy
+SUMMARY_KEEP_VERSIONS      = int(os.environ.get('SUMMARY_KEEP_VERSIONS', 3))
+SUMMARY_MIN_AGE_DAYS       = int(os.environ.get('SUMMARY_MIN_AGE_DAYS', 7))
+AGGREGATE_RETENTION_DAYS   = int(os.environ.get('AGGREGATE_RETENTION_DAYS', 30))
+ORPHAN_CHUNK_MIN_AGE_HOURS = int(os.environ.get('ORPHAN_CHUNK_MIN_AGE_HOURS', 24))
+HEAD_CONCURRENCY           = int(os.environ.get('GC_HEAD_CONCURRENCY', 16))
+
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+STUDY_ITEM_MARKER = "__STUDY__"
+SORT_KEY = "sessionId#fileName"
+
+# summary_<sanitized study name>_<UTC timestamp>.json, as written by the summarize Lambdas
+STUDY_SUMMARY_PATTERN = re.compile(r'^(?P<series>.+/summary_.+)_(?P<ts>\d{8}T\d{6}Z)\.json$')
+
+# --- Initialize AWS Clients ---
+s3_client            = boto3.client('s3')
+bedrock_agent_client = boto3.client('bedrock-agent', region_name=BEDROCK_REGION)
+dynamodb_resource    = boto3.resource('dynamodb')
+file_metadata_table  = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+
+def known_users():
+    """
+    The users who may own summaries: those with a summary folder in S3 and
+    those the run scheduler has seen (its __RUN_TENANT__ items).
+    """
+    users = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=f"{S3_SUMMARY_PREFIX}/", Delimiter='/'):
+        users.update(p['Prefix'][len(S3_SUMMARY_PREFIX) + 1:].rstrip('/') for p in page.get('CommonPrefixes', []))
+    users -= {"aggregated-summaries", "_checkpoints"}
+    for item in query_prefix(SYSTEM_USER, f"{RUN_TENANT_MARKER}#", "#sk"):
+        users.add(item[SORT_KEY].split('#', 1)[1])
+    return users
+
+
+def query_prefix(user_id, prefix, projection):
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key(SORT_KEY).begins_with(prefix),
+        'ProjectionExpression': projection,
+        'ExpressionAttributeNames': {'#sk': SORT_KEY}
+    }
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def referenced_summary_keys():
+    """
+    Every summary object something still points at: each folder's latest
+    aggregate and section index, the progressive summaries of its current run,
+    each registered study's summary and every latest-summary pointer. Read
+    with one Query per user and key prefix.
+
+    Also returns the summary version items by the object they record, so the
+    items of collected objects can be dropped with them.
+    """
+    refs, version_items = set(), defaultdict(list)
+    projection = ("userId, #sk, folderSummaryS3Key, folderSectionIndexS3Key, progressiveSummaries, "
+                  "summaryS3Key, s3Key, sectionIndexS3Key")
+    for user_id in sorted(known_users()):
+        for marker in (FOLDER_ITEM_SESSION_MARKER, STUDY_ITEM_MARKER, SUMMARY_ITEM_MARKER):
+            for item in query_prefix(user_id, f"{marker}#", projection):
+                refs.update(item[attr] for attr in ("folderSummaryS3Key", "folderSectionIndexS3Key", "summaryS3Key",
+                                                    "s3Key", "sectionIndexS3Key") if item.get(attr))
+                refs.update(p['s3_key'] for p in (item.get('progressiveSummaries') or {}).values() if p.get('s3_key'))
+        for item in query_prefix(user_id, f"{SUMMARY_VERSION_MARKER}#", "userId, #sk, s3Key"):
+            if item.get('s3Key'):
+                version_items[item['s3Key']].append({'userId': item['userId'], SORT_KEY: item[SORT_KEY]})
+    return refs, version_items
+
+
+def drop_version_items(version_items, deleted_keys):
+    """Removes the summary version items of objects that were just deleted. Returns how many."""
+    keys = [key for s3_key in deleted_keys for key in version_items.get(s3_key, ())]
+    with file_metadata_table.batch_writer() as batch:
+        for key in keys:
+            batch.delete_item(Key=key)
+    return len(keys)
+
+
+def aggregate_stem(key):
+    """aggregated-summaries/<ts>.json, .jsonl, .sections.jsonl and .sections.index.json are one aggregate."""
+    directory, _, name = key.rpartition('/')
+    return f"{directory}/{name.split('.', 1)[0]}"
+
+
+def stale_aggregates(refs, now):
+    prefix = f"{S3_SUMMARY_PREFIX}/aggregated-summaries/"
+    live_stems = {aggregate_stem(ref) for ref in refs if ref.startswith(prefix)}
+    cutoff = now - timedelta(days=AGGREGATE_RETENTION_DAYS)
+    return [
+        obj['Key'] for obj in list_keys(s3_client, S3_BUCKET_NAME, prefix)
+        if obj['LastModified'] < cutoff and aggregate_stem(obj['Key']) not in live_stems
+    ]
+
+
+def stale_study_summaries(refs, now):
+    """
+    Per study (folder + study name), keeps the SUMMARY_KEEP_VERSIONS newest
+    summaries, any that is still referenced and any younger than
+    SUMMARY_MIN_AGE_DAYS; older versions are returned for deletion.
+    """
+    series = defaultdict(list)
+    skip = (f"{S3_SUMMARY_PREFIX}/aggregated-summaries/", f"{S3_SUMMARY_PREFIX}/_checkpoints/")
+    for obj in list_keys(s3_client, S3_BUCKET_NAME, f"{S3_SUMMARY_PREFIX}/"):
+        if obj['Key'].startswith(skip):
+            continue
+        match = STUDY_SUMMARY_PATTERN.match(obj['Key'])
+        if match:
+            series[match.group('series')].append((match.group('ts'), obj))
+
+    cutoff = now - timedelta(days=SUMMARY_MIN_AGE_DAYS)
+    stale = []
+    for versions in series.values():
+        versions.sort(key=lambda v: v[0], reverse=True)
+        stale.extend(
+            obj['Key'] for _, obj in versions[SUMMARY_KEEP_VERSIONS:]
+            if obj['LastModified'] < cutoff and obj['Key'] not in refs
+        )
+    return stale
+
+
+def source_exists(source_key):
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=source_key)
+        return True
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def orphaned_chunks(now):
+    """KB chunk objects whose source file is gone (deleted before cascade deletion existed, or a missed event)."""
+    by_source = defaultdict(list)
+    cutoff = now - timedelta(hours=ORPHAN_CHUNK_MIN_AGE_HOURS)
+    for obj in list_keys(s3_client, S3_BUCKET_NAME, f"{KB_SOURCE_PREFIX}/"):
+        source_key, marker, _ = obj['Key'][len(KB_SOURCE_PREFIX) + 1:].rpartition('/chunk_')
+        if marker:
+            by_source[source_key].append(obj)
+
+    candidates = [s for s, objs in by_source.items() if all(o['LastModified'] < cutoff for o in objs)]
+    with ThreadPoolExecutor(max_workers=max(1, min(HEAD_CONCURRENCY, len(candidates)))) as executor:
+        exists = dict(zip(candidates, executor.map(source_exists, candidates)))
+    orphans = [s for s in candidates if not exists[s]]
+    return orphans, [obj['Key'] for s in orphans for obj in by_source[s]]
+
+
+def collect_garbage(dry_run):
+    now = datetime.now(timezone.utc)
+    refs, version_items = referenced_summary_keys()
+    plan = {
+        "aggregates":      stale_aggregates(refs, now),
+        "study_summaries": stale_study_summaries(refs, now),
+    }
+    orphan_sources, plan["orphaned_chunks"] = orphaned_chunks(now)
+
+    report = {"dryRun": dry_run, "referencedSummaries": len(refs), "orphanedSources": len(orphan_sources)}
+    for name, keys in plan.items():
+        if dry_run:
+            report[name] = {"candidates": len(keys), "sample": keys[:10]}
+            continue
+        deleted, errors = delete_keys(s3_client, S3_BUCKET_NAME, keys)
+        report[name] = {"deleted": deleted, "errors": len(errors)}
+        for error in errors[:10]:
+            print(f"Could not delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+        if name != "orphaned_chunks":
+            failed = {error.get('Key') for error in errors}
+            report[name]["versionItems"] = drop_version_items(version_items, [k for k in keys if k not in failed])
+
+    if not dry_run and report["orphaned_chunks"]["deleted"]:
+        request_kb_sync(file_metadata_table, len(orphan_sources), "orphaned chunks collected")
+    return report
+
+
+def lambda_handler(event, context):
+    """
+    Scheduled maintenance (EventBridge), chosen by event["task"]:
+
+      "kb_sync"  starts the coalesced KB ingestion job if deletions are pending
+      "gc"       prunes superseded study summaries and expired aggregates by the
+                 retention policy above, removes KB chunks whose source file is
+                 gone, then syncs the KB; {"dryRun": true} only reports
+    """
+    task = (event or {}).get('task', 'gc')
+    print(f"CleanupStaleArtifacts task: {task}")
+
+    report = {}
+    if task == 'gc':
+        report = collect_garbage(bool(event.get('dryRun')))
+        print("GC report:", json.dumps(report))
+        if report["dryRun"]:
+            return report
+    elif task != 'kb_sync':
+        raise ValueError(f"Unknown task: {task}")
+
+    report["kbSyncJobId"] = run_pending_kb_sync(file_metadata_table, bedrock_agent_client, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID)
+    return report
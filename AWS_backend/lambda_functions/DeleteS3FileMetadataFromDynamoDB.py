@@ -2,64 +2,197 @@ import json
 import boto3
 import os
 import urllib.parse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from change_version import bump_change_versions  # docrag_shared layer
+from file_status import DELETED, StatusWriter, event_time_ms, now_ms, row_folder_id  # docrag_shared layer
+from folder_counters import (  # docrag_shared layer
+    CONTRIBUTION_ATTRIBUTES, add_delta, apply_folder_counters, previous_items, report_counter_failure, row_contribution
+)
+from kb_cleanup import (  # docrag_shared layer
+    DEFAULT_KB_SOURCE_PREFIX, chunk_prefix, delete_keys, list_keys, request_kb_sync, run_pending_kb_sync
+)
+from s3_event_batch import batch_response, unpack_s3_event, write_batch  # docrag_shared layer
 
 dynamodb = boto3.resource('dynamodb')
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
 table = dynamodb.Table(TABLE_NAME)
+KEY_NAMES = ['userId', 'sessionId#fileName']
 
-def lambda_handler(event, context):
-    print("Received S3 delete event:", json.dumps(event, indent=2))
+S3_BUCKET_NAME    = os.environ.get('S3_BUCKET_NAME')
+KB_SOURCE_PREFIX  = os.environ.get('KB_S3_SOURCE_PREFIX', DEFAULT_KB_SOURCE_PREFIX).strip('/')
+MANIFEST_PREFIX   = os.environ.get('S3_MANIFEST_PREFIX', 'processing-manifests').strip('/')
+KNOWLEDGE_BASE_ID = os.environ.get('KNOWLEDGE_BASE_ID')
+DATA_SOURCE_ID    = os.environ.get('DATA_SOURCE_ID')
+CASCADE_LIST_CONCURRENCY = int(os.environ.get('CASCADE_LIST_CONCURRENCY', 8))
+
+s3_client = boto3.client('s3')
+bedrock_agent_client = boto3.client('bedrock-agent', region_name=os.environ.get('BEDROCK_REGION', 'us-east-1'))
+
+# SYSTEM prefixes to skip entirely (as in RecordS3FileMetadata); includes the
+# KB chunks, whose own removal notifications come back through this Lambda
+EXCLUDE_PREFIXES = [
+    f"{KB_SOURCE_PREFIX}/",
+    "verification/",
+    "textract-output/",
+    f"{MANIFEST_PREFIX}/",
+    "folder-summaries/_checkpoints/",
+    "folder-summaries/aggregated-summaries/",
+]
+
+
+def build_key(s3_record):
+    """
+    Returns (metadata key, source key whose KB chunks go with it, event time
+    in ms) for one ObjectRemoved record, or None for objects that are not user
+    files. Summaries under folder-summaries/ have a metadata row but no chunks.
+    """
+    object_key = urllib.parse.unquote_plus(s3_record['s3']['object']['key'], encoding='utf-8')
+
+    if any(object_key.startswith(p) for p in EXCLUDE_PREFIXES):
+        return None
+
+    # Optional upload prefix, if the frontend writes user files below one
+    upload_prefix = os.environ.get('S3_UPLOAD_PREFIX', '')
+    if not object_key.startswith(upload_prefix):
+        return None
+    path_after_prefix = object_key[len(upload_prefix):]
 
+    source_key = object_key
+    if path_after_prefix.startswith("folder-summaries/"):
+        path_after_prefix = path_after_prefix[len("folder-summaries/"):]
+        source_key = None
+
+    key_parts = path_after_prefix.split('/', 3)
+    if len(key_parts) < 4 or path_after_prefix.endswith('/'):
+        print(f"Error: Object key part '{path_after_prefix}' after prefix incorrect structure for delete. Skipping.")
+        return None
+
+    user_id_from_path, session_id_from_path, user_folder_from_path, file_name_from_path = key_parts
     try:
-        for record in event['Records']:
-            s3_record = record['s3']
-            bucket_name = s3_record['bucket']['name']
-            object_key = urllib.parse.unquote_plus(s3_record['object']['key'], encoding='utf-8')
-
-            # IMPORTANT: Add a check for prefix if this trigger is on the whole bucket
-            if not object_key.startswith(os.environ.get('S3_UPLOAD_PREFIX', 'uploads/')):
-                print(f"Skipping S3 delete for key '{object_key}' as it does not match the expected upload prefix.")
-                continue
-
-            print(f"Processing DELETE for Bucket: '{bucket_name}', Key: '{object_key}'")
-            
-            path_after_prefix = object_key
-            if 'S3_UPLOAD_PREFIX' in os.environ:
-                upload_prefix = os.environ['S3_UPLOAD_PREFIX']
-                if object_key.startswith(upload_prefix):
-                    path_after_prefix = object_key[len(upload_prefix):]
-
-            key_parts = path_after_prefix.split('/')
-            if len(key_parts) < 4:
-                print(f"Error: Object key part '{path_after_prefix}' after prefix incorrect structure for delete. Skipping.")
-                continue
-
-            user_id_from_path = key_parts[0]
-            session_id_from_path = key_parts[1]
-            user_folder_from_path = key_parts[2]
-            file_name_from_path = key_parts[3]
-
-            pk_to_delete = user_id_from_path
-            sk_to_delete = f"{session_id_from_path}#{user_folder_from_path}#{file_name_from_path}"
-
-            print(f"Attempting to delete from DynamoDB: PK='{pk_to_delete}', SK ('sessionId#fileName')='{sk_to_delete}'")
-            
-            response = table.delete_item(
-                Key={
-                    'userId': pk_to_delete,
-                    'sessionId#fileName': sk_to_delete 
-                }
-                # Consider adding ConditionExpression to only delete if item exists and has certain attributes
-            )
-            print(f"DynamoDB delete_item response: {response}")
-            print(f"Successfully processed S3 delete event for '{object_key}'. Metadata removed from DynamoDB.")
+        at_ms = event_time_ms(s3_record['eventTime'])
+    except (KeyError, ValueError):
+        at_ms = now_ms()
+    return {
+        'userId': user_id_from_path,
+        'sessionId#fileName': f"{session_id_from_path}#{user_folder_from_path}#{file_name_from_path}"
+    }, source_key, at_ms
+
+
+def cascade_chunk_deletion(sources):
+    """
+    Deletes the KB chunks of every removed source file ([(messageId, source key)])
+    with batched delete_objects. Returns (objects deleted, messageIds that failed).
+    """
+    def list_source(source):
+        message_id, source_key = source
+        return message_id, [obj['Key'] for obj in list_keys(s3_client, S3_BUCKET_NAME, chunk_prefix(KB_SOURCE_PREFIX, source_key))]
+
+    failed, chunk_keys, owners = set(), [], {}
+    with ThreadPoolExecutor(max_workers=max(1, min(CASCADE_LIST_CONCURRENCY, len(sources)))) as executor:
+        for message_id, keys in executor.map(list_source, sources):
+            chunk_keys.extend(keys)
+            owners.update((key, message_id) for key in keys)
 
+    deleted, errors = delete_keys(s3_client, S3_BUCKET_NAME, chunk_keys)
+    for error in errors:
+        print(f"Could not delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+        if error.get('Key') in owners:
+            failed.add(owners[error['Key']])
+    return deleted, failed
+
+
+def lambda_handler(event, context):
+    """
+    Removes file metadata for S3 ObjectRemoved notifications, delivered in
+    SQS batches (see s3_event_batch). The removed files' KB chunks are
+    deleted first and one coalesced ingestion sync is requested for the batch
+    (see kb_cleanup).
+
+    A file that was ingested keeps its row as a "deleted" tombstone (see
+    file_status) until the next run of its folder detaches it from its
+    studies; other rows are deleted through one batch_writer. A row whose
+    status is newer than the event, i.e. the file was uploaded again since,
+    is left alone. The folders' counters drop by what was removed (see
+    folder_counters).
+    Messages that could not be processed are reported in batchItemFailures
+    so only they are redelivered.
+    """
+    pairs, failed = unpack_s3_event(event)
+
+    removals, skipped = [], 0
+    for message_id, s3_record in pairs:
+        try:
+            parsed = build_key(s3_record)
+        except Exception as e:
+            print(f"Error reading record of message {message_id}: {e} ({json.dumps(s3_record)[:500]})")
+            failed.add(message_id)
+            continue
+        if parsed is None:
+            skipped += 1
+            continue
+        removals.append((message_id, *parsed))
+
+    # The rows' last state, to tell tombstones from deletes and take them out of their folders' counters
+    previous = previous_items(table, [key for _, key, _, _ in removals],
+                              [*CONTRIBUTION_ATTRIBUTES, 'sourceS3Key', 'statusAtMs']) if removals else {}
+    current = []
+    for removal in removals:
+        _, key, _, at_ms = removal
+        row = previous.get((key['userId'], key['sessionId#fileName'])) or {}
+        if int(row.get('statusAtMs') or 0) >= at_ms:
+            skipped += 1
+            continue
+        current.append(removal)
+
+    sources = [(message_id, source_key) for message_id, _, source_key, _ in current if source_key]
+    chunks_deleted = 0
+    if sources:
+        chunks_deleted, cascade_failed = cascade_chunk_deletion(sources)
+        failed |= cascade_failed
+
+    operations, tombstones = [], []
+    for message_id, key, _, at_ms in current:
+        if message_id in failed:
+            continue
+        if previous.get((key['userId'], key['sessionId#fileName']), {}).get('sourceS3Key'):
+            tombstones.append((key, at_ms))
+        else:
+            operations.append((message_id, "delete", key))
+
+    # A re-upload of the same file must be ingested again, not skipped as unchanged
+    with StatusWriter(table) as writer:
+        for key, at_ms in tombstones:
+            writer.emit(key, DELETED, at_ms=at_ms, remove=('sourceETag',))
+
+    write_failed = write_batch(table, operations, KEY_NAMES)
+    failed |= write_failed
+    deleted = [key for message_id, _, key in operations if message_id not in write_failed]
+
+    deltas = defaultdict(Counter)
+    for key in {(key['userId'], key['sessionId#fileName']) for key in deleted}:
+        row = previous.get(key)
+        # Rows written before sessionId/userFolder were recorded have no folder to count against
+        folder_id = row_folder_id(row) if row else None
+        if folder_id:
+            add_delta(deltas, key[0], folder_id, Counter(), row_contribution(row))
+    usage = None
+    try:
+        usage = apply_folder_counters(table, deltas)
     except Exception as e:
-        print(f"Error processing S3 delete event for object key '{object_key if 'object_key' in locals() else 'unknown'}'. Error: {str(e)}")
-        print("Full event causing error:", json.dumps(event, indent=2))
-        raise 
+        # The rows are gone; failing the batch would not count them again on redelivery
+        report_counter_failure(deltas, e)
+    if deleted:
+        bump_change_versions(table, [key['userId'] for key in deleted], usage)
+    if chunks_deleted:
+        request_kb_sync(table, len(sources), "source files deleted")
+        try:
+            run_pending_kb_sync(table, bedrock_agent_client, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID)
+        except Exception as e:
+            # The request stays pending; the scheduled cleanup run starts the sync
+            print(f"Could not start the KB sync now: {e}")
 
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Successfully processed S3 delete event records.')
-    }
+    print(f"Removed metadata for {len(deleted)} file(s), left {len(tombstones)} tombstone(s) and removed "
+          f"{chunks_deleted} KB chunk object(s) from {len(pairs)} S3 record(s); skipped {skipped}, "
+          f"{len(failed)} message(s) failed.")
+    return batch_response(failed)
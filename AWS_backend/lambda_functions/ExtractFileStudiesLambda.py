@@ -0,0 +1,230 @@
+import boto3
+import os
+import re
+import time
+import json
+import random
+from model_router import ModelRouter  # docrag_shared layer
+from change_version import bump_change_version  # docrag_shared layer
+from file_status import INGESTED, StatusWriter, file_key  # docrag_shared layer
+from retrieval import retrieval_depth
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key, Attr
+
+# AWS Clients and Environment variables
+bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
+lambda_client = boto3.client('lambda')
+dynamodb_resource = boto3.resource('dynamodb')
+KB_ID = os.environ.get('KB_ID')
+SUMMARY_MODEL_ID = os.environ.get('BEDROCK_SUMMARY_MODEL_ID')
+AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+bedrock_router = ModelRouter(bedrock_agent_runtime_client, region=AWS_REGION, default_model=SUMMARY_MODEL_ID)
+DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+SUMMARIZE_STUDY_FUNCTION_NAME = os.environ.get('SUMMARIZE_STUDY_FUNCTION_NAME')
+file_metadata_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+# Configuration
+MAX_RETRIES = 3
+BASE_SLEEP_SECONDS = 3
+PACING_DELAY_SECONDS = 1.0
+
+# Study registry items share the metadata table:
+#   sessionId#fileName = "__STUDY__#<folderId>#<studyKey>"
+# "version" is bumped whenever a file is mapped to or removed from the study;
+# a summary is current when summarizedVersion == version.
+STUDY_ITEM_MARKER = "__STUDY__"
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+
+
+def study_registry_key(user_id, folder_id, study_name):
+    study_key = re.sub(r'[^a-z0-9]+', '-', study_name.lower()).strip('-') or "unnamed"
+    return {'userId': user_id, 'sessionId#fileName': f"{STUDY_ITEM_MARKER}#{folder_id}#{study_key}"}
+
+def dispatch_study_summary(study_item):
+    """
+    Starts SummarizeSingleStudyLambda asynchronously for the study's current
+    version. Skipped when another file has bumped the version in the meantime;
+    whoever bumped it dispatches the newer version.
+    """
+    version = int(study_item['version'])
+    try:
+        file_metadata_table.update_item(
+            Key={'userId': study_item['userId'], 'sessionId#fileName': study_item['sessionId#fileName']},
+            UpdateExpression="SET dispatchedVersion = :v, dispatchedAtUtc = :now",
+            ConditionExpression="version = :v",
+            ExpressionAttributeValues={':v': version, ':now': datetime.now(timezone.utc).isoformat()}
+        )
+    except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Study '{study_item['studyName']}' moved past version {version}; not dispatching it.")
+        return False
+
+    study_event = {
+        "userId": study_item['userId'], "folderId": study_item['folderId'],
+        "drugName": study_item.get('drugName', ''), "companyName": study_item.get('companyName', ''),
+        "mechanismOfAction": study_item.get('mechanismOfAction', ''),
+        "studyName": study_item['studyName'], "sourceFiles": sorted(study_item.get('sourceFiles', [])),
+        "registryKey": study_item['sessionId#fileName'], "registryVersion": version
+    }
+    lambda_client.invoke(
+        FunctionName=SUMMARIZE_STUDY_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps(study_event).encode('utf-8')
+    )
+    print(f"Dispatched summary of '{study_item['studyName']}' v{version} ({len(study_event['sourceFiles'])} files).")
+    return True
+
+def invoke_bedrock_with_retry(prompt_text, filter, step_description, task):
+    for attempt in range(MAX_RETRIES):
+        try:
+            return bedrock_router.retrieve_and_generate(
+                task, prompt_text, KB_ID, {'filter': filter, 'numberOfResults': retrieval_depth(task)}, step_description
+            )
+        except bedrock_agent_runtime_client.exceptions.ThrottlingException as e:
+            if attempt < MAX_RETRIES - 1:
+                sleep_time = (BASE_SLEEP_SECONDS * (2 ** attempt)) + random.uniform(0, 1)
+                print(f"ThrottlingException during {step_description}. Retrying in {sleep_time:.2f}s...")
+                time.sleep(sleep_time)
+            else:
+                raise e
+        except Exception as e:
+            print(f"Error during {step_description}: {e}")
+            raise e
+    raise Exception(f"Failed {step_description} after retries.")
+
+def parse_product_overviews_text(text):
+    products = []
+    if "NO_PRIMARY_PRODUCTS_FOUND" in text:
+        return products
+    for block in text.split("###END_PRODUCT###"):
+        if not block.strip():
+            continue
+        product = {}
+        drug_match = re.search(r"Drug:\s*(.*?)(?=\nMechanism of Action:|\nCompany:|$)", block, re.IGNORECASE | re.DOTALL)
+        moa_match = re.search(r"Mechanism of Action:\s*(.*?)(?=\nCompany:|$)", block, re.IGNORECASE | re.DOTALL)
+        company_match = re.search(r"Company:\s*(.*)", block, re.IGNORECASE | re.DOTALL)
+        if drug_match:
+            product['drug_name'] = drug_match.group(1).strip()
+        if moa_match:
+            product['mechanism_of_action'] = moa_match.group(1).strip()
+        if company_match:
+            product['company_name'] = company_match.group(1).strip()
+        if product.get('drug_name') and product.get('company_name'):
+            products.append(product)
+    return products
+
+def extract_file_studies(user_id, folder_id, file_name):
+    """Product and study-type prompts restricted to one indexed file. Returns (product, [study names])."""
+    file_filter = {'andAll': [
+        {'equals': {'key': 'user_id', 'value': user_id}},
+        {'equals': {'key': 'folder_id', 'value': folder_id}},
+        {'equals': {'key': 'file_name', 'value': file_name}}
+    ]}
+
+    product_prompt = "Identify the main drug products and companies. Format each as:\nDrug: [name]\nMechanism of Action: [moa]\nCompany: [name]\n###END_PRODUCT###\nIf none, respond: NO_PRIMARY_PRODUCTS_FOUND"
+    product_result = invoke_bedrock_with_retry(product_prompt, file_filter, f"Product Identification ({file_name})", "product_list")
+    products = parse_product_overviews_text(product_result['output']['text'])
+    if not products:
+        return None, []
+    product = products[0]
+
+    time.sleep(PACING_DELAY_SECONDS)
+    study_type_prompt = f"For drug '{product['drug_name']}', list *all* distinct study types mentioned (e.g., Phase 3 VANGUARD). Respond only with a comma-separated list."
+    study_types_result = invoke_bedrock_with_retry(study_type_prompt, file_filter, f"Study Type for {product['drug_name']} ({file_name})", "study_names")
+    raw_text = study_types_result['output']['text'].strip()
+    if ':' in raw_text:
+        raw_text = raw_text.split(':', 1)[1].strip()
+    return product, sorted({s.strip() for s in raw_text.split(',') if s.strip()})
+
+def register_file_studies(user_id, folder_id, file_name, product, study_names):
+    """Maps the file to each study in the registry and bumps the study versions. Returns the updated items."""
+    updated = []
+    for study_name in study_names:
+        resp = file_metadata_table.update_item(
+            Key=study_registry_key(user_id, folder_id, study_name),
+            UpdateExpression=(
+                "SET folderId = :folder, studyName = if_not_exists(studyName, :study), "
+                "drugName = if_not_exists(drugName, :drug), companyName = if_not_exists(companyName, :company), "
+                "mechanismOfAction = if_not_exists(mechanismOfAction, :moa), lastUpdatedUtc = :now "
+                "ADD sourceFiles :file, version :one"
+            ),
+            ExpressionAttributeValues={
+                ':folder': folder_id, ':study': study_name,
+                ':drug': product['drug_name'], ':company': product['company_name'],
+                ':moa': product.get('mechanism_of_action', ''),
+                ':now': datetime.now(timezone.utc).isoformat(),
+                ':file': {file_name}, ':one': 1
+            },
+            ReturnValues="ALL_NEW"
+        )
+        updated.append(resp['Attributes'])
+    return updated
+
+def record_studies_total(user_id, folder_id):
+    """studiesTotal of the progressive aggregate = studies in the registry that still have files."""
+    total = 0
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key('sessionId#fileName').begins_with(f"{STUDY_ITEM_MARKER}#{folder_id}#"),
+        'FilterExpression': Attr('sourceFiles').exists(),
+        'Select': 'COUNT'
+    }
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        total += response.get('Count', 0)
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    file_metadata_table.update_item(
+        Key={'userId': user_id, 'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"},
+        UpdateExpression="SET studiesTotal = :total",
+        ExpressionAttributeValues={':total': total}
+    )
+    bump_change_version(file_metadata_table, user_id)
+    return total
+
+def lambda_handler(event, context):
+    """
+    Pipelined mode: runs right after a batch's ingestion job is COMPLETE.
+
+    event == { "userId", "folderId", "results": [ per-item results of IngestFileBatchToKB ] }
+
+    Every successfully ingested file is marked ingested (see file_status) and
+    gets its own study extraction, the study registry is updated, and each
+    study touched is dispatched for summarization immediately instead of
+    waiting for the rest of the folder.
+    """
+    bedrock_router.reset_stats()
+    user_id = event['userId']
+    folder_id = event['folderId']
+    ingested = [r for r in event.get('results', [])
+                if r.get('status') == 'SUCCEEDED' and r.get('action', 'ingest') == 'ingest']
+    with StatusWriter(file_metadata_table) as writer:
+        completed_at = datetime.now(timezone.utc).isoformat()
+        for r in ingested:
+            writer.emit(file_key(user_id, folder_id, r.get('fileName') or os.path.basename(r['s3Key'])), INGESTED,
+                        attributes={'ingestionJobStatus': "COMPLETE", 'completedAtUtc': completed_at})
+    files = sorted({os.path.basename(r['s3Key']) for r in ingested})
+    print(f"Extracting studies for {len(files)} newly indexed file(s) in folder {folder_id}.")
+
+    touched = {}
+    failed_files = []
+    for file_name in files:
+        try:
+            product, study_names = extract_file_studies(user_id, folder_id, file_name)
+            if not study_names:
+                print(f"No studies found in {file_name}.")
+                continue
+            for item in register_file_studies(user_id, folder_id, file_name, product, study_names):
+                touched[item['sessionId#fileName']] = item
+            print(f"{file_name}: {study_names}")
+        except Exception as e:
+            print(f"Study extraction failed for {file_name}: {e}")
+            failed_files.append(file_name)
+        time.sleep(PACING_DELAY_SECONDS)
+
+    dispatched = sum(1 for item in touched.values() if dispatch_study_summary(item))
+    if touched:
+        print(f"Folder {folder_id} now has {record_studies_total(user_id, folder_id)} studies.")
+    print(f"Model stats: {json.dumps(bedrock_router.summary())}")
+    return {"filesProcessed": len(files), "failedFiles": failed_files,
+            "studiesTouched": len(touched), "studiesDispatched": dispatched}
@@ -4,39 +4,33 @@ import re
 import time
 import json
 import random
+from model_router import ModelRouter  # docrag_shared layer
+from retrieval import retrieval_depth
 
 # AWS Clients and Environment variables
 bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
+dynamodb_resource = boto3.resource('dynamodb')
 KB_ID = os.environ.get('KB_ID')
 SUMMARY_MODEL_ID = os.environ.get('BEDROCK_SUMMARY_MODEL_ID')
 AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+bedrock_router = ModelRouter(bedrock_agent_runtime_client, region=AWS_REGION, default_model=SUMMARY_MODEL_ID)
+DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+file_metadata_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
 
 # Configuration
 MAX_RETRIES = 3
 BASE_SLEEP_SECONDS = 3
 PACING_DELAY_SECONDS = 1.0
 
-def invoke_bedrock_with_retry(prompt_text, filter, step_description):
-    model_arn = SUMMARY_MODEL_ID if SUMMARY_MODEL_ID.startswith("arn:") else f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{SUMMARY_MODEL_ID}"
+def invoke_bedrock_with_retry(prompt_text, filter, step_description, task):
     for attempt in range(MAX_RETRIES):
         try:
-            response = bedrock_agent_runtime_client.retrieve_and_generate(
-                input={'text': prompt_text},
-                retrieveAndGenerateConfiguration={
-                    'type': 'KNOWLEDGE_BASE',
-                    'knowledgeBaseConfiguration': {
-                        'knowledgeBaseId': KB_ID,
-                        'modelArn': model_arn,
-                        'retrievalConfiguration': {
-                            'vectorSearchConfiguration': {
-                                'filter': filter,
-                                'numberOfResults': 30
-                            }
-                        }
-                    }
-                }
+            return bedrock_router.retrieve_and_generate(
+                task, prompt_text, KB_ID, {'filter': filter, 'numberOfResults': retrieval_depth(task)}, step_description
             )
-            return response
         except bedrock_agent_runtime_client.exceptions.ThrottlingException as e:
             if attempt < MAX_RETRIES - 1:
                 sleep_time = (BASE_SLEEP_SECONDS * (2 ** attempt)) + random.uniform(0, 1)
@@ -70,7 +64,19 @@ def parse_product_overviews_text(text):
             products.append(product)
     return products
 
+def record_studies_total(user_id, folder_id, total):
+    """Lets the progressive aggregate report completed/total while the studies are summarized."""
+    try:
+        file_metadata_table.update_item(
+            Key={'userId': user_id, 'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"},
+            UpdateExpression="SET studiesTotal = :total",
+            ExpressionAttributeValues={':total': total}
+        )
+    except Exception as e:
+        print(f"Could not record studiesTotal for folder {folder_id}: {e}")
+
 def lambda_handler(event, context):
+    bedrock_router.reset_stats()
     user_id = event['userId']
     folder_id = event['folderId']
     print(f"Identifying studies for User: {user_id}, Folder: {folder_id}")
@@ -78,10 +84,11 @@ def lambda_handler(event, context):
 
     # Step 1: Extract Products
     product_prompt = "Identify the main drug products and companies. Format each as:\nDrug: [name]\nMechanism of Action: [moa]\nCompany: [name]\n###END_PRODUCT###\nIf none, respond: NO_PRIMARY_PRODUCTS_FOUND"
-    product_result = invoke_bedrock_with_retry(product_prompt, base_filter, "Product Identification")
+    product_result = invoke_bedrock_with_retry(product_prompt, base_filter, "Product Identification", "product_list")
     extracted_products = parse_product_overviews_text(product_result['output']['text'])
     
     if not extracted_products:
+        record_studies_total(user_id, folder_id, 0)
         return {"studies": [], "productOverviews": []}
 
     main_product = extracted_products[0]
@@ -91,7 +98,7 @@ def lambda_handler(event, context):
     # Step 2: Get a unique list of all study names
     all_found_study_names = set()
     study_type_prompt = f"For drug '{drug}', list *all* distinct study types mentioned (e.g., Phase 3 VANGUARD). Respond only with a comma-separated list."
-    study_types_result = invoke_bedrock_with_retry(study_type_prompt, base_filter, f"Study Type for {drug}")
+    study_types_result = invoke_bedrock_with_retry(study_type_prompt, base_filter, f"Study Type for {drug}", "study_names")
     raw_text = study_types_result['output']['text'].strip()
     if ':' in raw_text:
         raw_text = raw_text.split(':', 1)[1].strip()
@@ -104,7 +111,7 @@ def lambda_handler(event, context):
     for study_name in all_found_study_names:
         source_file_prompt = f"Which source file name contains the exact phrase or study identifier '{study_name}'? Respond with only the filename(s)."
         time.sleep(PACING_DELAY_SECONDS)
-        source_file_result = invoke_bedrock_with_retry(source_file_prompt, base_filter, f"Source File for {study_name}")
+        source_file_result = invoke_bedrock_with_retry(source_file_prompt, base_filter, f"Source File for {study_name}", "file_lookup")
         
         source_files = set()
         citations = source_file_result.get('citations', [])
@@ -127,5 +134,7 @@ def lambda_handler(event, context):
             "drugName": drug, "companyName": company, "mechanismOfAction": moa,
             "studyName": study_name, "sourceFiles": files
         })
-    
+
+    record_studies_total(user_id, folder_id, len(studies_to_process))
+    print(f"Model stats: {json.dumps(bedrock_router.summary())}")
     return {"studies": studies_to_process, "productOverviews": product_overview}
\ No newline at end of file
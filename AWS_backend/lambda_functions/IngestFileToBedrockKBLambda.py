@@ -1,11 +1,12 @@
 import json
 import boto3
 import os
-import time
 import traceback
 import uuid
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key, Attr
 
 # Import Textractor and related classes
 from textractor import Textractor
@@ -14,15 +15,21 @@ from textractor.entities.bbox import BoundingBox
 from textractor.entities.document_entity import DocumentEntity
 from textractor.entities.table import Table
 
+from file_status import INGEST_FAILED, INGESTING, StatusWriter, file_key, file_parts  # docrag_shared layer
+from kb_cleanup import DEFAULT_KB_SOURCE_PREFIX, SYNC_PENDING, request_kb_sync  # docrag_shared layer
+
 # --- Configuration (Environment Variables) ---
 DYNAMODB_TABLE_NAME     = os.environ['DYNAMODB_TABLE_NAME']
 S3_BUCKET_NAME          = os.environ['S3_BUCKET_NAME']
 BEDROCK_REGION          = os.environ.get('BEDROCK_REGION', 'us-east-1')
 DESTINATION_S3_BUCKET   = os.environ.get('DESTINATION_S3_BUCKET')
-DESTINATION_S3_PREFIX   = os.environ.get('DESTINATION_S3_PREFIX', 'kb-data-source/').strip('/')
+DESTINATION_S3_PREFIX   = os.environ.get('DESTINATION_S3_PREFIX', DEFAULT_KB_SOURCE_PREFIX).strip('/')
 KNOWLEDGE_BASE_ID       = os.environ.get('KNOWLEDGE_BASE_ID')
 DATA_SOURCE_ID          = os.environ.get('DATA_SOURCE_ID')
 MAX_WORDS_PER_CHUNK     = int(os.environ.get('MAX_WORDS_PER_CHUNK', 200))
+INGEST_BATCH_CONCURRENCY = int(os.environ.get('INGEST_BATCH_CONCURRENCY', 4))
+STUDY_ITEM_MARKER       = "__STUDY__"
+SUPPORTED_EXTENSIONS    = ('.pdf','.png','.jpg','.jpeg','.txt','.md','.html','.doc','.docx','.csv','.xls','.xlsx')
 
 # --- Initialize AWS Clients ---
 s3_client            = boto3.client('s3')
@@ -65,7 +72,8 @@ def extract_text_chunks_from_document(s3_bucket_name, s3_object_key, parsed_user
         "error": None,
         "source_s3_bucket": s3_bucket_name,
         "source_s3_key": s3_object_key,
-        "chunks_generated": 0
+        "chunks_generated": 0,
+        "pages_processed": 0
     }
 
     try:
@@ -75,6 +83,7 @@ def extract_text_chunks_from_document(s3_bucket_name, s3_object_key, parsed_user
             save_image=False
         )
         print(f"Textract analysis completed. Processing {len(document.pages)} pages.")
+        processing_status["pages_processed"] = len(document.pages)
 
         if not document.pages:
             processing_status["status"] = "No pages found by Textract"
@@ -226,39 +235,9 @@ def extract_text_chunks_from_document(s3_bucket_name, s3_object_key, parsed_user
 
 
 # -----------------------------------------------------------------------------
-# 3a. Find any active ingestion job
-# -----------------------------------------------------------------------------
-def _find_active_ingestion_job_id(knowledge_base_id, data_source_id):
-    paginator = bedrock_agent_client.get_paginator('list_ingestion_jobs')
-    for page in paginator.paginate(knowledgeBaseId=knowledge_base_id, dataSourceId=data_source_id):
-        for job in page.get("ingestionJobSummaries", []):
-            if job.get("status") in ("IN_PROGRESS", "STARTING"):
-                return job["ingestionJobId"]
-    return None
-
-
-# -----------------------------------------------------------------------------
-# 3b. Polling helper to wait for ingestion completion
-# -----------------------------------------------------------------------------
-def _wait_for_ingestion_completion(kb_id, ds_id, job_id, delay=30, max_attempts=20):
-    for attempt in range(1, max_attempts+1):
-        resp = bedrock_agent_client.get_ingestion_job(
-            knowledgeBaseId=kb_id,
-            dataSourceId=ds_id,
-            ingestionJobId=job_id
-        )
-        status = resp["ingestionJob"]["status"]
-        print(f"[{attempt}/{max_attempts}] Job {job_id} status: {status}")
-        if status in ("COMPLETE", "FAILED"):
-            return status
-        time.sleep(delay)
-    raise TimeoutError(f"Ingestion job {job_id} did not complete after {delay*max_attempts} seconds.")
-
-
-# -----------------------------------------------------------------------------
-# 3c. Save chunks and start (or enqueue) ingestion (MODIFIED)
+# 3a. Save chunks for the KB data source (ingestion is started once per batch)
 # -----------------------------------------------------------------------------
-def save_chunks_for_kb_and_ingest(chunks, s3_object_key, processing_status_obj):
+def save_chunks_for_kb(chunks, s3_object_key, processing_status_obj):
     if not all([DESTINATION_S3_BUCKET, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID]):
         err = "Missing DESTINATION_S3_BUCKET, KNOWLEDGE_BASE_ID, or DATA_SOURCE_ID"
         print(f"CRITICAL: {err}")
@@ -266,7 +245,7 @@ def save_chunks_for_kb_and_ingest(chunks, s3_object_key, processing_status_obj):
         return False
 
     if not chunks:
-        print(f"No chunks to save for {s3_object_key}. Skipping ingestion.")
+        print(f"No chunks to save for {s3_object_key}.")
         return True
 
     file_name = os.path.basename(s3_object_key)
@@ -312,21 +291,14 @@ def save_chunks_for_kb_and_ingest(chunks, s3_object_key, processing_status_obj):
             processing_status_obj["error"] = str(e)
             return False
 
-    # check for existing ingestion
-    print("All chunks saved. Checking for active ingestion jobs…")
-    active_id = _find_active_ingestion_job_id(KNOWLEDGE_BASE_ID, DATA_SOURCE_ID)
-    if active_id:
-        print(f"Found active job {active_id}; polling for completion…")
-        try:
-            final_status = _wait_for_ingestion_completion(
-                KNOWLEDGE_BASE_ID, DATA_SOURCE_ID, active_id
-            )
-            print(f"Previous ingestion job {active_id} finished with status: {final_status}")
-        except Exception as e:
-            print(f"Polling error for job {active_id}: {e}")
-            # we can continue to start a new one or choose to abort; here we continue
+    print(f"All {len(chunks)} chunks saved for {s3_object_key}.")
+    return True
+
 
-    # start a new ingestion job
+# -----------------------------------------------------------------------------
+# 3b. Start an ingestion job, or leave it to the barrier if one is running
+# -----------------------------------------------------------------------------
+def start_kb_ingestion_job(processing_status_obj, changes):
     print("Starting new ingestion job.")
     try:
         resp = bedrock_agent_client.start_ingestion_job(
@@ -338,6 +310,13 @@ def save_chunks_for_kb_and_ingest(chunks, s3_object_key, processing_status_obj):
         processing_status_obj["ingestion_job_details"] = ingestion_job
         print(f"Ingestion started: {ingestion_job.get('ingestionJobId')}")
         return True
+    except bedrock_agent_client.exceptions.ConflictException:
+        # The data source runs one job at a time. The chunks are written; the
+        # CheckIngestionJobs barrier starts the job that picks them up (see kb_cleanup).
+        request_kb_sync(file_metadata_table, changes, "ingest batch")
+        processing_status_obj["ingestion_job_details"] = {"status": SYNC_PENDING}
+        print(f"An ingestion job is already running; {changes} change(s) wait for the next sync.")
+        return True
     except Exception as e:
         print(f"Error starting ingestion job: {e}")
         processing_status_obj["error"] = str(e)
@@ -345,26 +324,90 @@ def save_chunks_for_kb_and_ingest(chunks, s3_object_key, processing_status_obj):
 
 
 # -----------------------------------------------------------------------------
-# 4. Lambda entry point
+# 3c. Remove the KB chunks of a source file that no longer exists
 # -----------------------------------------------------------------------------
-def lambda_handler(event, context):
-    original_key = event['s3Key']
-    user_id      = event['userId']
-    folder_id    = event['folderId']
-    session_id   = event.get('sessionId', 'unknown_session')
-    file_name    = event.get('fileName', os.path.basename(original_key))
-
-    print(f"Triggered for file: {original_key} (user={user_id}, folder={folder_id})")
-
-    status_rec = {
-        "sessionId#fileName": f"{session_id}#{file_name}",
-        "parsed_user_id":     user_id,
-        "parsed_folder_id":   folder_id,
-        "source_s3_key":      original_key
+def remove_chunks_for_source(s3_object_key, processing_status_obj):
+    if not all([DESTINATION_S3_BUCKET, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID]):
+        err = "Missing DESTINATION_S3_BUCKET, KNOWLEDGE_BASE_ID, or DATA_SOURCE_ID"
+        print(f"CRITICAL: {err}")
+        processing_status_obj["error"] = err
+        return False
+
+    prefix = f"{os.path.join(DESTINATION_S3_PREFIX, s3_object_key)}/"
+    print(f"Removing chunks under s3://{DESTINATION_S3_BUCKET}/{prefix}")
+
+    deleted = 0
+    paginator = s3_client.get_paginator('list_objects_v2')
+    try:
+        for page in paginator.paginate(Bucket=DESTINATION_S3_BUCKET, Prefix=prefix):
+            objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if not objects:
+                continue
+            # list_objects_v2 pages hold at most 1000 keys, the delete_objects limit
+            s3_client.delete_objects(Bucket=DESTINATION_S3_BUCKET, Delete={"Objects": objects, "Quiet": True})
+            deleted += len(objects)
+    except Exception as e:
+        print(f"Error removing chunks for {s3_object_key}: {e}")
+        processing_status_obj["error"] = str(e)
+        return False
+
+    print(f"Removed {deleted} chunk objects for {s3_object_key}.")
+    processing_status_obj["chunks_removed"] = deleted
+    return True
+
+
+# -----------------------------------------------------------------------------
+# 3d. Detach a removed file from the pipelined-mode study registry
+# -----------------------------------------------------------------------------
+def detach_file_from_studies(user_id, folder_id, file_name):
+    """Bumps the version of every registered study that cited the file, so its summary is rebuilt without it."""
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key('sessionId#fileName').begins_with(f"{STUDY_ITEM_MARKER}#{folder_id}#"),
+        'FilterExpression': Attr('sourceFiles').contains(file_name)
+    }
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        for study in response.get('Items', []):
+            file_metadata_table.update_item(
+                Key={'userId': user_id, 'sessionId#fileName': study['sessionId#fileName']},
+                UpdateExpression="DELETE sourceFiles :file ADD version :one",
+                ExpressionAttributeValues={':file': {file_name}, ':one': 1}
+            )
+            print(f"Detached {file_name} from study '{study.get('studyName')}'.")
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# -----------------------------------------------------------------------------
+# 4. Per-item processing (runs concurrently inside a batch)
+# -----------------------------------------------------------------------------
+def process_batch_item(item):
+    original_key = item['s3Key']
+    user_id      = item['userId']
+    folder_id    = item['folderId']
+    action       = item.get('action', 'ingest')
+
+    print(f"Processing {action} for file: {original_key} (user={user_id}, folder={folder_id})")
+
+    result = {
+        "item":               item,
+        "action":             action,
+        "kbChanged":          False,
+        "chunksCount":        0,
+        "pagesCount":         0,
+        "error":              None
     }
 
     try:
-        if not original_key.lower().endswith(('.pdf','.png','.jpg','.jpeg','.txt','.md','.html','.doc','.docx','.csv','.xls','.xlsx')):
+        if action == 'delete':
+            if not remove_chunks_for_source(original_key, result):
+                raise RuntimeError(f"Chunk removal error: {result.get('error')}")
+            result["kbChanged"] = result.get("chunks_removed", 0) > 0
+            detach_file_from_studies(user_id, folder_id, os.path.basename(original_key))
+            return result
+
+        if not original_key.lower().endswith(SUPPORTED_EXTENSIONS):
             raise ValueError(f"Unsupported file type: {original_key}")
 
         chunks, ext_status = extract_text_chunks_from_document(
@@ -373,38 +416,122 @@ def lambda_handler(event, context):
         if ext_status.get("error") or not chunks:
             raise RuntimeError(f"Extraction error: {ext_status.get('status')}")
 
-        save_ok = save_chunks_for_kb_and_ingest(chunks, original_key, status_rec)
-        if not save_ok:
-            raise RuntimeError(f"Save/ingest error: {status_rec.get('error')}")
-
-        job_details = status_rec.get("ingestion_job_details", {})
-        file_metadata_table.put_item(Item={
-            'sessionId#fileName': status_rec["sessionId#fileName"],
-            'ingestionJobId':     job_details.get("ingestionJobId"),
-            'userId':             user_id,
-            'folderId':           folder_id,
-            'sourceS3Key':        original_key,
-            'chunksCount':        len(chunks),
-            'startedAtUtc':       datetime.now(timezone.utc).isoformat(),
-            'status':             job_details.get("status", "STARTED")
-        })
-
-        return {
-            'statusCode': 200,
-            'body': json.dumps(f"Ingestion started for {original_key}")
-        }
+        if not save_chunks_for_kb(chunks, original_key, result):
+            raise RuntimeError(f"Save error: {result.get('error')}")
 
+        result["chunksCount"] = len(chunks)
+        result["pagesCount"] = ext_status["pages_processed"]
+        result["kbChanged"] = True
     except Exception as e:
-        print(f"Lambda handler failed for {original_key}: {e}")
+        print(f"Processing failed for {original_key}: {e}")
         traceback.print_exc()
-        file_metadata_table.put_item(Item={
-            'sessionId#fileName': status_rec["sessionId#fileName"],
-            'userId':             user_id,
-            'folderId':           folder_id,
-            'sourceS3Key':        original_key,
-            'status':             'FAILED',
-            'error':              str(e),
-            'startedAtUtc':       datetime.now(timezone.utc).isoformat()
-        })
-        # re-raise to mark the Lambda as failed
-        raise
\ No newline at end of file
+        result["error"] = str(e)
+    return result
+
+
+# -----------------------------------------------------------------------------
+# 5. Record per-item outcomes in the metadata table
+# -----------------------------------------------------------------------------
+def write_batch_records(results, job_details):
+    """
+    Records each item's outcome on its file's row (see file_status): ingesting
+    with the job and source version for written chunks, ingest_failed with
+    the error, and removal of the row for a file that is gone. The writes go
+    through a StatusWriter, which also moves the folder counters.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    with StatusWriter(file_metadata_table) as writer:
+        for result in results:
+            item = result["item"]
+            relative_name = item.get('fileName', os.path.basename(item['s3Key']))
+            key = file_key(item['userId'], item['folderId'], relative_name)
+            if result["error"] is None and result["action"] == 'delete':
+                writer.emit_delete(key)
+                continue
+
+            session_id, user_folder, file_name = file_parts(item['folderId'], relative_name)
+            attributes = {
+                'folderId':     item['folderId'],
+                'folderKey':    f"{item['userId']}#{item['folderId']}",
+                'sessionId':    session_id,
+                'userFolder':   user_folder,
+                'fileName':     file_name,
+                'fileType':     'main',
+                'originalS3Key': item['s3Key'],
+                's3Bucket':     S3_BUCKET_NAME,
+                'sourceS3Key':  item['s3Key'],
+                'startedAtUtc': now,
+                'lastStatusUpdateTimestamp': now
+            }
+            if item.get('size') is not None:
+                attributes['fileSize'] = int(item['size'])
+            if result["error"] is None:
+                # Without a job ID the barrier attaches the sync job that covers the chunks
+                job_id = job_details.get("ingestionJobId")
+                writer.emit(key, INGESTING, create=True, attributes={
+                    **attributes,
+                    **({'ingestionJobId': job_id} if job_id else {}),
+                    'ingestionJobStatus': job_details.get("status", "STARTED"),
+                    'chunksCount':        result["chunksCount"],
+                    'pagesCount':         result["pagesCount"],
+                    'sourceETag':         item.get('eTag'),
+                    'sourceSize':         item.get('size'),
+                    'sourceLastModified': item.get('lastModified')
+                }, remove=('processingError',) + (() if job_id else ('ingestionJobId',)))
+            else:
+                # Whatever chunks the attempt left behind are replaced by the next one
+                writer.emit(key, INGEST_FAILED, create=True, attributes={
+                    **attributes, 'processingError': result["error"]
+                }, remove=('sourceETag', 'ingestionJobId', 'ingestionJobStatus'))
+
+
+# -----------------------------------------------------------------------------
+# 6. Lambda entry point
+# -----------------------------------------------------------------------------
+def lambda_handler(event, context):
+    """
+    Accepts either a single item ({"s3Key", "userId", "folderId", ...}) or a
+    Distributed Map ItemBatcher batch ({"Items": [...], "BatchInput": {...}}).
+    Items are processed concurrently, one ingestion job is started for the whole
+    batch, and the per-item outcome is reported so one bad file does not fail
+    the others.
+    """
+    batch_input = event.get('BatchInput') or {}
+    items = [{**batch_input, **item} for item in event['Items']] if 'Items' in event else [event]
+    print(f"Received batch of {len(items)} item(s).")
+
+    workers = max(1, min(INGEST_BATCH_CONCURRENCY, len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(process_batch_item, items))
+
+    # A single ingestion job picks up every chunk written or removed by this batch
+    job_status = {}
+    changes = sum(1 for r in results if r["error"] is None and r["kbChanged"])
+    if changes:
+        if not start_kb_ingestion_job(job_status, changes):
+            for r in results:
+                if r["error"] is None and r["kbChanged"]:
+                    r["error"] = f"Ingest error: {job_status.get('error')}"
+    job_details = job_status.get("ingestion_job_details", {})
+
+    write_batch_records(results, job_details)
+
+    item_results = [{
+        "s3Key":    r["item"]["s3Key"],
+        "fileName": r["item"].get("fileName", os.path.basename(r["item"]["s3Key"])),
+        "action":   r["action"],
+        "status":   "FAILED" if r["error"] else "SUCCEEDED",
+        "error":    r["error"]
+    } for r in results]
+    failed = sum(1 for r in item_results if r["status"] == "FAILED")
+    print(f"Batch finished: {len(items) - failed} succeeded, {failed} failed, ingestion job {job_details.get('ingestionJobId')}.")
+
+    # Failed items are recorded as ingest_failed and reported, even when none succeeded:
+    # retrying the batch would re-run Textract on files that fail the same way
+    return {
+        "ingestionJobId": job_details.get("ingestionJobId"),
+        "syncPending":    job_details.get("status") == SYNC_PENDING,
+        "succeeded":      len(items) - failed,
+        "failed":         failed,
+        "results":        item_results
+    }
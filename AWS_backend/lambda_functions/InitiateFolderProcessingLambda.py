@@ -3,13 +3,123 @@ import boto3
 import os
 import re
 from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key, Attr
+from admission import admit_runs, enqueue_run  # docrag_shared layer
+from file_status import DELETED, INGEST_FAILED  # docrag_shared layer
 
 s3_client = boto3.client('s3')
 stepfunctions_client = boto3.client('stepfunctions')
+dynamodb_resource = boto3.resource('dynamodb')
 
 S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
 STATE_MACHINE_ARN = os.environ['STATE_MACHINE_ARN']
 UPLOAD_PREFIX = os.environ.get('S3_UPLOAD_PREFIX', '')  # Allow empty prefix
+DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+MANIFEST_PREFIX = os.environ.get('S3_MANIFEST_PREFIX', 'processing-manifests').strip('/')
+PIPELINED_SUMMARIZATION = os.environ.get('PIPELINED_SUMMARIZATION', 'false').lower() == 'true'
+MANIFEST_PART_SIZE_BYTES = int(os.environ.get('MANIFEST_PART_SIZE_BYTES', 8 * 1024 * 1024))  # S3 minimum part size is 5 MiB
+FOLDER_INDEX_NAME = os.environ.get('FOLDER_INDEX_NAME', '')  # sparse GSI on folderKey = "<userId>#<folderId>"
+MANIFEST_SORT_WINDOW = int(os.environ.get('MANIFEST_SORT_WINDOW', 1000))  # records held at once for the size sort
+# Admission caps (see admission in the docrag_shared layer); AdmitFolderRuns uses the same values
+TENANT_MAX_RUNNING_FOLDERS = int(os.environ.get('TENANT_MAX_RUNNING_FOLDERS', 2))
+MAX_RUNNING_FOLDERS = int(os.environ.get('MAX_RUNNING_FOLDERS', 10))  # 0: no global cap
+ADMISSION_MAX_WAIT_SECONDS = int(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', 900))
+file_metadata_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+
+
+class JsonlManifestWriter:
+    """
+    Streams one JSON object per line into an S3 object. Lines are buffered until
+    MANIFEST_PART_SIZE_BYTES and then uploaded as a multipart part, so memory stays
+    bounded no matter how many files the folder holds. Small manifests are written
+    with a single put_object.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.count = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, record):
+        self._buffer += json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.count += 1
+        if len(self._buffer) >= MANIFEST_PART_SIZE_BYTES:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType='application/jsonl'
+            )['UploadId']
+        part_number = len(self._parts) + 1
+        resp = s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer)
+        )
+        self._parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+        self._buffer.clear()
+
+    def close(self):
+        if self._upload_id is None:
+            s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), ContentType='application/jsonl'
+            )
+        else:
+            if self._buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+        self._buffer.clear()
+
+    def abort(self):
+        if self._upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer.clear()
+
+
+def load_ingestion_records(user_id, folder_id, full_s3_prefix):
+    """
+    Returns {sourceS3Key: file row} for every file of this folder that
+    IngestFileToBedrockKBLambda has recorded an ingestion on (see file_status).
+    """
+    records = {}
+    query_kwargs = {
+        # The folder's file rows are "<session>#<userFolder>#<path>"
+        'KeyConditionExpression': Key('userId').eq(user_id) & Key('sessionId#fileName').begins_with(f"{folder_id.replace('/', '#', 1)}#"),
+        'FilterExpression': Attr('sourceS3Key').exists()
+    }
+    if FOLDER_INDEX_NAME:
+        query_kwargs.update({
+            'IndexName': FOLDER_INDEX_NAME,
+            'KeyConditionExpression': Key('folderKey').eq(f"{user_id}#{folder_id}")
+        })
+    while True:
+        response = file_metadata_table.query(**query_kwargs)
+        for item in response.get('Items', []):
+            source_key = item.get('sourceS3Key')
+            if source_key and source_key.startswith(full_s3_prefix):
+                records[source_key] = item
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return records
+
+
+def is_unchanged_since_ingestion(s3_object, record):
+    """True when the object still matches the ETag/size/LastModified recorded at its last successful ingestion."""
+    if not record or record.get('status') in (INGEST_FAILED, DELETED) or record.get('ingestionJobStatus') in ('FAILED', 'STOPPED'):
+        return False
+    return (
+        record.get('sourceETag') == s3_object['ETag'].strip('"')
+        and int(record.get('sourceSize', -1)) == s3_object['Size']
+        and record.get('sourceLastModified') == s3_object['LastModified'].isoformat()
+    )
 
 def lambda_handler(event, context):
     try:
@@ -24,6 +134,8 @@ def lambda_handler(event, context):
         body_str = event.get('body', '{}')
         body = json.loads(body_str) if body_str else {}
         folder_id = body.get('folderId')
+        force_reprocess = bool(body.get('forceReprocess', False))
+        pipelined = bool(body.get('pipelined', PIPELINED_SUMMARIZATION))
         
         if not folder_id:
             return error_response(400, "folderId must be provided.")
@@ -34,65 +146,148 @@ def lambda_handler(event, context):
         
         print(f"Listing objects in S3 prefix: {full_s3_prefix}")
 
-        # Gather all relevant files under this prefix
-        s3_items_for_step_function = []
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=full_s3_prefix):
-            for obj in page.get('Contents', []):
-                s3_key = obj['Key']
-                
-                # Skip empty folders and directory markers
-                if s3_key.endswith('/'):
-                    continue
-                
-                # Extract the relative file name (everything after the prefix)
-                file_name = s3_key[len(full_s3_prefix):]
-                
-                # Skip any empty file names
-                if not file_name.strip():
-                    print(f"Skipping empty file name for '{s3_key}'")
-                    continue
-
-                # Extract the session ID from the folder structure
-                folder_parts = folder_id.split('/')
-                session_id = folder_parts[0] if len(folder_parts) > 1 else "unknown_session"
-
-                s3_items_for_step_function.append({
-                    "s3Key": s3_key,
-                    "userId": user_id,
-                    "folderId": folder_id,
-                    "sessionId": session_id,
-                    "fileName": file_name
-                })
-
-        # Handle empty folder case
-        if not s3_items_for_step_function:
-            print(f"No eligible files found to process in folder '{folder_id}' for user '{user_id}'.")
-            return success_response(200, f"No files found to process in folder '{folder_id}'.")
-
-        # Prepare Step Functions input
+        # Extract the session ID from the folder structure
+        folder_parts = folder_id.split('/')
+        session_id = folder_parts[0] if len(folder_parts) > 1 else "unknown_session"
+
+        # Previous ingestion records for this folder, keyed by source S3 key
+        ingestion_records = load_ingestion_records(user_id, folder_id, full_s3_prefix)
+        print(f"Loaded {len(ingestion_records)} existing ingestion records (forceReprocess={force_reprocess}).")
+
+        # Stream all new or changed files under this prefix into an S3 manifest
+        timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        manifest_base = f"{MANIFEST_PREFIX}/{user_folder_prefix}{timestamp}"
+        ingest_manifest = JsonlManifestWriter(S3_BUCKET_NAME, f"{manifest_base}/ingest.jsonl")
+        delete_manifest = JsonlManifestWriter(S3_BUCKET_NAME, f"{manifest_base}/delete.jsonl")
+        seen_s3_keys = set()
+        unchanged_file_count = 0
+        ingest_bytes = 0
+        # Shortest job first: the ingest Map works through the manifest in order, so small
+        # files are ingested before one large PDF can hold them up. Records are sorted in
+        # windows of MANIFEST_SORT_WINDOW so memory stays bounded however large the folder.
+        sort_window = []
+
+        def write_sort_window():
+            sort_window.sort(key=lambda record: record["size"])
+            for record in sort_window:
+                ingest_manifest.write(record)
+            sort_window.clear()
+
+        try:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=full_s3_prefix):
+                for obj in page.get('Contents', []):
+                    s3_key = obj['Key']
+
+                    # Skip empty folders and directory markers
+                    if s3_key.endswith('/'):
+                        continue
+
+                    # Extract the relative file name (everything after the prefix)
+                    file_name = s3_key[len(full_s3_prefix):]
+
+                    # Skip any empty file names
+                    if not file_name.strip():
+                        print(f"Skipping empty file name for '{s3_key}'")
+                        continue
+
+                    seen_s3_keys.add(s3_key)
+                    if not force_reprocess and is_unchanged_since_ingestion(obj, ingestion_records.get(s3_key)):
+                        unchanged_file_count += 1
+                        continue
+
+                    ingest_bytes += obj['Size']
+                    sort_window.append({
+                        "s3Key": s3_key,
+                        "userId": user_id,
+                        "folderId": folder_id,
+                        "sessionId": session_id,
+                        "fileName": file_name,
+                        "eTag": obj['ETag'].strip('"'),
+                        "size": obj['Size'],
+                        "lastModified": obj['LastModified'].isoformat()
+                    })
+                    if len(sort_window) >= MANIFEST_SORT_WINDOW:
+                        write_sort_window()
+            write_sort_window()
+
+            # Files that were ingested on a previous run but no longer exist in S3,
+            # including the tombstones DeleteS3FileMetadata leaves for them
+            for source_key in sorted(ingestion_records):
+                if source_key not in seen_s3_keys:
+                    delete_manifest.write({
+                        "s3Key": source_key,
+                        "userId": user_id,
+                        "folderId": folder_id,
+                        "sessionId": session_id,
+                        "fileName": source_key[len(full_s3_prefix):],
+                        "action": "delete"
+                    })
+
+            # Handle empty folder case
+            if not seen_s3_keys and not delete_manifest.count:
+                ingest_manifest.abort()
+                delete_manifest.abort()
+                print(f"No eligible files found to process in folder '{folder_id}' for user '{user_id}'.")
+                return success_response(200, f"No files found to process in folder '{folder_id}'.")
+
+            ingest_manifest.close()
+            delete_manifest.close()
+        except Exception:
+            ingest_manifest.abort()
+            delete_manifest.abort()
+            raise
+
+        print(f"Folder '{folder_id}': {ingest_manifest.count} new/changed, "
+              f"{unchanged_file_count} unchanged, {delete_manifest.count} removed since last run.")
+
+        # Prepare Step Functions input; the file lists stay in S3 and are read by the Map ItemReaders
         sfn_input = {
             "userId": user_id,
             "folderId": folder_id,
-            "s3ItemsToProcess": s3_items_for_step_function
+            "manifest": {
+                "bucket": S3_BUCKET_NAME,
+                "ingestKey": ingest_manifest.key,
+                "deleteKey": delete_manifest.key
+            },
+            "filesToIngestCount": ingest_manifest.count,
+            "filesToDeleteCount": delete_manifest.count,
+            "unchangedFileCount": unchanged_file_count,
+            "totalFileCount": len(seen_s3_keys),
+            "pipelined": pipelined
         }
 
         # Generate a safe, unique execution name
-        timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
         safe_user_id = re.sub(r'[^a-zA-Z0-9-]', '', user_id.replace('_', '-'))
         safe_folder_id = re.sub(r'[^a-zA-Z0-9-]', '', folder_id.replace('/', '-').replace('_', '-'))
         execution_name = f"folderproc-{safe_user_id}-{safe_folder_id}-{timestamp}"[:80]
 
-        print(f"Starting Step Function execution: {execution_name} with {len(s3_items_for_step_function)} items.")
-        sfn_response = stepfunctions_client.start_execution(
-            stateMachineArn=STATE_MACHINE_ARN,
-            input=json.dumps(sfn_input),
-            name=execution_name
-        )
+        # Queue the run and start whatever the admission caps allow, this run or others
+        print(f"Queuing Step Function execution: {execution_name} with manifest s3://{S3_BUCKET_NAME}/{manifest_base}/")
+        enqueue_run(file_metadata_table, user_id, folder_id, execution_name, sfn_input,
+                    ingest_bytes, ingest_manifest.count)
+        try:
+            admitted = admit_runs(file_metadata_table, stepfunctions_client, STATE_MACHINE_ARN,
+                                  TENANT_MAX_RUNNING_FOLDERS, MAX_RUNNING_FOLDERS, ADMISSION_MAX_WAIT_SECONDS * 1000)
+        except Exception as e:
+            # The run is queued; AdmitFolderRuns starts it on the next status change or reconcile
+            print(f"ERROR: Admission failed after queuing {execution_name}: {e}")
+            admitted = []
+        started = next((run for run in admitted if run["executionName"] == execution_name), None)
 
         # Return success response
-        return success_response(202, f"Folder processing initiated for {len(s3_items_for_step_function)} files.", {
-            "executionArn": sfn_response["executionArn"]
+        counts = {
+            "filesToIngest": ingest_manifest.count,
+            "filesToDelete": delete_manifest.count,
+            "unchangedFileCount": unchanged_file_count
+        }
+        if started:
+            return success_response(202, f"Folder processing initiated for {ingest_manifest.count} files.", {
+                "executionArn": started["executionArn"], **counts
+            })
+        return success_response(202, f"Folder processing queued for {ingest_manifest.count} files; "
+                                     f"it starts when earlier runs finish.", {
+            "queued": True, "executionName": execution_name, **counts
         })
 
     except json.JSONDecodeError as e:
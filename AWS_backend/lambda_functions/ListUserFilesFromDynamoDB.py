@@ -1,8 +1,17 @@
+import base64
+import gzip
+import hashlib
 import json
 import boto3
 import os
+import time
+from collections import OrderedDict
 from boto3.dynamodb.conditions import Key, Attr
 from decimal import Decimal
+from change_version import CHANGE_VERSION_SORT_KEY, read_change_version, read_user_usage  # docrag_shared layer
+from folder_counters import COUNTERS, counter_values  # docrag_shared layer
+from file_status import DELETED  # docrag_shared layer
+from summary_pointers import SUMMARY_ITEM_MARKER, SUMMARY_VERSION_MARKER  # docrag_shared layer
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -17,9 +26,282 @@ table = dynamodb.Table(TABLE_NAME)
 
 FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
 FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+STUDY_ITEM_MARKER = "__STUDY__"
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('LIST_FILES_DEFAULT_PAGE_SIZE', 200))
+MAX_PAGE_SIZE = int(os.environ.get('LIST_FILES_MAX_PAGE_SIZE', 1000))
+FOLDER_INDEX_NAME = os.environ.get('FOLDER_INDEX_NAME', '')  # sparse GSI on folderKey = "<userId>#<folderId>"
+LIST_CACHE_TTL_SECONDS = int(os.environ.get('LIST_CACHE_TTL_SECONDS', 30))
+LIST_CACHE_MAX_ENTRIES = int(os.environ.get('LIST_CACHE_MAX_ENTRIES', 256))
+GZIP_MIN_BYTES = int(os.environ.get('LIST_GZIP_MIN_BYTES', 1024))
+CURSOR_VERSION = 1
+
+FILE_ATTRIBUTES = [
+    "userId", "originalS3Key", "s3Bucket", "sessionId", "userFolder", "fileName", "fileSize",
+    "uploadTimestamp", "status", "lastStatusUpdateTimestamp", "processingError",
+    "ingestionJobStatus", "chunksCount", "pagesCount"
+]
+FOLDER_ATTRIBUTES = [
+    "folderOverallStatus", "folderSummaryS3Key", "folderSectionIndexS3Key", "lastFolderUpdateTimestamp",
+    "folderProcessingErrorDetails", "studiesCompleted", "studiesTotal", "progressiveSummaries",
+    "progressiveStartedAtUtc", "hedgesIssued", "hedgesWon", "failedStudies", *COUNTERS
+]
+SORT_KEY = "sessionId#fileName"
+
+# Listing bodies served by this container, keyed by (userId, ETag). The ETag
+# carries the user's change version, so an entry never outlives the data it
+# was built from; the TTL only bounds how long a cold entry holds memory.
+_listing_cache = OrderedDict()
+
+
+class BadRequest(Exception):
+    pass
+
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(body, cls=DecimalEncoder, separators=(',', ':'))
+    }
+
+
+def listing_etag(version, filters, page_size, cursor):
+    """Weak ETag of one listing: the user's change version plus the query that shaped the body."""
+    shape = json.dumps({"f": filters, "l": page_size, "c": cursor}, sort_keys=True)
+    return f'W/"{version}-{hashlib.sha256(shape.encode("utf-8")).hexdigest()[:16]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match uses weak comparison: W/"x" and "x" name the same version."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or etag[2:] in tags
+
+
+def cached_listing(cache_key):
+    entry = _listing_cache.get(cache_key)
+    if entry is None:
+        return None
+    if entry["expiresAt"] < time.monotonic():
+        del _listing_cache[cache_key]
+        return None
+    _listing_cache.move_to_end(cache_key)
+    return entry
+
+
+def cache_listing(cache_key, body_text):
+    entry = {"expiresAt": time.monotonic() + LIST_CACHE_TTL_SECONDS, "body": body_text, "gzipBody": None}
+    _listing_cache[cache_key] = entry
+    _listing_cache.move_to_end(cache_key)
+    while len(_listing_cache) > LIST_CACHE_MAX_ENTRIES:
+        _listing_cache.popitem(last=False)
+    return entry
+
+
+def listing_response(etag, entry=None, accept_encoding=""):
+    """
+    200 with the listing, gzipped when the client accepts it and the body is
+    at least GZIP_MIN_BYTES (the compressed body is kept on the cache entry),
+    or 304 without a body when entry is None.
+    """
+    headers = {
+        'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*',
+        'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Accept-Encoding'
+    }
+    if entry is None:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    if len(entry["body"]) >= GZIP_MIN_BYTES and 'gzip' in accept_encoding.lower():
+        if entry["gzipBody"] is None:
+            entry["gzipBody"] = base64.b64encode(gzip.compress(entry["body"].encode('utf-8'), compresslevel=6)).decode('ascii')
+        headers['Content-Encoding'] = 'gzip'
+        return {'statusCode': 200, 'headers': headers, 'isBase64Encoded': True, 'body': entry["gzipBody"]}
+    return {'statusCode': 200, 'headers': headers, 'body': entry["body"]}
+
+
+def projection():
+    """ProjectionExpression over the attributes the listing returns (every name aliased: some are reserved words)."""
+    names = {f"#a{i}": attr for i, attr in enumerate([SORT_KEY] + FILE_ATTRIBUTES + FOLDER_ATTRIBUTES)}
+    return {'ProjectionExpression': ", ".join(names), 'ExpressionAttributeNames': names}
+
+
+def folder_item_key(folder_id):
+    return f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"
+
+
+def key_segments(user_id, session_id=None, folder_id=None, folders_only=False):
+    """
+    The key ranges a listing reads, in order, as query arguments. Each is a
+    key condition, so filtering by folder or session never reads other
+    sessions' items. Folder items share the __FOLDER_INFO__# prefix, so
+    folder statuses alone are one bounded range; a folder's file rows come
+    from FolderIndex when it is enabled.
+    """
+    partition = Key('userId').eq(user_id)
+    if folder_id:
+        segments = [{'KeyConditionExpression': partition & Key(SORT_KEY).eq(folder_item_key(folder_id))}]
+        if folders_only:
+            return segments
+        if FOLDER_INDEX_NAME:
+            return segments + [{
+                'IndexName': FOLDER_INDEX_NAME,
+                'KeyConditionExpression': Key('folderKey').eq(f"{user_id}#{folder_id}"),
+                # Ingestion records not yet migrated onto the file rows share the key (scripts/migrate_ingestion_records.py)
+                'FilterExpression': Attr('userFolder').exists()
+            }]
+        session_part, _, user_folder = folder_id.partition('/')
+        prefix = f"{session_part}#{user_folder}#" if user_folder else f"{session_part}#"
+        return segments + [{'KeyConditionExpression': partition & Key(SORT_KEY).begins_with(prefix)}]
+    if session_id:
+        segments = [{'KeyConditionExpression': partition & Key(SORT_KEY).begins_with(f"{FOLDER_ITEM_SESSION_MARKER}#{session_id}/")}]
+        if folders_only:
+            return segments
+        return segments + [{'KeyConditionExpression': partition & Key(SORT_KEY).begins_with(f"{session_id}#")}]
+    if folders_only:
+        return [{'KeyConditionExpression': partition & Key(SORT_KEY).begins_with(f"{FOLDER_ITEM_SESSION_MARKER}#")}]
+    return [{'KeyConditionExpression': partition}]
+
+
+def encode_cursor(user_id, filters, segment, last_key):
+    payload = {"v": CURSOR_VERSION, "u": user_id, "f": filters, "s": segment, "k": last_key}
+    return base64.urlsafe_b64encode(json.dumps(payload, cls=DecimalEncoder, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, user_id, filters):
+    """Returns (segment, ExclusiveStartKey or None). Cursors are only valid for the caller and the same filters."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise BadRequest("Malformed cursor.")
+    if payload.get("v") != CURSOR_VERSION or payload.get("u") != user_id or payload.get("f") != filters:
+        raise BadRequest("Cursor does not belong to this listing.")
+    last_key = payload.get("k")
+    if last_key is not None and (
+        last_key.get("userId") != user_id or not last_key.get("folderKey", f"{user_id}#").startswith(f"{user_id}#")
+    ):
+        raise BadRequest("Cursor does not belong to this listing.")
+    return int(payload.get("s", 0)), last_key
+
+
+def folder_metadata_entry(item):
+    folder_name = item['sessionId#fileName'].split('#')[1]
+    return {
+        "folderName": folder_name,
+        "overallStatus": item.get("folderOverallStatus"),
+        "summaryS3Key": item.get("folderSummaryS3Key"),
+        "sectionIndexS3Key": item.get("folderSectionIndexS3Key"),
+        "lastUpdatedAt": item.get("lastFolderUpdateTimestamp"),
+        "errorDetails": item.get("folderProcessingErrorDetails"),
+        # Progressive aggregate of the latest run, filled as each study completes
+        "studiesCompleted": item.get("studiesCompleted"),
+        "studiesTotal": item.get("studiesTotal"),
+        "progressiveSummaryKeys": sorted(
+            (item.get("progressiveSummaries") or {}).values(),
+            key=lambda p: p.get("completedAtUtc", "")
+        ),
+        "progressiveStartedAt": item.get("progressiveStartedAtUtc"),
+        "hedgesIssued": item.get("hedgesIssued"),
+        "hedgesWon": item.get("hedgesWon"),
+        "studiesFailed": len(item.get("failedStudies") or ()),
+        # Running totals kept by the writers (see folder_counters)
+        "counters": {name: int(item.get(name) or 0) for name in COUNTERS}
+    }
+
+
+def collect(items, files_output, folder_metadata_map):
+    """Sorts items into file entries and folder metadata entries, skipping internal bookkeeping."""
+    for item in items:
+        sort_key_value = item.get('sessionId#fileName', '')
+
+        if sort_key_value.startswith(FOLDER_ITEM_SESSION_MARKER) and \
+           sort_key_value.endswith(FOLDER_ITEM_FILENAME_MARKER):
+            if len(sort_key_value.split('#')) == 3:
+                entry = folder_metadata_entry(item)
+                folder_metadata_map[entry["folderName"]] = entry
+        elif sort_key_value.startswith((STUDY_ITEM_MARKER + "#", SUMMARY_ITEM_MARKER + "#", SUMMARY_VERSION_MARKER + "#")) \
+                or sort_key_value == CHANGE_VERSION_SORT_KEY:
+            # Pipelined-mode study registry entries, summary pointers and the change version are internal bookkeeping
+            continue
+        elif item.get('status') == DELETED:
+            # Tombstone of a removed file, kept until its folder's next run (see file_status)
+            continue
+        else:
+            # Individual file item
+            file_item = {attr: item.get(attr) for attr in FILE_ATTRIBUTES}
+            files_output.append({k: v for k, v in file_item.items() if v is not None})
+
+
+def list_all(user_id, segments):
+    """Unpaginated listing: every item of every segment (the original response, for small accounts)."""
+    files_output, folder_metadata_map = [], {}
+    for segment in segments:
+        query_kwargs = {**segment, **projection()}
+        while True:
+            response = table.query(**query_kwargs)
+            collect(response.get('Items', []), files_output, folder_metadata_map)
+            if 'LastEvaluatedKey' not in response:
+                break
+            print(f"Paginating for more items for userId = {user_id}")
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return {"files": files_output, "folderMetadata": list(folder_metadata_map.values())}
+
+
+def list_page(user_id, segments, filters, page_size, cursor=None):
+    """
+    One page of at most page_size items read, resuming from cursor. Items
+    skipped as bookkeeping still count, so a page can hold fewer entries;
+    nextCursor is null once every segment has been read.
+    """
+    segment, last_key = decode_cursor(cursor, user_id, filters) if cursor else (0, None)
+    files_output, folder_metadata_map = [], {}
+    read = 0
+    while segment < len(segments) and read < page_size:
+        query_kwargs = {**segments[segment], 'Limit': page_size - read, **projection()}
+        if last_key:
+            query_kwargs['ExclusiveStartKey'] = last_key
+        response = table.query(**query_kwargs)
+        items = response.get('Items', [])
+        read += len(items)
+        collect(items, files_output, folder_metadata_map)
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            segment += 1
+
+    next_cursor = encode_cursor(user_id, filters, segment, last_key) if segment < len(segments) else None
+    return {
+        "files": files_output,
+        "folderMetadata": list(folder_metadata_map.values()),
+        "pageSize": page_size,
+        "nextCursor": next_cursor
+    }
+
+
+def usage_body(user_id, folder_id=None, item=None):
+    """view=usage: the user's totals (item, already read with the version) or one folder's entry, one GetItem each."""
+    if not folder_id:
+        return {"usage": counter_values(item or {})}
+    response = table.get_item(Key={'userId': user_id, SORT_KEY: folder_item_key(folder_id)}, **projection())
+    return {"folder": folder_metadata_entry(response['Item']) if 'Item' in response else None}
+
 
 def lambda_handler(event, context):
-    print("Received API Gateway event for ListUserFiles:", json.dumps(event, indent=2))
+    """
+    GET /files[?limit=<n>][&cursor=<nextCursor>][&folderName=<sessionId/folder>][&sessionId=<sessionId>][&view=folders|usage]
+
+    Without limit or cursor the whole listing is returned in one response
+    ({"files", "folderMetadata"}). With either, one page is returned together
+    with "nextCursor" (null on the last page), which is passed back as cursor
+    to get the next one. folderName and sessionId narrow the listing through
+    the sort key; view=folders returns folder metadata only. view=usage
+    returns the user's usage totals, or with folderName that folder's entry
+    and counters, from a single item.
+
+    Every listing carries an ETag built from the user's change version; a
+    request whose If-None-Match still matches gets 304 after one GetItem.
+    Bodies of GZIP_MIN_BYTES or more are gzipped for clients that accept it.
+    """
+    print("Received API Gateway event for ListUserFiles:", json.dumps(event))
 
     try:
         claims = event.get('requestContext', {}).get('authorizer', {}).get('jwt', {}).get('claims', {})
@@ -31,84 +313,60 @@ def lambda_handler(event, context):
 
         if not user_id:
             print("Error: User identifier not found in JWT claims.")
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Unauthorized: User identifier not found.'})
-            }
-        
-        print(f"Querying files and folder summaries for userId = {user_id}")
-
-        response = table.query(KeyConditionExpression=Key('userId').eq(user_id))
-        items = response.get('Items', [])
-        
-        while 'LastEvaluatedKey' in response:
-            print(f"Paginating for more items for userId = {user_id}")
-            response = table.query(
-                KeyConditionExpression=Key('userId').eq(user_id),
-                ExclusiveStartKey=response['LastEvaluatedKey']
-            )
-            items.extend(response.get('Items', []))
-        
-        files_output = []
-        folder_metadata_map = {} 
-
-        for item in items:
-            sort_key_value = item.get('sessionId#fileName', '')
-            
-            if sort_key_value.startswith(FOLDER_ITEM_SESSION_MARKER) and \
-               sort_key_value.endswith(FOLDER_ITEM_FILENAME_MARKER):
-                parts = sort_key_value.split('#')
-                if len(parts) == 3:
-                    folder_name = parts[1]
-                    folder_metadata_map[folder_name] = {
-                        "folderName": folder_name,
-                        "overallStatus": item.get("folderOverallStatus"),
-                        "summaryS3Key": item.get("folderSummaryS3Key"),
-                        "lastUpdatedAt": item.get("lastFolderUpdateTimestamp"),
-                        "errorDetails": item.get("folderProcessingErrorDetails")
-                    }
-            else:
-                # Individual file item
-                file_item = {
-                    "userId": item.get("userId"),
-                    "originalS3Key": item.get("originalS3Key"),
-                    "s3Bucket": item.get("s3Bucket"),
-                    "sessionId": item.get("sessionId"),
-                    "userFolder": item.get("userFolder"),
-                    "fileName": item.get("fileName"),
-                    "fileSize": item.get("fileSize"),
-                    "uploadTimestamp": item.get("uploadTimestamp"),
-                    "status": item.get("status"),
-                    "lastStatusUpdateTimestamp": item.get("lastStatusUpdateTimestamp"),
-                    "processingError": item.get("processingError")
-                }
-                files_output.append({k: v for k, v in file_item.items() if v is not None})
-
-
-        print(f"Found {len(files_output)} file items and {len(folder_metadata_map)} folder metadata entries for userId = {user_id}")
-        
-        final_response_body = {
-            "files": files_output,
-            "folderMetadata": list(folder_metadata_map.values())
-        }
-
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*' 
-            },
-            'body': json.dumps(final_response_body, cls=DecimalEncoder, indent=2) # Added indent for readability
-        }
+            return json_response(401, {'error': 'Unauthorized: User identifier not found.'})
+
+        params = event.get('queryStringParameters') or {}
+        request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        filters = {k: params[k] for k in ("folderName", "sessionId", "view") if params.get(k)}
+        paginated = bool(params.get('limit') or params.get('cursor'))
+        page_size = None
+        if paginated:
+            try:
+                page_size = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+            except ValueError:
+                return json_response(400, {'error': 'limit must be an integer.'})
+            page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+
+        # Read before querying: a write that lands meanwhile bumps past this version
+        usage_view = filters.get("view") == "usage"
+        usage_item = None
+        if usage_view and not filters.get("folderName"):
+            version, usage_item = read_user_usage(table, user_id)
+        else:
+            version = read_change_version(table, user_id)
+        etag = listing_etag(version, filters, page_size, params.get('cursor'))
+        if etag_matches(request_headers.get('if-none-match'), etag):
+            print(f"Listing for userId = {user_id} unchanged at version {version}; 304")
+            return listing_response(etag)
+
+        cache_key = (user_id, etag)
+        entry = cached_listing(cache_key)
+        if entry is not None:
+            print(f"Serving cached listing for userId = {user_id} at version {version}")
+            return listing_response(etag, entry, request_headers.get('accept-encoding', ''))
+
+        segments = key_segments(user_id, session_id=filters.get("sessionId"), folder_id=filters.get("folderName"),
+                                folders_only=filters.get("view") == "folders")
+        if usage_view:
+            body = usage_body(user_id, filters.get("folderName"), usage_item)
+            entry = cache_listing(cache_key, json.dumps(body, cls=DecimalEncoder, separators=(',', ':')))
+            return listing_response(etag, entry, request_headers.get('accept-encoding', ''))
+        if not paginated:
+            print(f"Querying files and folder summaries for userId = {user_id} {filters}")
+            body = list_all(user_id, segments)
+        else:
+            print(f"Querying a page of {page_size} items for userId = {user_id} {filters}")
+            body = list_page(user_id, segments, filters, page_size, params.get('cursor'))
+
+        print(f"Found {len(body['files'])} file items and {len(body['folderMetadata'])} folder metadata entries for userId = {user_id}")
+        entry = cache_listing(cache_key, json.dumps(body, cls=DecimalEncoder, separators=(',', ':')))
+        return listing_response(etag, entry, request_headers.get('accept-encoding', ''))
 
+    except BadRequest as e:
+        return json_response(400, {'error': str(e)})
     except Exception as e:
         print(f"Error listing files for user: {str(e)}")
         import traceback
         traceback.print_exc()
         print("Full event causing error in ListUserFiles:", json.dumps(event, indent=2)) 
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Internal server error: {str(e)}'})
-        }
+        return json_response(500, {'error': f'Internal server error: {str(e)}'})
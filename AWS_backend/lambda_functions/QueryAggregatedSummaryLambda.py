@@ -0,0 +1,193 @@
+import json
+import boto3
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# AWS clients
+s3_client = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+
+# Environment
+S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
+TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+table = dynamodb.Table(TABLE_NAME)
+
+# Configuration
+QUERY_RANGE_COALESCE_GAP_BYTES = int(os.environ.get('QUERY_RANGE_COALESCE_GAP_BYTES', 64 * 1024))
+QUERY_FETCH_CONCURRENCY        = int(os.environ.get('QUERY_FETCH_CONCURRENCY', 8))
+
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+SECTION_STORE_FORMAT = "sections-jsonl/v1"
+
+RESPONSE_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+def response(status_code, body):
+    return {'statusCode': status_code, 'headers': RESPONSE_HEADERS, 'body': json.dumps(body)}
+
+def split_param(value):
+    return [v.strip() for v in (value or "").split(',') if v.strip()]
+
+def load_folder_item(user_id, folder_name):
+    return table.get_item(Key={
+        'userId': user_id,
+        'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_name}#{FOLDER_ITEM_FILENAME_MARKER}"
+    }).get('Item')
+
+def load_section_index(folder_item):
+    """Reads the section index of the folder's latest aggregated summary."""
+    index_key = (folder_item or {}).get('folderSectionIndexS3Key')
+    if not index_key:
+        return None
+    obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=index_key)
+    index = json.loads(obj['Body'].read().decode('utf-8'))
+    if index.get('format') != SECTION_STORE_FORMAT:
+        raise ValueError(f"Unsupported section store format: {index.get('format')}")
+    return index
+
+def serves_progressive(folder_item):
+    """
+    True while a run is in progress or after it failed: the progressive
+    aggregate is newer than the last aggregated summary (or there is none).
+    """
+    if not folder_item or not folder_item.get('progressiveSummaries'):
+        return False
+    if not folder_item.get('folderSectionIndexS3Key'):
+        return True
+    return folder_item.get('progressiveStartedAtUtc', '') > folder_item.get('lastFolderUpdateTimestamp', '')
+
+def read_progressive_rows(folder_item, sections, requested_studies):
+    """Reads the requested sections straight from the per-study summaries completed so far."""
+    pointers = sorted(folder_item['progressiveSummaries'].values(), key=lambda p: p.get('completedAtUtc', ''))
+    if requested_studies:
+        pointers = [p for p in pointers if p['studyName'] in requested_studies]
+
+    def fetch(pointer):
+        obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=pointer['s3_key'])
+        doc = json.loads(obj['Body'].read().decode('utf-8'))
+        row = {"studyName": pointer['studyName']}
+        row.update({section: doc[section] for section in sections if section in doc})
+        return row
+
+    with ThreadPoolExecutor(max_workers=max(1, QUERY_FETCH_CONCURRENCY)) as executor:
+        return list(executor.map(fetch, pointers))
+
+def plan_ranges(index, sections, study_indexes):
+    """
+    Collects the [offset, length] of every requested (section, study) record and
+    merges ranges separated by less than QUERY_RANGE_COALESCE_GAP_BYTES, so
+    records of one section are usually served by a single ranged GET.
+    """
+    wanted = []
+    for section in sections:
+        per_study = index['sections'].get(section, {}).get('studies', {})
+        for idx in study_indexes:
+            rng = per_study.get(str(idx))
+            if rng:
+                wanted.append((rng[0], rng[0] + rng[1]))
+    wanted.sort()
+
+    merged = []
+    for start, end in wanted:
+        if merged and start - merged[-1][1] <= QUERY_RANGE_COALESCE_GAP_BYTES:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged, set(wanted)
+
+def fetch_range(data_key, start, end):
+    obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=data_key, Range=f"bytes={start}-{end - 1}")
+    return start, obj['Body'].read()
+
+def read_records(data_key, ranges, wanted):
+    """Fetches the coalesced ranges and yields only the records that were asked for."""
+    with ThreadPoolExecutor(max_workers=max(1, QUERY_FETCH_CONCURRENCY)) as executor:
+        chunks = executor.map(lambda r: fetch_range(data_key, r[0], r[1]), ranges)
+        for chunk_start, chunk in chunks:
+            pos = 0
+            while pos < len(chunk):
+                nl = chunk.find(b'\n', pos)
+                line_end = len(chunk) if nl == -1 else nl + 1
+                if (chunk_start + pos, chunk_start + line_end) in wanted:
+                    yield json.loads(chunk[pos:line_end])
+                pos = line_end
+
+def lambda_handler(event, context):
+    """
+    GET /summary/sections?folderName=<folder>&sections=AttackRates,StudyDetails[&studies=Study A,Study B]
+
+    Returns only the requested sections of the folder's aggregated summary:
+    { "folderName": ..., "sections": [...], "studies": [{"studyName": ..., "<section>": {...}}, ...] }
+
+    While the folder is being processed (or when its run produced no section
+    index) the studies completed so far are served instead, with the
+    completed/total counters and "partial": true until the run has finished.
+    """
+    print("Received API Gateway event for QueryAggregatedSummary:", json.dumps(event))
+
+    try:
+        claims = event.get('requestContext', {}).get('authorizer', {}).get('jwt', {}).get('claims', {})
+        user_id = claims.get('cognito:username') or claims.get('username') or claims.get('sub')
+        if not user_id:
+            return response(401, {'error': 'Unauthorized: User identifier not found.'})
+
+        params = event.get('queryStringParameters') or {}
+        folder_name = params.get('folderName')
+        sections = split_param(params.get('sections'))
+        if not folder_name or not sections:
+            return response(400, {'error': 'folderName and sections are required.'})
+
+        requested_studies = split_param(params.get('studies'))
+        folder_item = load_folder_item(user_id, folder_name)
+        if serves_progressive(folder_item):
+            rows = read_progressive_rows(folder_item, sections, requested_studies)
+            completed = int(folder_item.get('studiesCompleted', len(folder_item['progressiveSummaries'])))
+            total = int(folder_item['studiesTotal']) if folder_item.get('studiesTotal') is not None else None
+            run_finished = folder_item.get('lastFolderUpdateTimestamp', '') >= folder_item.get('progressiveStartedAtUtc', '')
+            print(f"Serving {len(rows)} progressive study summaries for folder '{folder_name}' ({completed}/{total}).")
+            return response(200, {
+                "folderName": folder_name,
+                "sections": sections,
+                "studies": rows,
+                "partial": not (run_finished and total is not None and completed >= total),
+                "studiesCompleted": completed,
+                "studiesTotal": total
+            })
+
+        index = load_section_index(folder_item)
+        if index is None:
+            return response(404, {'error': f"No section index found for folder '{folder_name}'."})
+
+        studies = index['studies']
+        if requested_studies:
+            study_indexes = [i for i, name in enumerate(studies) if name in requested_studies]
+        else:
+            study_indexes = list(range(len(studies)))
+
+        ranges, wanted = plan_ranges(index, sections, study_indexes)
+        print(f"Serving {len(wanted)} records for {len(sections)} sections x {len(study_indexes)} studies "
+              f"with {len(ranges)} ranged GETs ({sum(e - s for s, e in ranges)} of {index['size']} bytes)")
+
+        rows = {idx: {"studyName": studies[idx]} for idx in study_indexes}
+        by_name = {}
+        for idx in study_indexes:
+            by_name.setdefault(studies[idx], []).append(idx)
+        for record in read_records(index['dataKey'], ranges, wanted):
+            for idx in by_name.get(record['study'], []):
+                if record['section'] not in rows[idx]:
+                    rows[idx][record['section']] = record['data']
+                    break
+
+        return response(200, {
+            "folderName": folder_name,
+            "sections": sections,
+            "studies": [rows[idx] for idx in study_indexes],
+            "partial": False
+        })
+
+    except Exception as e:
+        print(f"Error querying aggregated summary: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return response(500, {'error': f'Internal server error: {str(e)}'})
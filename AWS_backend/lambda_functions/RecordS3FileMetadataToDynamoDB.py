@@ -2,82 +2,183 @@ import json
 import boto3
 import os
 import urllib.parse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from change_version import bump_change_versions  # docrag_shared layer
+from file_status import UNPROCESSED, event_time_ms, now_ms  # docrag_shared layer
+from folder_counters import add_delta, apply_folder_counters, report_counter_failure, row_contribution  # docrag_shared layer
+from kb_cleanup import DEFAULT_KB_SOURCE_PREFIX  # docrag_shared layer
+from s3_event_batch import batch_response, unpack_s3_event  # docrag_shared layer
 
 # DynamoDB setup
 dynamodb = boto3.resource('dynamodb')
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
 table = dynamodb.Table(TABLE_NAME)
+KEY_NAMES = ['userId', 'sessionId#fileName']
+WRITE_CONCURRENCY = int(os.environ.get('RECORD_WRITE_CONCURRENCY', 8))
+MANIFEST_PREFIX = os.environ.get('S3_MANIFEST_PREFIX', 'processing-manifests').strip('/')
+KB_SOURCE_PREFIX = os.environ.get('KB_S3_SOURCE_PREFIX', DEFAULT_KB_SOURCE_PREFIX).strip('/')
 
 # SYSTEM prefixes to skip entirely
 EXCLUDE_PREFIXES = [
-    "kb-source/",
+    f"{KB_SOURCE_PREFIX}/",
     "verification/",
     "textract-output/",
+    f"{MANIFEST_PREFIX}/",
+    "folder-summaries/_checkpoints/",
     # add more system prefixes here if needed
 ]
 
-def lambda_handler(event, context):
-    print("Received S3 event:", json.dumps(event, indent=2))
-    
-    for record in event.get('Records', []):
-        try:
-            key = urllib.parse.unquote_plus(record['s3']['object']['key'])
-            bucket_name = record['s3']['bucket']['name']
-            file_size = record['s3']['object'].get('size', 0)
 
-            # 1) Skip any system prefixes
-            if any(key.startswith(p) for p in EXCLUDE_PREFIXES):
-                print(f"Skipping system object: {key}")
-                continue
+def build_item(s3_record, upload_ts):
+    """The metadata item for one ObjectCreated record, or None for objects that are not user files."""
+    key = urllib.parse.unquote_plus(s3_record['s3']['object']['key'])
+    bucket_name = s3_record['s3']['bucket']['name']
+    file_size = s3_record['s3']['object'].get('size', 0)
 
-            # 2) Determine fileType + strip the appropriate prefix
-            if key.startswith("folder-summaries/"):
-                file_type = "folder_summaries"
-                path_after_prefix = key[len("folder-summaries/"):]
-            else:
-                file_type = "main"
-                path_after_prefix = key
-
-            # 3) Expect path_after_prefix = userId/sessionId/userFolder/fileName[...]
-            parts = path_after_prefix.split('/', 3)
-            if len(parts) < 4 or path_after_prefix.endswith('/'):
-                print(f"Skipping invalid structure (needs ≥4 segments): {key}")
-                continue
+    # 1) Skip any system prefixes
+    if any(key.startswith(p) for p in EXCLUDE_PREFIXES):
+        return None
 
-            user_id, session_id, user_folder, file_name = parts
-
-            # 4) Build your sort key and timestamps
-            sort_key = f"{session_id}#{user_folder}#{file_name}"
-            upload_ts = datetime.now(timezone.utc).isoformat()
-
-            # 5) Compose the DynamoDB item
-            item = {
-                'userId': user_id,
-                'sessionId#fileName': sort_key,
-                'originalS3Key': key,
-                's3Bucket': bucket_name,
-                'sessionId': session_id,
-                'userFolder': user_folder,
-                'fileName': file_name,
-                'fileSize': int(file_size),
-                'uploadTimestamp': upload_ts,
-                'lastStatusUpdateTimestamp': upload_ts,
-                'status': "unprocessed",
-                'fileType': file_type
-            }
-
-            print("Storing item:", json.dumps(item, indent=2))
-            table.put_item(Item=item)
-            print(f"Stored metadata for {file_type} → {key}")
+    # 2) Determine fileType + strip the appropriate prefix
+    if key.startswith("folder-summaries/"):
+        file_type = "folder_summaries"
+        path_after_prefix = key[len("folder-summaries/"):]
+    else:
+        file_type = "main"
+        path_after_prefix = key
 
-        except Exception as e:
-            print(f"Error processing record for key={record.get('s3',{}).get('object',{}).get('key')}: {e}", 
-                  exc_info=True)
-            # Depending on your retry strategy you might choose to continue on error
-            raise
+    # 3) Expect path_after_prefix = userId/sessionId/userFolder/fileName[...]
+    parts = path_after_prefix.split('/', 3)
+    if len(parts) < 4 or path_after_prefix.endswith('/'):
+        print(f"Skipping invalid structure (needs ≥4 segments): {key}")
+        return None
+
+    user_id, session_id, user_folder, file_name = parts
 
+    try:
+        at_ms = event_time_ms(s3_record['eventTime'])
+    except (KeyError, ValueError):
+        at_ms = now_ms()
+
+    # 4) Compose the DynamoDB item
     return {
-        'statusCode': 200,
-        'body': json.dumps('Successfully processed S3 event records.')
+        'userId': user_id,
+        'sessionId#fileName': f"{session_id}#{user_folder}#{file_name}",
+        'originalS3Key': key,
+        's3Bucket': bucket_name,
+        'sessionId': session_id,
+        'userFolder': user_folder,
+        'folderKey': f"{user_id}#{session_id}/{user_folder}",  # FolderIndex (sparse GSI)
+        'fileName': file_name,
+        'fileSize': int(file_size),
+        'uploadTimestamp': upload_ts,
+        'lastStatusUpdateTimestamp': upload_ts,
+        'status': UNPROCESSED,
+        'statusAtMs': at_ms,
+        'fileType': file_type
     }
+
+
+def record_upload(item):
+    """
+    Writes one upload over an older state of its row, keeping the attributes
+    it does not set (the previous version's ingestion fields). Returns
+    (previous row, new row), or None if the row has a newer status.
+    """
+    values = {name: value for name, value in item.items() if name not in KEY_NAMES}
+    names = {f"#u{i}": name for i, name in enumerate(values)}
+    # The Table's client is thread-safe and (de)serializes values like the Table does
+    client = table.meta.client
+    try:
+        old = client.update_item(
+            TableName=table.name,
+            Key={name: item[name] for name in KEY_NAMES},
+            UpdateExpression="SET " + ", ".join(f"#u{i} = :u{i}" for i in range(len(values))) + " REMOVE processingError",
+            ConditionExpression="attribute_not_exists(statusAtMs) OR statusAtMs < :at",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={**{f":u{i}": value for i, value in enumerate(values.values())},
+                                       ':at': item['statusAtMs']},
+            ReturnValues="ALL_OLD"
+        ).get('Attributes') or {}
+    except client.exceptions.ConditionalCheckFailedException:
+        return None
+    return old, {**{name: value for name, value in old.items() if name != 'processingError'}, **item}
+
+
+def count_uploads(rows):
+    """Adds the written rows, as (previous, new) pairs, to their folders' upload counters. Returns the per-user totals."""
+    deltas = defaultdict(Counter)
+    for old, new in rows:
+        add_delta(deltas, new['userId'], f"{new['sessionId']}/{new['userFolder']}",
+                  row_contribution(new), row_contribution(old))
+    try:
+        return apply_folder_counters(table, deltas)
+    except Exception as e:
+        # The rows are written; failing the batch would not recount them on redelivery
+        report_counter_failure(deltas, e)
+        return None
+
+
+def lambda_handler(event, context):
+    """
+    Records uploaded files from S3 ObjectCreated notifications, delivered in
+    SQS batches (see s3_event_batch). The rows of a batch are written in
+    parallel; messages that could not be recorded are reported in
+    batchItemFailures so only they are redelivered. The folders' upload
+    counters move by the new and resized files (see folder_counters).
+
+    Each row is written with a conditional update, only over an older status
+    (see file_status), so a redelivered or late notification cannot reset a
+    file that has moved on, even if the move lands while the batch is being
+    written. A re-upload keeps the ingestion fields of the previous version:
+    its chunks stay in the KB until the next run finds the ETag changed and
+    ingests it again.
+    """
+    pairs, failed = unpack_s3_event(event)
+    upload_ts = datetime.now(timezone.utc).isoformat()
+
+    latest, skipped = {}, 0
+    for message_id, s3_record in pairs:
+        try:
+            item = build_item(s3_record, upload_ts)
+        except Exception as e:
+            print(f"Error reading record of message {message_id}: {e} ({json.dumps(s3_record)[:500]})")
+            failed.add(message_id)
+            continue
+        if item is None:
+            skipped += 1
+            continue
+        # Of several events for one file in the batch, only the newest can win
+        key = (item['userId'], item['sessionId#fileName'])
+        if key in latest:
+            skipped += 1
+            if latest[key][1]['statusAtMs'] > item['statusAtMs']:
+                continue
+        latest[key] = (message_id, item)
+
+    def write(entry):
+        message_id, item = entry
+        try:
+            return record_upload(item)
+        except Exception as e:
+            print(f"Write for message {message_id} failed: {e}")
+            failed.add(message_id)
+            return False
+
+    written = []
+    if latest:
+        with ThreadPoolExecutor(max_workers=max(1, min(WRITE_CONCURRENCY, len(latest)))) as executor:
+            outcomes = list(executor.map(write, latest.values()))
+        for outcome in outcomes:
+            if outcome is None:
+                skipped += 1
+            elif outcome:
+                written.append(outcome)
+    if written:
+        bump_change_versions(table, [new['userId'] for _, new in written], count_uploads(written))
+
+    print(f"Recorded {len(written)} file(s) from {len(pairs)} S3 record(s); "
+          f"skipped {skipped}, {len(failed)} message(s) failed.")
+    return batch_response(failed)
@@ -5,10 +5,17 @@ from datetime import datetime, timezone
 import time
 import json
 import random
+import uuid
+from model_router import ModelRouter  # docrag_shared layer
+from retrieval import retrieval_depth
+from json_extraction import parse_json_object  # docrag_shared layer
+from schema_registry import KEY_MAP, METADATA_PART, get_schema, schema_tag  # docrag_shared layer
+from summary_pointers import record_summary, study_scope  # docrag_shared layer
 
 # Initialize AWS clients
 bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
 s3_client = boto3.client('s3')
+dynamodb_resource = boto3.resource('dynamodb')
 
 # Environment Variables
 KB_ID = os.environ.get('KB_ID')
@@ -16,6 +23,9 @@ SUMMARY_MODEL_ID = os.environ.get('BEDROCK_SUMMARY_MODEL_ID')
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
 S3_SUMMARY_PREFIX = os.environ.get('S3_SUMMARY_PREFIX', 'folder-summaries')
 AWS_REGION = os.environ.get('AWS_REGION', boto3.session.Session().region_name)
+DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME')
+metadata_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME) if DYNAMODB_TABLE_NAME else None
+bedrock_router = ModelRouter(bedrock_agent_runtime_client, region=AWS_REGION, default_model=SUMMARY_MODEL_ID)
 
 # Enhanced Configuration for retry and rate limiting
 MAX_RETRIES = 3
@@ -23,123 +33,23 @@ BASE_SLEEP_SECONDS = 3
 MAX_SLEEP_SECONDS = 30
 PACING_DELAY_SECONDS = 1.0
 
-# --- FINAL FIX: A more precise JSON extraction function ---
+# Checkpointing: each step's results are saved to S3 so a run that approaches the
+# Lambda deadline can hand back a continuation token and resume without redoing LLM calls.
+S3_CHECKPOINT_PREFIX = os.environ.get('S3_CHECKPOINT_PREFIX', f"{S3_SUMMARY_PREFIX}/_checkpoints")
+DEADLINE_SAFETY_MARGIN_MS = int(os.environ.get('DEADLINE_SAFETY_MARGIN_MS', 150000))  # room for one study's three prompts
+
 def extract_json_from_response(response_text):
     """
-    Extracts a JSON object from a string by finding the first '{' and last '}'.
-    This is more reliable than a greedy regex if there's trailing text.
+    Parses the JSON object in a model answer through the shared cascade
+    (strict parse, brace-balanced scan, json_repair). Returns {} if none is found.
     """
-    try:
-        start_index = response_text.find('{')
-        end_index = response_text.rfind('}')
-        
-        if start_index != -1 and end_index != -1 and end_index > start_index:
-            json_str = response_text[start_index:end_index+1]
-            return json.loads(json_str)
-        else:
-            print(f"    ⚠️ Could not find valid start/end braces in the response.")
-            return None
-    except json.JSONDecodeError as e:
-        print(f"    ⚠️ JSONDecodeError during parsing: {e}. Raw sliced string: {response_text[start_index:end_index+1][:500]}")
-        return None
-    except Exception as e:
-        print(f"    ⚠️ An unexpected error occurred in extract_json_from_response: {e}")
-        return None
-
+    data, stage = parse_json_object(response_text)
+    if stage == "failed":
+        print(f"    ⚠️ No JSON object could be recovered from the response: {(response_text or '')[:500]}")
+    elif stage != "strict":
+        print(f"    JSON recovered by {stage} parse.")
+    return data
 
-# --- Global KEY_MAP_DEFINITION (Complete and Unabridged) ---
-KEY_MAP_DEFINITION = {
-    "PRODUCT_OVERVIEW_DRUG_NAME": ("ProductOverview", "DrugName"),
-    "PRODUCT_OVERVIEW_MECHANISM_OF_ACTION": ("ProductOverview", "MechanismOfAction"),
-    "PRODUCT_OVERVIEW_ROUTE_OF_ADMINISTRATION": ("ProductOverview", "RouteOfAdministration"),
-    "PRODUCT_OVERVIEW_COMPANY": ("ProductOverview", "Company"),
-    "PRODUCT_OVERVIEW_LONG_TERM_REGISTRY_NUMBER": ("ProductOverview", "LongTermClinicalTrialRegistryNumber"),
-    "STUDY_DETAILS_STUDY_TYPE": ("StudyDetails", "StudyType"),
-    "STUDY_DETAILS_REGISTRY_NUMBER": ("StudyDetails", "ClinicalTrialRegistryNumber"),
-    "STUDY_DETAILS_LONG_TERM_DETAILS": ("StudyDetails", "LongTermStudyDetails"),
-    "STUDY_DETAILS_DESIGN": ("StudyDetails", "StudyDesign"),
-    "STUDY_DETAILS_ELIGIBILITY_CRITERIA": ("StudyDetails", "EligibilityCriteria"),
-    "STUDY_DETAILS_TRIAL_DURATION_WEEKS": ("StudyDetails", "TrialDurationWeeks"),
-    "STUDY_DETAILS_NUMBER_OF_PATIENTS": ("StudyDetails", "NumberOfPatients"),
-    "STUDY_DETAILS_STATUS": ("StudyDetails", "StudyStatus"),
-    "EFFICACY_PRIMARY_ENDPOINTS": ("EfficacyEndpoints", "PrimaryEndpoints"),
-    "EFFICACY_SECONDARY_ENDPOINTS": ("EfficacyEndpoints", "SecondaryEndpoints"),
-    "EFFICACY_EXPLORATORY_ENDPOINTS": ("EfficacyEndpoints", "ExploratoryEndpoints"),
-    "ATTACK_RATES_MEAN_HAE_PER_MONTH": ("AttackRates", "MeanHAEAttacksPerMonth"),
-    "ATTACK_RATES_LSM_HAE_PER_MONTH": ("AttackRates", "LSMHAEAttacksPerMonth"),
-    "ATTACK_RATES_MEDIAN_HAE_PER_MONTH": ("AttackRates", "MedianHAEAttacksPerMonth"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_VS_PLACEBO": ("AttackRates", "PercentReductionMeanActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_LSM_VS_PLACEBO": ("AttackRates", "PercentReductionLSMActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_VS_PLACEBO": ("AttackRates", "PercentReductionMedianActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "PercentReductionMeanFromBaseline"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE": ("AttackRates", "PercentReductionMedianFromBaseline"),
-    "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "NumericalReductionMeanFromBaseline"),
-    "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN": ("AttackRates", "PercentPatients100ReductionVsRunIn"),
-    "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION": ("AttackRates", "PercentPatients90PlusReduction"),
-    "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION": ("AttackRates", "PercentPatients70PlusReduction"),
-    "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION": ("AttackRates", "PercentPatients50PlusReduction"),
-    "ATTACK_RATES_OTHER_TIME_FRAMES": ("AttackRates", "AttackRateOtherTimeFrames"),
-    "ATTACK_RATES_BY_BASELINE_RATE": ("AttackRates", "AttackRateByBaselineRate"),
-    "RESCUE_MED_MEAN_PER_MONTH": ("RescueMedicationUse", "MeanRescueMedicationsPerMonth"),
-    "RESCUE_MED_ATTACKS_REQUIRING_RESCUE": ("RescueMedicationUse", "AttacksPerMonthRequiringRescue"),
-    "ATTACK_PARAMETERS_SEVERITY": ("AttackParameters", "SeverityOfAttacks"),
-    "ATTACK_PARAMETERS_DURATION": ("AttackParameters", "DurationOfAttacks"),
-    "ATTACK_PARAMETERS_DAYS_SWELLING": ("AttackParameters", "DaysOfSwellingSymptoms"),
-    "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK": ("AttackParameters", "TimeToFirstAttack"),
-    "ATTACK_PARAMETERS_BY_LOCATION": ("AttackParameters", "AttacksByLocation"),
-    "PRO_DATA_AE_QOL_CHANGE": ("PatientReportedOutcomes", "AEQOLScoreChange"),
-    "PRO_DATA_PERCENT_GOOD_ON_SGART": ("PatientReportedOutcomes", "PercentRatingGoodOnSGART"),
-    "PRO_DATA_AECT_SCORE_WEEK_25": ("PatientReportedOutcomes", "AECTScoreWeek25"),
-    "PRO_DATA_TSQM_DETAILS": ("PatientReportedOutcomes", "TSQMDetails"),
-    "PK_PD_SUMMARY": ("PharmacokineticsPharmacodynamics", "PKPDDataSummary"),
-    "ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS": ("AdditionalExploratoryEndpointsDetails", "Details"),
-    "REFERENCES_LIST": ("ReferencesAndFootnotes", "ReferencesList"),
-    "FOOTNOTES_LIST": ("ReferencesAndFootnotes", "FootnotesList")
-}
-
-# Using the original two-part buckets for smaller, more reliable prompts
-SECTION_BUCKETS_PART1 = {
-    "EfficacyEndpoints": [
-        "EFFICACY_PRIMARY_ENDPOINTS",
-        "EFFICACY_SECONDARY_ENDPOINTS",
-        "EFFICACY_EXPLORATORY_ENDPOINTS",
-    ],
-    "AttackRates": [
-        "ATTACK_RATES_MEAN_HAE_PER_MONTH", "ATTACK_RATES_LSM_HAE_PER_MONTH",
-        "ATTACK_RATES_MEDIAN_HAE_PER_MONTH", "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE",
-        "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE", "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE",
-        "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN", "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION",
-        "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION", "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION",
-        "ATTACK_RATES_OTHER_TIME_FRAMES", "ATTACK_RATES_BY_BASELINE_RATE",
-    ],
-    "AttackParameters": [
-        "ATTACK_PARAMETERS_SEVERITY", "ATTACK_PARAMETERS_DURATION", "ATTACK_PARAMETERS_DAYS_SWELLING",
-        "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK", "ATTACK_PARAMETERS_BY_LOCATION",
-    ],
-}
-SECTION_BUCKETS_PART2 = {
-    "StudyDetails": ["STUDY_DETAILS_STUDY_TYPE","STUDY_DETAILS_REGISTRY_NUMBER","STUDY_DETAILS_LONG_TERM_DETAILS","STUDY_DETAILS_DESIGN","STUDY_DETAILS_ELIGIBILITY_CRITERIA","STUDY_DETAILS_TRIAL_DURATION_WEEKS","STUDY_DETAILS_NUMBER_OF_PATIENTS","STUDY_DETAILS_STATUS"],
-    "PatientReportedOutcomes": [
-    "PRO_DATA_AE_QOL_CHANGE", "PRO_DATA_PERCENT_GOOD_ON_SGART",
-    "PRO_DATA_AECT_SCORE_WEEK_25", "PRO_DATA_TSQM_DETAILS",
-    ],
-    "RescueMedicationUse": ["RESCUE_MED_MEAN_PER_MONTH", "RESCUE_MED_ATTACKS_REQUIRING_RESCUE"],
-    "PharmacokineticsPharmacodynamics": ["PK_PD_SUMMARY"],
-    "AdditionalExploratoryEndpointsDetails": ["ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS"],
-    "ReferencesAndFootnotes": ["REFERENCES_LIST", "FOOTNOTES_LIST"],
-}
-
-# Schema for the new metadata RAG call
-METADATA_BUCKET = {
-    "TrialAndProduct": [
-        "NCT", "TrialName", "ProductName", "StartDate", "EndDate", "MechanismOfAction"
-    ],
-    "PatientCriteria": [
-        "Age", "HAESubtype", "GeographicalLocation", "SexRestriction",
-        "EthnicityRaceRestriction", "OtherRelevantRestriction"
-    ],
-    "Documentation": ["References", "Footnotes"]
-}
 
 def sanitize_filename(s):
     s = str(s)
@@ -208,26 +118,14 @@ def parse_normalization_map_text(text):
     return normalization_map
 
 def invoke_bedrock_retrieve_and_generate_with_retry(
-        prompt_text, knowledge_base_id, model_arn, retrieval_filter, step_description="Bedrock RAG call"):
-    """Enhanced retry mechanism with better throttling handling"""
+        prompt_text, knowledge_base_id, task, retrieval_filter, step_description="Bedrock RAG call"):
+    """Enhanced retry mechanism with better throttling handling; task selects the model route."""
     
     for attempt in range(MAX_RETRIES):
         try:
-            response = bedrock_agent_runtime_client.retrieve_and_generate(
-                input={'text': prompt_text},
-                retrieveAndGenerateConfiguration={
-                    'type': 'KNOWLEDGE_BASE',
-                    'knowledgeBaseConfiguration': {
-                        'knowledgeBaseId': knowledge_base_id,
-                        'modelArn': model_arn,
-                        'retrievalConfiguration': {
-                            'vectorSearchConfiguration': {
-                                'filter': retrieval_filter,
-                                'numberOfResults':30
-                            }
-                        }
-                    }
-                }
+            response = bedrock_router.retrieve_and_generate(
+                task, prompt_text, knowledge_base_id,
+                {'filter': retrieval_filter, 'numberOfResults': retrieval_depth(task)}, step_description
             )
             
             response_text = response['output']['text']
@@ -279,7 +177,104 @@ def invoke_bedrock_retrieve_and_generate_with_retry(
     raise Exception(f"Failed {step_description} after {MAX_RETRIES} retries without specific exception.")
 
 
+def checkpoint_key(user_id, folder_id, run_id):
+    return f"{S3_CHECKPOINT_PREFIX}/{user_id}/{folder_id}/{sanitize_filename(run_id)}.json"
+
+def load_checkpoint(key):
+    try:
+        obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return json.loads(obj['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def save_checkpoint(key, state):
+    s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=json.dumps(state).encode("utf-8"), ContentType="application/json")
+
+def delete_checkpoint(key):
+    s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+
+def deadline_reached(context):
+    """True when the remaining invocation time can no longer fit another unit of LLM work."""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < DEADLINE_SAFETY_MARGIN_MS
+
+def summarize_study(user_id, folder_id, product_data, study, source_files, schema_name=None):
+    """Runs the three extraction prompts for one study and saves its summary. Returns (s3_key, summary_doc)."""
+    schema = get_schema(schema_name)
+    drug = product_data["drug_name"]
+    company = product_data["normalized_company_name"]
+    moa = product_data["mechanism_of_action"]
+    roa = product_data["route_of_administration"]
+
+    # --- FIX: Changed 'values' to 'value' ---
+    dynamic_filter = {
+        'andAll': [
+            {'equals': {'key': 'user_id', 'value': user_id}},
+            {'equals': {'key': 'folder_id', 'value': folder_id}},
+            {'in': {'key': 'file_name', 'value': source_files}}
+        ]
+    }
+
+    summary_doc = {"ProductOverview": {"DrugName": drug, "Company": company, "MechanismOfAction": moa, "RouteOfAdministration": roa}, "StudyDetails": {"StudyType": study}}
+    all_citations = []
+
+    prompt1_schema = {sec: {k: "" for k in keys} for sec, keys in schema["parts"]["Part1"].items()}
+    prompt1 = f'For **{drug}** ({study}), extract the fields. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt1_schema, indent=2)}\n\nOutput **only** the JSON.'
+    resp1 = invoke_bedrock_retrieve_and_generate_with_retry(prompt1, KB_ID, "extraction", dynamic_filter, f"Step4-Part1({drug}/{study})")
+    all_citations.extend(resp1.get("citations", [])); data1 = extract_json_from_response(resp1["text"]) or {}
+
+    time.sleep(PACING_DELAY_SECONDS)
+
+    prompt2_schema = {sec: {k: "" for k in keys} for sec, keys in schema["parts"]["Part2"].items()}
+    prompt2 = f'For **{drug}** ({study}), extract the fields. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt2_schema, indent=2)}\n\nOutput **only** the JSON.'
+    resp2 = invoke_bedrock_retrieve_and_generate_with_retry(prompt2, KB_ID, "extraction", dynamic_filter, f"Step4-Part2({drug}/{study})")
+    all_citations.extend(resp2.get("citations", [])); data2 = extract_json_from_response(resp2["text"]) or {}
+
+    time.sleep(PACING_DELAY_SECONDS)
+
+    prompt3_schema = {sec: {k: "" for k in keys} for sec, keys in schema["parts"][METADATA_PART].items()}
+    prompt3 = f'For study "{study}" ({drug}), extract metadata. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt3_schema, indent=2)}\n\nOutput **only** the JSON.'
+    resp3 = invoke_bedrock_retrieve_and_generate_with_retry(prompt3, KB_ID, "extraction", dynamic_filter, f"Step4-GMetadata({drug}/{study})")
+    all_citations.extend(resp3.get("citations", [])); data3 = extract_json_from_response(resp3["text"]) or {}
+
+    # Assemble the final document
+    all_clinical_data = {**data1, **data2}
+    all_sections = {**schema["parts"]["Part1"], **schema["parts"]["Part2"]}
+    for sec, keys in all_sections.items():
+        bucket, mapped = all_clinical_data.get(sec, {}), {}
+        if isinstance(bucket, dict):
+            for llm_key, val in bucket.items():
+                if llm_key in KEY_MAP: _, fld = KEY_MAP[llm_key]; mapped[fld] = val
+        summary_doc[sec] = mapped
+
+    metadata_summary_mapped = {}
+    for sec in schema["parts"][METADATA_PART]:
+        bucket = data3.get(sec, {})
+        if isinstance(bucket, dict): metadata_summary_mapped.update(bucket)
+    summary_doc["trialMetadataSummary"] = metadata_summary_mapped
+    summary_doc["Citations"] = all_citations
+    summary_doc["__schema__"] = schema_tag(schema)
+
+    # Save file
+    ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"); safe_study_name = sanitize_filename(study)
+    session_part, run_part = folder_id.split('/', 1) if '/' in folder_id else (folder_id, "")
+    prefix = f"{S3_SUMMARY_PREFIX}/{user_id}/{session_part}"; 
+    if run_part: prefix = f"{prefix}/{run_part}"
+    key = f"{prefix}/summary_{safe_study_name}_{ts}.json"
+    body = json.dumps(summary_doc, indent=2).encode("utf-8")
+    s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=body, ContentType="application/json")
+    print("     ✅ Saved", key)
+    if metadata_table is not None:
+        try:
+            record_summary(metadata_table, user_id, folder_id, study_scope(study), key, len(body), {"studyName": study})
+        except Exception as e:
+            print(f"     ⚠️ Could not record the summary pointer of {study}: {e}")
+    return key, summary_doc
+
+
 def lambda_handler(event, context):
+    bedrock_router.reset_stats()
     # 1. INITIAL SETUP & VALIDATION
     missing_env_vars = []
     if not KB_ID: missing_env_vars.append("KB_ID")
@@ -287,7 +282,7 @@ def lambda_handler(event, context):
     if not S3_BUCKET_NAME: missing_env_vars.append("S3_BUCKET_NAME")
 
     return_payload = {
-        "summaryS3Keys": [], "structuredSummaries": [], "productOverviews": [],
+        "status": "COMPLETE", "summaryS3Keys": [], "productOverviews": [],
         "message": "", "errorDetails": None, "textSummariesGenerated": 0,
         "normalizationAppliedCount": 0, "uniqueProductsForStudyTypes": 0
     }
@@ -308,21 +303,56 @@ def lambda_handler(event, context):
         return {"statusCode": 400, "body": json.dumps(return_payload)}
 
     print(f"Processing request for User: {user_id}, Folder: {folder_id}")
-    model_arn = SUMMARY_MODEL_ID if SUMMARY_MODEL_ID.startswith("arn:") else f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{SUMMARY_MODEL_ID}"
-    print(f"Using Model ARN: {model_arn}")
+    print(f"Model routes: {json.dumps(bedrock_router.routes) if bedrock_router.routes else SUMMARY_MODEL_ID}")
 
     base_retrieval_filter = {'andAll': [{'equals': {'key': 'user_id', 'value': user_id}}, {'equals': {'key': 'folder_id', 'value': folder_id}}]}
 
-    normalization_applied_count = 0
-    text_summaries_generated_count = 0
-    all_summary_files = []
-    aggregated_results_for_frontend = []
-    product_overviews_for_output = []
+    # Resume from the checkpoint named by the continuation token, or start a new run
+    run_id = event.get('continuationToken') or f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    ckpt_key = checkpoint_key(user_id, folder_id, run_id)
+    if event.get('releaseCheckpoint') and event.get('continuationToken'):
+        # The caller has the run's result; its checkpoint is no longer needed
+        delete_checkpoint(ckpt_key)
+        print(f"Released checkpoint {ckpt_key}")
+        return {"status": "RELEASED", "continuationToken": run_id}
+    state = load_checkpoint(ckpt_key) if event.get('continuationToken') else None
+    if state and state.get("step") == "done":
+        # A retried invocation of a finished run: its result may not have been delivered
+        print(f"Run {run_id} is already complete; returning its saved result.")
+        return state["result"]
+    if state:
+        print(f"Resuming run {run_id} at step '{state['step']}' ({len(state.get('completedStudies', {}))} studies already summarized)")
+    else:
+        state = {"runId": run_id, "step": "products"}
+
+    def suspend():
+        save_checkpoint(ckpt_key, state)
+        print(f"⏸️ Approaching the Lambda deadline during step '{state['step']}'. Checkpoint saved to {ckpt_key}")
+        return {
+            "status": "IN_PROGRESS", "continuationToken": run_id,
+            "userId": user_id, "folderId": folder_id, "step": state["step"],
+            "summariesCompleted": len(state.get("completedStudies", {})),
+            "message": f"Run {run_id} checkpointed at step '{state['step']}'; re-invoke with continuationToken to resume."
+        }
+
+    def finish(result):
+        # The checkpoint keeps the result until the caller releases it (releaseCheckpoint)
+        # or it expires, so a retry after a lost response does not start the run over.
+        state.update({"step": "done", "result": result})
+        save_checkpoint(ckpt_key, state)
+        return result
+
+    def finish_early(message):
+        print(message); return_payload["message"] = message
+        return_payload["normalizationAppliedCount"] = state.get("normalizationAppliedCount", 0)
+        return finish({"statusCode": 200, "body": json.dumps(return_payload)})
 
     try:
         # 2. EXTRACT PRODUCT OVERVIEW DETAILS
-        print("Step 1: Extracting initial primary product overview details...")
-        product_overview_prompt_text = f"""
+        if state["step"] == "products":
+            if deadline_reached(context): return suspend()
+            print("Step 1: Extracting initial primary product overview details...")
+            product_overview_prompt_text = f"""
         You are a clinical research data extraction assistant focused on identifying primary investigational drug products.
         Your task: Identify the main drug products being studied in clinical trials.
         For each PRIMARY drug product (not incidental mentions), extract:
@@ -341,186 +371,147 @@ def lambda_handler(event, context):
 If no primary products found, respond: NO_PRIMARY_PRODUCTS_FOUND
 Focus only on drugs that are the main subject of clinical studies, not drugs mentioned in passing.
 """
-        product_overview_result = invoke_bedrock_retrieve_and_generate_with_retry(
-            product_overview_prompt_text, KB_ID, model_arn, base_retrieval_filter, "Step 1 Product Overview"
-        )
-        product_overviews_llm_text = product_overview_result['text']
-        if (product_overviews_llm_text == 'LLM_DECLINED_TO_ASSIST' or "NO_PRIMARY_PRODUCTS_FOUND" in product_overviews_llm_text):
-            error_details = "No primary products found in documents (Step 1)."
-            print(error_details); return_payload["message"] = error_details
-            return {"statusCode": 200, "body": json.dumps(return_payload)}
-
-        extracted_products = parse_product_overviews_text(product_overviews_llm_text)
-        if not extracted_products:
-            error_details = "No product data parsed from LLM output (Step 1)."
-            print(error_details); return_payload["message"] = error_details
-            return {"statusCode": 200, "body": json.dumps(return_payload)}
-
-        print(f"Found {len(extracted_products)} products before validation.")
-        validated_products = [prod for prod in extracted_products if prod.get('drug_name', '').lower() != 'not specified' and prod.get('company_name', '').lower() != 'not specified']
-        if not validated_products:
-            error_details = "All products filtered out after validation (Step 1)."
-            print(error_details); return_payload["message"] = error_details
-            return {"statusCode": 200, "body": json.dumps(return_payload)}
-        
-        extracted_products = validated_products
-        print(f"Have {len(extracted_products)} validated products after Step 1.")
+            product_overview_result = invoke_bedrock_retrieve_and_generate_with_retry(
+                product_overview_prompt_text, KB_ID, "product_list", base_retrieval_filter, "Step 1 Product Overview"
+            )
+            product_overviews_llm_text = product_overview_result['text']
+            if (product_overviews_llm_text == 'LLM_DECLINED_TO_ASSIST' or "NO_PRIMARY_PRODUCTS_FOUND" in product_overviews_llm_text):
+                return finish_early("No primary products found in documents (Step 1).")
+
+            extracted_products = parse_product_overviews_text(product_overviews_llm_text)
+            if not extracted_products:
+                return finish_early("No product data parsed from LLM output (Step 1).")
+
+            print(f"Found {len(extracted_products)} products before validation.")
+            validated_products = [prod for prod in extracted_products if prod.get('drug_name', '').lower() != 'not specified' and prod.get('company_name', '').lower() != 'not specified']
+            if not validated_products:
+                return finish_early("All products filtered out after validation (Step 1).")
+
+            print(f"Have {len(validated_products)} validated products after Step 1.")
+            state.update({"step": "normalization", "products": validated_products})
+            save_checkpoint(ckpt_key, state)
 
         # 3. NORMALIZE COMPANY NAMES
-        print("Step 2: Normalizing company names...")
-        original_company_names = sorted(list(set(p['company_name'] for p in extracted_products if p.get('company_name'))))
-        company_normalization_map = {name: name for name in original_company_names}
-        if original_company_names:
-            company_list_str = ", ".join(original_company_names)
-            normalization_prompt_plain_text = f"""
+        if state["step"] == "normalization":
+            if deadline_reached(context): return suspend()
+            print("Step 2: Normalizing company names...")
+            extracted_products = state["products"]
+            normalization_applied_count = 0
+            original_company_names = sorted(list(set(p['company_name'] for p in extracted_products if p.get('company_name'))))
+            company_normalization_map = {name: name for name in original_company_names}
+            if original_company_names:
+                company_list_str = ", ".join(original_company_names)
+                normalization_prompt_plain_text = f"""
 Normalize these pharmaceutical company names to their standard forms: {company_list_str}
 Provide one mapping per line in format: Original Name | Standard Name
 """
-            time.sleep(PACING_DELAY_SECONDS)
-            normalization_result = invoke_bedrock_retrieve_and_generate_with_retry(
-                normalization_prompt_plain_text, KB_ID, model_arn, base_retrieval_filter, "Step 2 Company Normalization"
-            )
-            if normalization_result['text'] != 'LLM_DECLINED_TO_ASSIST':
-                parsed_map = parse_normalization_map_text(normalization_result['text'])
-                if parsed_map:
-                    company_normalization_map.update(parsed_map)
-        products_with_normalized_companies = []
-        for prod in extracted_products:
-            original_company = prod['company_name']
-            normalized_company = company_normalization_map.get(original_company, original_company)
-            if original_company != normalized_company:
-                normalization_applied_count += 1
-            prod["normalized_company_name"] = normalized_company
-            products_with_normalized_companies.append(prod)
-        return_payload["normalizationAppliedCount"] = normalization_applied_count
-        unique_processed_products = {(p.get('drug_name', '').strip().lower(), p.get('normalized_company_name', '').strip().lower()): p for p in products_with_normalized_companies}
-        final_products_for_study_type_extraction = list(unique_processed_products.values())
-        if not final_products_for_study_type_extraction:
-            error_details = "No unique products after normalization (Step 2)."
-            print(error_details); return_payload["message"] = error_details
-            return {"statusCode": 200, "body": json.dumps(return_payload)}
+                time.sleep(PACING_DELAY_SECONDS)
+                normalization_result = invoke_bedrock_retrieve_and_generate_with_retry(
+                    normalization_prompt_plain_text, KB_ID, "normalization", base_retrieval_filter, "Step 2 Company Normalization"
+                )
+                if normalization_result['text'] != 'LLM_DECLINED_TO_ASSIST':
+                    parsed_map = parse_normalization_map_text(normalization_result['text'])
+                    if parsed_map:
+                        company_normalization_map.update(parsed_map)
+            products_with_normalized_companies = []
+            for prod in extracted_products:
+                original_company = prod['company_name']
+                normalized_company = company_normalization_map.get(original_company, original_company)
+                if original_company != normalized_company:
+                    normalization_applied_count += 1
+                prod["normalized_company_name"] = normalized_company
+                products_with_normalized_companies.append(prod)
+            state["normalizationAppliedCount"] = normalization_applied_count
+            unique_processed_products = {(p.get('drug_name', '').strip().lower(), p.get('normalized_company_name', '').strip().lower()): p for p in products_with_normalized_companies}
+            final_products_for_study_type_extraction = list(unique_processed_products.values())
+            if not final_products_for_study_type_extraction:
+                return finish_early("No unique products after normalization (Step 2).")
+
+            state.update({"step": "study_types", "finalProducts": final_products_for_study_type_extraction,
+                          "studyTypesDone": 0, "productsReady": []})
+            save_checkpoint(ckpt_key, state)
+
+        return_payload["normalizationAppliedCount"] = state.get("normalizationAppliedCount", 0)
 
         # 4. FIND STUDY TYPES AND THEIR SOURCE FILES
-        print("Step 3: Finding study types and their source files...")
-        products_ready_for_summary_iteration = []
-        for product in final_products_for_study_type_extraction:
-            drug = product['drug_name']
-            company = product.get('normalized_company_name', 'N/A')
-            study_type_prompt = f"""
+        if state["step"] == "study_types":
+            print("Step 3: Finding study types and their source files...")
+            final_products_for_study_type_extraction = state["finalProducts"]
+            while state["studyTypesDone"] < len(final_products_for_study_type_extraction):
+                if deadline_reached(context): return suspend()
+                product = final_products_for_study_type_extraction[state["studyTypesDone"]]
+                drug = product['drug_name']
+                company = product.get('normalized_company_name', 'N/A')
+                study_type_prompt = f"""
 For the drug '{drug}' from '{company}', list *all* distinct study types mentioned, including any trial names or registry IDs (e.g. Phase 3 VANGUARD (NCT04656418), Phase 2 OLE).
 Respond only with a comma-separated list—no extra commentary.
 """
-            time.sleep(PACING_DELAY_SECONDS)
-            study_types_result = invoke_bedrock_retrieve_and_generate_with_retry(
-                study_type_prompt, KB_ID, model_arn, base_retrieval_filter, f"Step 3 Study Types ({drug})"
-            )
-            
-            study_to_files_map = {}
-            if study_types_result['text'] != 'LLM_DECLINED_TO_ASSIST':
-                raw_text = study_types_result['text'].strip()
-                if ':' in raw_text: raw_text = raw_text.split(':', 1)[1].strip()
-                study_names = [s.strip() for s in raw_text.split(',') if s.strip()]
-
-                citations = study_types_result.get('citations', [])
-                for citation in citations:
-                    for ref in citation.get('retrievedReferences', []):
-                        file_name = ref.get('metadata', {}).get('file_name')
-                        if not file_name: continue
-                        
-                        for study_name in study_names:
-                            study_to_files_map.setdefault(study_name, set()).add(file_name)
-            
-            if study_to_files_map:
-                product['study_to_files_map'] = {k: list(v) for k, v in study_to_files_map.items()}
-                products_ready_for_summary_iteration.append(product)
-                print(f"Found study-to-file map for {drug}: {product['study_to_files_map']}")
-            else:
-                print(f"No valid study types found for {drug}")
+                time.sleep(PACING_DELAY_SECONDS)
+                study_types_result = invoke_bedrock_retrieve_and_generate_with_retry(
+                    study_type_prompt, KB_ID, "study_names", base_retrieval_filter, f"Step 3 Study Types ({drug})"
+                )
+
+                study_to_files_map = {}
+                if study_types_result['text'] != 'LLM_DECLINED_TO_ASSIST':
+                    raw_text = study_types_result['text'].strip()
+                    if ':' in raw_text: raw_text = raw_text.split(':', 1)[1].strip()
+                    study_names = [s.strip() for s in raw_text.split(',') if s.strip()]
+
+                    citations = study_types_result.get('citations', [])
+                    for citation in citations:
+                        for ref in citation.get('retrievedReferences', []):
+                            file_name = ref.get('metadata', {}).get('file_name')
+                            if not file_name: continue
+
+                            for study_name in study_names:
+                                study_to_files_map.setdefault(study_name, set()).add(file_name)
+
+                if study_to_files_map:
+                    product['study_to_files_map'] = {k: list(v) for k, v in study_to_files_map.items()}
+                    state["productsReady"].append(product)
+                    print(f"Found study-to-file map for {drug}: {product['study_to_files_map']}")
+                else:
+                    print(f"No valid study types found for {drug}")
+                state["studyTypesDone"] += 1
+                save_checkpoint(ckpt_key, state)
+
+            if not state["productsReady"]:
+                return finish_early("Found products, but could not identify specific study types for them.")
 
-        if not products_ready_for_summary_iteration:
-            return_payload["message"] = "Found products, but could not identify specific study types for them."
-            return {"statusCode": 200, "body": json.dumps(return_payload)}
+            state.update({"step": "summaries", "completedStudies": {}})
+            save_checkpoint(ckpt_key, state)
 
         # 5. GENERATE DETAILED SUMMARIES
         print("Step 4: Generating detailed summaries…")
-        for product_data in products_ready_for_summary_iteration:
+        product_overviews_for_output = []
+        completed_studies = state["completedStudies"]
+        for product_data in state["productsReady"]:
             drug = product_data["drug_name"]
-            company = product_data["normalized_company_name"]
-            moa = product_data["mechanism_of_action"]
-            roa = product_data["route_of_administration"]
-            study_map = product_data.get('study_to_files_map', {})
-            
             product_overviews_for_output.append({
-                "drug_name": drug, "company_name": company,
-                "mechanism_of_action": moa, "route_of_administration": roa
+                "drug_name": drug, "company_name": product_data["normalized_company_name"],
+                "mechanism_of_action": product_data["mechanism_of_action"], "route_of_administration": product_data["route_of_administration"]
             })
 
-            for study, source_files in study_map.items():
+            for study, source_files in product_data.get('study_to_files_map', {}).items():
+                study_ckpt_id = f"{drug}||{study}"
+                if study_ckpt_id in completed_studies:
+                    continue
+                if deadline_reached(context): return suspend()
                 print(f"\n--- Processing {drug} / {study} (Sources: {source_files}) ---")
-                
-                # --- FIX: Changed 'values' to 'value' ---
-                dynamic_filter = {
-                    'andAll': [
-                        {'equals': {'key': 'user_id', 'value': user_id}},
-                        {'equals': {'key': 'folder_id', 'value': folder_id}},
-                        {'in': {'key': 'file_name', 'value': source_files}}
-                    ]
-                }
-                
-                summary_doc = {"ProductOverview": {"DrugName": drug, "Company": company, "MechanismOfAction": moa, "RouteOfAdministration": roa}, "StudyDetails": {"StudyType": study}}
-                all_citations = []
-                
-                prompt1_schema = {sec: {k: "" for k in keys} for sec, keys in SECTION_BUCKETS_PART1.items()}
-                prompt1 = f'For **{drug}** ({study}), extract the fields. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt1_schema, indent=2)}\n\nOutput **only** the JSON.'
-                resp1 = invoke_bedrock_retrieve_and_generate_with_retry(prompt1, KB_ID, model_arn, dynamic_filter, f"Step4-Part1({drug}/{study})")
-                all_citations.extend(resp1.get("citations", [])); data1 = extract_json_from_response(resp1["text"]) or {}
+                key, _ = summarize_study(user_id, folder_id, product_data, study, source_files, event.get('schema'))
+                completed_studies[study_ckpt_id] = key
+                save_checkpoint(ckpt_key, state)
 
-                time.sleep(PACING_DELAY_SECONDS)
-                
-                prompt2_schema = {sec: {k: "" for k in keys} for sec, keys in SECTION_BUCKETS_PART2.items()}
-                prompt2 = f'For **{drug}** ({study}), extract the fields. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt2_schema, indent=2)}\n\nOutput **only** the JSON.'
-                resp2 = invoke_bedrock_retrieve_and_generate_with_retry(prompt2, KB_ID, model_arn, dynamic_filter, f"Step4-Part2({drug}/{study})")
-                all_citations.extend(resp2.get("citations", [])); data2 = extract_json_from_response(resp2["text"]) or {}
-                
-                time.sleep(PACING_DELAY_SECONDS)
-
-                prompt3_schema = {sec: {k: "" for k in keys} for sec, keys in METADATA_BUCKET.items()}
-                prompt3 = f'For study "{study}" ({drug}), extract metadata. It is critically important to output a complete and valid JSON. Schema:\n\n{json.dumps(prompt3_schema, indent=2)}\n\nOutput **only** the JSON.'
-                resp3 = invoke_bedrock_retrieve_and_generate_with_retry(prompt3, KB_ID, model_arn, dynamic_filter, f"Step4-GMetadata({drug}/{study})")
-                all_citations.extend(resp3.get("citations", [])); data3 = extract_json_from_response(resp3["text"]) or {}
-                
-                # Assemble the final document
-                all_clinical_data = {**data1, **data2}
-                all_sections = {**SECTION_BUCKETS_PART1, **SECTION_BUCKETS_PART2}
-                for sec, keys in all_sections.items():
-                    bucket, mapped = all_clinical_data.get(sec, {}), {}
-                    if isinstance(bucket, dict):
-                        for llm_key, val in bucket.items():
-                            if llm_key in KEY_MAP_DEFINITION: _, fld = KEY_MAP_DEFINITION[llm_key]; mapped[fld] = val
-                    summary_doc[sec] = mapped
-
-                metadata_summary_mapped = {}
-                for sec, keys in METADATA_BUCKET.items():
-                    bucket = data3.get(sec, {})
-                    if isinstance(bucket, dict): metadata_summary_mapped.update(bucket)
-                summary_doc["trialMetadataSummary"] = metadata_summary_mapped
-                summary_doc["Citations"] = all_citations
-
-                # Save file
-                ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"); safe_study_name = sanitize_filename(study)
-                session_part, run_part = folder_id.split('/', 1) if '/' in folder_id else (folder_id, "")
-                prefix = f"{S3_SUMMARY_PREFIX}/{user_id}/{session_part}"; 
-                if run_part: prefix = f"{prefix}/{run_part}"
-                key = f"{prefix}/summary_{safe_study_name}_{ts}.json"
-                s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=json.dumps(summary_doc, indent=2).encode("utf-8"), ContentType="application/json")
-                print("     ✅ Saved", key)
-                all_summary_files.append(key); aggregated_results_for_frontend.append(summary_doc); text_summaries_generated_count += 1
-        
         # 6. FINALIZE AND RETURN
-        return_payload.update({"textSummariesGenerated": text_summaries_generated_count, "summaryS3Keys": all_summary_files, "structuredSummaries": aggregated_results_for_frontend, "productOverviews": list({tuple(sorted(po.items())): po for po in product_overviews_for_output}.values()), "message": f"Processing complete. Generated {text_summaries_generated_count} summaries."})
-        return return_payload
+        # Only the S3 keys are returned; the summaries themselves would not fit
+        # in a Step Functions payload (256 KB) for a large folder.
+        all_summary_files = list(completed_studies.values())
+        text_summaries_generated_count = len(all_summary_files)
+        print(f"Model stats: {json.dumps(bedrock_router.summary())}")
+        return_payload.update({"textSummariesGenerated": text_summaries_generated_count, "summaryS3Keys": all_summary_files, "productOverviews": list({tuple(sorted(po.items())): po for po in product_overviews_for_output}.values()), "message": f"Processing complete. Generated {text_summaries_generated_count} summaries."})
+        return finish(return_payload)
 
     except Exception as e_critical:
         critical_error = f"Critical error during lambda execution: {e_critical}"; print(critical_error); import traceback; traceback.print_exc()
         return_payload["errorDetails"] = critical_error; return_payload["message"] = "A critical error occurred."
-        raise e_critical
\ No newline at end of file
+        raise e_critical
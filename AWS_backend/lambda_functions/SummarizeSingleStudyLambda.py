@@ -1,14 +1,31 @@
 import os
 import re
 import json
+import hashlib
 import random
+import threading
 import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime, timezone
 import boto3
+from model_router import ModelRouter  # docrag_shared layer
+from change_version import bump_change_version, bump_change_versions  # docrag_shared layer
+from file_status import INGESTED, SUMMARIZED, SUMMARIZING, StatusWriter, file_key  # docrag_shared layer
+from folder_counters import apply_folder_counters  # docrag_shared layer
+from retrieval import (  # docrag_shared layer
+    RERANK_TOKEN_BUDGET, build_passage_prompt, field_token_budget, passage_citations, rerank, rerank_pool_size,
+    retrieval_depth, section_terms
+)
+from json_extraction import missing_sections, parse_json_object, stage_counts  # docrag_shared layer
+from summary_pointers import record_summary, study_scope  # docrag_shared layer
+from schema_registry import KEY_MAP, METADATA_PART, clinical_sections, get_schema, prune_sections, schema_tag  # docrag_shared layer
 
 # AWS clients
 bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime')
+bedrock_runtime_client = boto3.client('bedrock-runtime')
 s3_client = boto3.client('s3')
+dynamodb_resource = boto3.resource('dynamodb')
 
 # Environment Variables
 KB_ID                 = os.environ['KB_ID']
@@ -16,122 +33,250 @@ SUMMARY_MODEL_ID      = os.environ['BEDROCK_SUMMARY_MODEL_ID']
 S3_BUCKET_NAME        = os.environ['S3_BUCKET_NAME']
 S3_SUMMARY_PREFIX     = os.environ.get('S3_SUMMARY_PREFIX', 'folder-summaries')
 AWS_REGION            = os.environ.get('AWS_REGION', boto3.session.Session().region_name)
+DYNAMODB_TABLE_NAME   = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
+file_metadata_table   = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
 
 # Configuration
 MAX_RETRIES           = 3
 BASE_SLEEP_SECONDS    = 3
-PACING_DELAY_SECONDS  = 1.0
-
-# --- Schema definitions (unchanged) ---
-KEY_MAP_DEFINITION = {
-    "PRODUCT_OVERVIEW_DRUG_NAME": ("ProductOverview", "DrugName"),
-    "PRODUCT_OVERVIEW_MECHANISM_OF_ACTION": ("ProductOverview", "MechanismOfAction"),
-    "PRODUCT_OVERVIEW_ROUTE_OF_ADMINISTRATION": ("ProductOverview", "RouteOfAdministration"),
-    "PRODUCT_OVERVIEW_COMPANY": ("ProductOverview", "Company"),
-    "PRODUCT_OVERVIEW_LONG_TERM_REGISTRY_NUMBER": ("ProductOverview", "LongTermClinicalTrialRegistryNumber"),
-    "STUDY_DETAILS_STUDY_TYPE": ("StudyDetails", "StudyType"),
-    "STUDY_DETAILS_REGISTRY_NUMBER": ("StudyDetails", "ClinicalTrialRegistryNumber"),
-    "STUDY_DETAILS_LONG_TERM_DETAILS": ("StudyDetails", "LongTermStudyDetails"),
-    "STUDY_DETAILS_DESIGN": ("StudyDetails", "StudyDesign"),
-    "STUDY_DETAILS_ELIGIBILITY_CRITERIA": ("StudyDetails", "EligibilityCriteria"),
-    "STUDY_DETAILS_TRIAL_DURATION_WEEKS": ("StudyDetails", "TrialDurationWeeks"),
-    "STUDY_DETAILS_NUMBER_OF_PATIENTS": ("StudyDetails", "NumberOfPatients"),
-    "STUDY_DETAILS_STATUS": ("StudyDetails", "StudyStatus"),
-    "EFFICACY_PRIMARY_ENDPOINTS": ("EfficacyEndpoints", "PrimaryEndpoints"),
-    "EFFICACY_SECONDARY_ENDPOINTS": ("EfficacyEndpoints", "SecondaryEndpoints"),
-    "EFFICACY_EXPLORATORY_ENDPOINTS": ("EfficacyEndpoints", "ExploratoryEndpoints"),
-    "ATTACK_RATES_MEAN_HAE_PER_MONTH": ("AttackRates", "MeanHAEAttacksPerMonth"),
-    "ATTACK_RATES_LSM_HAE_PER_MONTH": ("AttackRates", "LSMHAEAttacksPerMonth"),
-    "ATTACK_RATES_MEDIAN_HAE_PER_MONTH": ("AttackRates", "MedianHAEAttacksPerMonth"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_VS_PLACEBO": ("AttackRates", "PercentReductionMeanActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_LSM_VS_PLACEBO": ("AttackRates", "PercentReductionLSMActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_VS_PLACEBO": ("AttackRates", "PercentReductionMedianActiveVsPlacebo"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "PercentReductionMeanFromBaseline"),
-    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE": ("AttackRates", "PercentReductionMedianFromBaseline"),
-    "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "NumericalReductionMeanFromBaseline"),
-    "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN": ("AttackRates", "PercentPatients100ReductionVsRunIn"),
-    "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION": ("AttackRates", "PercentPatients90PlusReduction"),
-    "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION": ("AttackRates", "PercentPatients70PlusReduction"),
-    "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION": ("AttackRates", "PercentPatients50PlusReduction"),
-    "ATTACK_RATES_OTHER_TIME_FRAMES": ("AttackRates", "AttackRateOtherTimeFrames"),
-    "ATTACK_RATES_BY_BASELINE_RATE": ("AttackRates", "AttackRateByBaselineRate"),
-    "RESCUE_MED_MEAN_PER_MONTH": ("RescueMedicationUse", "MeanRescueMedicationsPerMonth"),
-    "RESCUE_MED_ATTACKS_REQUIRING_RESCUE": ("RescueMedicationUse", "AttacksPerMonthRequiringRescue"),
-    "ATTACK_PARAMETERS_SEVERITY": ("AttackParameters", "SeverityOfAttacks"),
-    "ATTACK_PARAMETERS_DURATION": ("AttackParameters", "DurationOfAttacks"),
-    "ATTACK_PARAMETERS_DAYS_SWELLING": ("AttackParameters", "DaysOfSwellingSymptoms"),
-    "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK": ("AttackParameters", "TimeToFirstAttack"),
-    "ATTACK_PARAMETERS_BY_LOCATION": ("AttackParameters", "AttacksByLocation"),
-    "PRO_DATA_AE_QOL_CHANGE": ("PatientReportedOutcomes", "AEQOLScoreChange"),
-    "PRO_DATA_PERCENT_GOOD_ON_SGART": ("PatientReportedOutcomes", "PercentRatingGoodOnSGART"),
-    "PRO_DATA_AECT_SCORE_WEEK_25": ("PatientReportedOutcomes", "AECTScoreWeek25"),
-    "PRO_DATA_TSQM_DETAILS": ("PatientReportedOutcomes", "TSQMDetails"),
-    "PK_PD_SUMMARY": ("PharmacokineticsPharmacodynamics", "PKPDDataSummary"),
-    "ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS": ("AdditionalExploratoryEndpointsDetails", "Details"),
-    "REFERENCES_LIST": ("ReferencesAndFootnotes", "ReferencesList"),
-    "FOOTNOTES_LIST": ("ReferencesAndFootnotes", "FootnotesList")
-}
-
-SECTION_BUCKETS_PART1 = {
-    "EfficacyEndpoints": [
-        "EFFICACY_PRIMARY_ENDPOINTS",
-        "EFFICACY_SECONDARY_ENDPOINTS",
-        "EFFICACY_EXPLORATORY_ENDPOINTS"
-    ],
-    "AttackRates": [
-        "ATTACK_RATES_MEAN_HAE_PER_MONTH",
-        "ATTACK_RATES_LSM_HAE_PER_MONTH",
-        "ATTACK_RATES_MEDIAN_HAE_PER_MONTH",
-        "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE",
-        "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE",
-        "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE",
-        "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN",
-        "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION",
-        "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION",
-        "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION",
-        "ATTACK_RATES_OTHER_TIME_FRAMES",
-        "ATTACK_RATES_BY_BASELINE_RATE"
-    ],
-    "AttackParameters": [
-        "ATTACK_PARAMETERS_SEVERITY",
-        "ATTACK_PARAMETERS_DURATION",
-        "ATTACK_PARAMETERS_DAYS_SWELLING",
-        "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK",
-        "ATTACK_PARAMETERS_BY_LOCATION"
-    ],
-}
-
-SECTION_BUCKETS_PART2 = {
-    "StudyDetails": [
-        "STUDY_DETAILS_STUDY_TYPE",
-        "STUDY_DETAILS_REGISTRY_NUMBER",
-        "STUDY_DETAILS_LONG_TERM_DETAILS",
-        "STUDY_DETAILS_DESIGN",
-        "STUDY_DETAILS_ELIGIBILITY_CRITERIA",
-        "STUDY_DETAILS_TRIAL_DURATION_WEEKS",
-        "STUDY_DETAILS_NUMBER_OF_PATIENTS",
-        "STUDY_DETAILS_STATUS"
-    ],
-    "PatientReportedOutcomes": [
-        "PRO_DATA_AE_QOL_CHANGE",
-        "PRO_DATA_PERCENT_GOOD_ON_SGART",
-        "PRO_DATA_AECT_SCORE_WEEK_25",
-        "PRO_DATA_TSQM_DETAILS"
-    ],
-    "RescueMedicationUse": [
-        "RESCUE_MED_MEAN_PER_MONTH",
-        "RESCUE_MED_ATTACKS_REQUIRING_RESCUE"
-    ],
-    "PharmacokineticsPharmacodynamics": ["PK_PD_SUMMARY"],
-    "AdditionalExploratoryEndpointsDetails": ["ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS"],
-    "ReferencesAndFootnotes": ["REFERENCES_LIST", "FOOTNOTES_LIST"],
-}
-
-METADATA_BUCKET = {
-    "TrialAndProduct": ["NCT", "TrialName", "ProductName", "StartDate", "EndDate", "MechanismOfAction"],
-    "PatientCriteria": ["Age", "HAESubtype", "GeographicalLocation", "SexRestriction", "EthnicityRaceRestriction", "OtherRelevantRestriction"],
-    "Documentation": ["References", "Footnotes"]
-}
+BEDROCK_MAX_CONCURRENCY     = int(os.environ.get('BEDROCK_MAX_CONCURRENCY', 3))
+BEDROCK_REQUESTS_PER_SECOND = float(os.environ.get('BEDROCK_REQUESTS_PER_SECOND', 1.0))
+BEDROCK_HEDGING             = os.environ.get('BEDROCK_HEDGING', 'false').lower() == 'true'
+HEDGE_LATENCY_PERCENTILE    = float(os.environ.get('BEDROCK_HEDGE_PERCENTILE', 95))
+HEDGE_MIN_SAMPLES           = int(os.environ.get('BEDROCK_HEDGE_MIN_SAMPLES', 20))
+HEDGE_WINDOW_SIZE           = int(os.environ.get('BEDROCK_HEDGE_WINDOW_SIZE', 200))
+HEDGE_BUDGET_PER_FOLDER     = int(os.environ.get('BEDROCK_HEDGE_BUDGET_PER_FOLDER', 20))
+LOCAL_RERANK                = os.environ.get('LOCAL_RERANK', 'false').lower() == 'true'
+SCHEMA_PRUNING              = os.environ.get('SCHEMA_PRUNING', 'false').lower() == 'true'
+JSON_REASK_MAX              = int(os.environ.get('JSON_REASK_MAX', 1))
+
+FOLDER_ITEM_SESSION_MARKER  = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+
+# --- Rate limiting ---
+class RateLimiter:
+    """Thread-safe token bucket shared by every Bedrock call in this invocation."""
+
+    def __init__(self, rate_per_second, burst=1):
+        self.rate = rate_per_second
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def try_acquire(self):
+        """Takes a token only if one is available right now."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+bedrock_rate_limiter = RateLimiter(BEDROCK_REQUESTS_PER_SECOND)
+bedrock_router = ModelRouter(
+    bedrock_agent_runtime_client, region=AWS_REGION, default_model=SUMMARY_MODEL_ID,
+    runtime_client=bedrock_runtime_client
+)
+
+
+# --- Usage counters ---
+class FolderCallCounter:
+    """
+    Bedrock requests made per (userId, folderId), retries and hedges
+    included. They are added to the folders' bedrockCalls counters once per
+    invocation instead of once per request (see folder_counters).
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, scope):
+        if scope is None:
+            return
+        with self.lock:
+            self.calls[scope] += 1
+
+    def flush(self):
+        with self.lock:
+            calls, self.calls = self.calls, Counter()
+        if not calls:
+            return
+        try:
+            usage = apply_folder_counters(file_metadata_table, {scope: Counter(bedrockCalls=n) for scope, n in calls.items()})
+            bump_change_versions(file_metadata_table, [user_id for user_id, _ in calls], usage)
+        except Exception as e:
+            print(f"⚠️ Could not record Bedrock call counts: {e}")
+
+
+bedrock_calls = FolderCallCounter()
+file_statuses = StatusWriter(file_metadata_table)
+
+
+def mark_source_files(study_event, status, from_statuses=(INGESTED, SUMMARIZING, SUMMARIZED)):
+    """
+    Buffers the status of the files the study cites (see file_status).
+    sourceFiles are the KB's file names, so only files at the top of the
+    folder are found; rows that do not exist, failed to ingest or were
+    deleted are left alone, as are rows in a status not in from_statuses.
+    """
+    for file_name in study_event.get('sourceFiles') or ():
+        file_statuses.emit(file_key(study_event['userId'], study_event['folderId'], file_name), status,
+                           from_statuses=from_statuses)
+
+
+def release_source_files(study_event):
+    """Returns the files of a study that did not finish to ingested; files another study summarized keep that."""
+    mark_source_files(study_event, INGESTED, from_statuses=(SUMMARIZING,))
+
+
+# --- Request hedging ---
+class LatencyTracker:
+    """Rolling window of successful Bedrock call latencies, kept for the life of the container."""
+
+    def __init__(self, window_size):
+        self.samples = deque(maxlen=window_size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        """None until HEDGE_MIN_SAMPLES calls have been seen; hedging waits for a baseline."""
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class HedgeBudget:
+    """
+    Caps duplicate requests per folder run. The count lives on the folder item
+    (hedgesIssued, reset by admission.reset_progressive_summary when the run is
+    started) so every batch of the run draws from the same budget; hedgesWon
+    counts the duplicates that answered first. The counters do not bump the user's change version; the
+    listing picks them up with the next progressive summary.
+
+    issued/won count this invocation only (reset() at the start of each);
+    the run's totals are the folder item's.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.exhausted = set()
+        self.issued = 0
+        self.won = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def folder_key(scope):
+        user_id, folder_id = scope
+        return {'userId': user_id, 'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"}
+
+    def claim(self, scope):
+        if scope is None or scope in self.exhausted:
+            return False
+        try:
+            file_metadata_table.update_item(
+                Key=self.folder_key(scope),
+                UpdateExpression="ADD hedgesIssued :one",
+                ConditionExpression="attribute_not_exists(hedgesIssued) OR hedgesIssued < :limit",
+                ExpressionAttributeValues={':one': 1, ':limit': self.limit}
+            )
+        except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+            print(f"Hedge budget of {self.limit} used up for folder {scope[1]}.")
+            self.exhausted.add(scope)
+            return False
+        except Exception as e:
+            print(f"⚠️ Could not claim hedge budget: {e}")
+            return False
+        with self.lock:
+            self.issued += 1
+        return True
+
+    def record_win(self, scope):
+        with self.lock:
+            self.won += 1
+        try:
+            file_metadata_table.update_item(
+                Key=self.folder_key(scope),
+                UpdateExpression="ADD hedgesWon :one",
+                ExpressionAttributeValues={':one': 1}
+            )
+        except Exception as e:
+            print(f"⚠️ Could not record hedge win: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"hedgesIssued": self.issued, "hedgesWon": self.won}
+
+    def reset(self):
+        """Starts this invocation's counts; a warm container keeps the instance."""
+        with self.lock:
+            self.issued = 0
+            self.won = 0
+            self.exhausted.clear()
+
+
+bedrock_latency = LatencyTracker(HEDGE_WINDOW_SIZE)
+hedge_budget = HedgeBudget(HEDGE_BUDGET_PER_FOLDER)
+# Losing requests cannot be cancelled and run to completion here, hence the headroom
+hedge_executor = ThreadPoolExecutor(max_workers=max(4, 4 * BEDROCK_MAX_CONCURRENCY))
+
+
+def timed_call(fn):
+    start = time.monotonic()
+    result = fn()
+    bedrock_latency.record(time.monotonic() - start)
+    return result
+
+def call_with_hedge(fn, scope, desc):
+    """
+    Runs fn; if it is still pending after the rolling p95 latency, issues one
+    duplicate (when the rate limiter has a token to spare and the folder's
+    hedge budget allows) and returns whichever response arrives first. The
+    other response is discarded.
+    """
+    primary = hedge_executor.submit(timed_call, fn)
+    threshold = bedrock_latency.percentile(HEDGE_LATENCY_PERCENTILE)
+    if threshold is None:
+        return primary.result()
+    done, _ = wait([primary], timeout=threshold)
+    if done or not bedrock_rate_limiter.try_acquire() or not hedge_budget.claim(scope):
+        return primary.result()
+
+    print(f"Hedging {desc}: no response after {threshold:.1f}s (p{HEDGE_LATENCY_PERCENTILE:g}).")
+    bedrock_calls.record(scope)
+    hedge = hedge_executor.submit(timed_call, fn)
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    hedge_budget.record_win(scope)
+                return future.result()
+            first_error = first_error or future.exception()
+    raise first_error
 
 # --- Helpers ---
 def sanitize_filename(s):
@@ -141,117 +286,239 @@ def sanitize_filename(s):
     s = re.sub(r'_+', '_', s)
     return s.strip('_.- ') or "unnamed"
 
-def extract_json_from_response(text):
-    try:
-        start = text.find('{')
-        end   = text.rfind('}')
-        if start != -1 and end > start:
-            return json.loads(text[start:end+1])
-    except Exception:
-        pass
-    return {}
+def reference_id(ref):
+    """Stable ID for a retrieved chunk: hash of its source location and text."""
+    location = json.dumps(ref.get("location", {}), sort_keys=True)
+    text = (ref.get("content") or {}).get("text", "")
+    return hashlib.sha1(f"{location}\n{text}".encode("utf-8")).hexdigest()[:16]
+
+def normalize_citations(citation_lists):
+    """
+    Moves every retrieved chunk into one reference table and leaves only
+    reference IDs on the citations. The three prompts retrieve from the same
+    study files, so most chunks would otherwise be stored up to three times.
+    Returns (citations, references).
+    """
+    references = {}
+    citations = {}
+    for name, citation_list in citation_lists.items():
+        slim = []
+        for citation in citation_list or []:
+            ref_ids = []
+            for ref in citation.get("retrievedReferences", []):
+                ref_id = reference_id(ref)
+                references.setdefault(ref_id, ref)
+                if ref_id not in ref_ids:
+                    ref_ids.append(ref_id)
+            slim.append({
+                "generatedResponsePart": citation.get("generatedResponsePart", {}),
+                "referenceIds": ref_ids
+            })
+        citations[name] = slim
+    return citations, references
+
+EXTRACTION_SYSTEM_PROMPT = (
+    "You extract clinical trial data from the numbered passages given by the user. "
+    "Use only facts stated in those passages and leave a field empty when they do not cover it."
+)
+
+# Stand-in response for a part whose sections were all pruned
+SKIPPED_RESPONSE = {'output': {'text': '{}'}, 'citations': [], 'data': {}}
+
+
+def is_throttling(error):
+    return isinstance(error, (
+        bedrock_agent_runtime_client.exceptions.ThrottlingException,
+        bedrock_runtime_client.exceptions.ThrottlingException
+    ))
+
+
+def generate_from_passages(task, prompt_text, passages, desc):
+    """Converse over preselected passages, answered in RetrieveAndGenerate's shape."""
+    response = bedrock_router.converse(task, EXTRACTION_SYSTEM_PROMPT, build_passage_prompt(prompt_text, passages), desc)
+    text = "".join(block.get('text', '') for block in response['output']['message']['content'])
+    return {'output': {'text': text}, 'citations': passage_citations(text, passages)}
+
+
+def invoke_bedrock_with_retry(prompt_text, filt, desc, hedge_scope=None, task="extraction", passages=None,
+                              field_count=0):
+    """
+    task selects the model route (see model_router). hedge_scope is the
+    (userId, folderId) whose hedge budget a duplicate request draws from.
+    With passages (local re-ranking), the prompt is answered from those
+    passages instead of a knowledge-base retrieval. field_count, the number
+    of fields the prompt asks for, sizes the retrieval (see retrieval).
+    """
+    def request():
+        if passages:
+            return generate_from_passages(task, prompt_text, passages, desc)
+        return bedrock_router.retrieve_and_generate(
+            task, prompt_text, KB_ID, {'filter': filt, 'numberOfResults': retrieval_depth(task, field_token_budget(field_count))}, desc
+        )
 
-def invoke_bedrock_with_retry(prompt_text, filt, desc):
-    model_arn = SUMMARY_MODEL_ID if SUMMARY_MODEL_ID.startswith("arn:") else f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{SUMMARY_MODEL_ID}"
     for attempt in range(MAX_RETRIES):
+        bedrock_rate_limiter.acquire()
+        bedrock_calls.record(hedge_scope)
         try:
-            return bedrock_agent_runtime_client.retrieve_and_generate(
-                input={'text': prompt_text},
-                retrieveAndGenerateConfiguration={
-                    'type': 'KNOWLEDGE_BASE',
-                    'knowledgeBaseConfiguration': {
-                        'knowledgeBaseId': KB_ID,
-                        'modelArn': model_arn,
-                        'retrievalConfiguration': {
-                            'vectorSearchConfiguration': {'filter': filt, 'numberOfResults': 30}
-                        }
-                    }
-                }
+            if BEDROCK_HEDGING:
+                return call_with_hedge(request, hedge_scope, desc)
+            return timed_call(request)
+        except Exception as e:
+            if not is_throttling(e):
+                raise
+            if attempt < MAX_RETRIES - 1:
+                sleep_time = BASE_SLEEP_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+                print(f"ThrottlingException during {desc}. Retrying in {sleep_time:.2f}s...")
+                time.sleep(sleep_time)
+            else:
+                raise
+
+
+def retrieve_study_passages(study_event, filt, schema):
+    """
+    Local re-ranking / schema pruning: one Retrieve call with a large k for
+    the whole study. Each part then prunes its sections and picks its own
+    passages from this pool.
+    """
+    query = " ".join([
+        study_event['drugName'], study_event['studyName'],
+        *(section for sections in schema["parts"].values() for section in sections)
+    ])
+    pool_size = rerank_pool_size(sum(count_fields(sections) for sections in schema["parts"].values()))
+    for attempt in range(MAX_RETRIES):
+        bedrock_rate_limiter.acquire()
+        bedrock_calls.record((study_event['userId'], study_event['folderId']))
+        try:
+            response = bedrock_agent_runtime_client.retrieve(
+                knowledgeBaseId=KB_ID,
+                retrievalQuery={'text': query},
+                retrievalConfiguration={'vectorSearchConfiguration': {'filter': filt, 'numberOfResults': pool_size}}
             )
+            return response.get('retrievalResults', [])
         except bedrock_agent_runtime_client.exceptions.ThrottlingException:
             if attempt < MAX_RETRIES - 1:
                 sleep_time = BASE_SLEEP_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+                print(f"ThrottlingException during Retrieve({study_event['studyName']}). Retrying in {sleep_time:.2f}s...")
                 time.sleep(sleep_time)
             else:
                 raise
-        except Exception:
-            raise
 
-# --- Lambda entry point ---
-def lambda_handler(event, context):
-    user_id      = event['userId']
-    folder_id    = event['folderId']
-    drug         = event['drugName']
-    company      = event['companyName']
-    moa          = event['mechanismOfAction']
-    study        = event['studyName']
-    source_files = event['sourceFiles']
-
-    # Build the Bedrock filter
-    dynamic_filter = {'andAll': [
-        {'equals': {'key': 'user_id',    'value': user_id}},
-        {'equals': {'key': 'folder_id',  'value': folder_id}},
-        {'in':     {'key': 'file_name',  'value': source_files}}
+
+def count_fields(sections):
+    """Fields asked for by a part's {section: [fields]}."""
+    return sum(len(fields) for fields in sections.values())
+
+
+def extract_part(study_event, schema, part, filt, scope, pool_future=None):
+    """
+    One extraction prompt. With a passage pool, sections without evidence in
+    it are left out of the schema (SCHEMA_PRUNING) and only the passages
+    ranked best for this part are sent (LOCAL_RERANK). Returns (response, prunedSections).
+    """
+    desc = f"{part}({study_event['studyName']})"
+    sections = schema["parts"][part]
+    passages, dropped = None, []
+    if pool_future is not None:
+        pool = pool_future.result()
+        if SCHEMA_PRUNING and pool:
+            sections, dropped = prune_sections(schema, part, pool)
+            if dropped:
+                print(f"{desc}: no evidence for {', '.join(dropped)} in {len(pool)} passages; not asked.")
+            if not sections:
+                return SKIPPED_RESPONSE, dropped
+        if LOCAL_RERANK:
+            terms = section_terms(sections, study_event['drugName'], study_event['studyName'])
+            passages = rerank(pool, terms, field_token_budget(count_fields(sections), RERANK_TOKEN_BUDGET))
+            print(f"{desc}: {len(passages)} of {len(pool)} retrieved passages kept after re-ranking.")
+    prompt = build_part_prompt(study_event, part, sections)
+    response = invoke_bedrock_with_retry(prompt, filt, desc, scope, passages=passages, field_count=count_fields(sections))
+    return complete_part_response(study_event, part, sections, response, filt, scope, passages), dropped
+
+
+def complete_part_response(study_event, part, sections, response, filt, scope, passages=None):
+    """
+    Parses the answer through the JSON cascade and re-asks, up to
+    JSON_REASK_MAX times, for only the sections that did not come back.
+    The parsed sections are attached as response['data'].
+    """
+    desc = f"{part}({study_event['studyName']})"
+    data, stage = parse_json_object(response['output']['text'])
+    if stage == "failed":
+        print(f"{desc}: no JSON object in the answer.")
+    elif stage != "strict":
+        print(f"{desc}: JSON recovered by {stage} parse.")
+    citations = list(response.get('citations', []))
+    for _ in range(JSON_REASK_MAX):
+        missing = missing_sections(data, sections)
+        if not missing:
+            break
+        print(f"{desc}: re-asking for {', '.join(missing)}.")
+        prompt = build_part_prompt(study_event, part, {sec: sections[sec] for sec in missing})
+        retry = invoke_bedrock_with_retry(
+            prompt, filt, f"{desc} re-ask", scope, passages=passages,
+            field_count=count_fields({sec: sections[sec] for sec in missing})
+        )
+        retry_data, _ = parse_json_object(retry['output']['text'])
+        data.update({sec: retry_data[sec] for sec in missing if isinstance(retry_data.get(sec), dict)})
+        citations.extend(retry.get('citations', []))
+    return {**response, 'citations': citations, 'data': data}
+
+# --- Per-study prompts and assembly ---
+def build_study_filter(study_event):
+    """Knowledge-base filter restricting retrieval to the study's source files."""
+    return {'andAll': [
+        {'equals': {'key': 'user_id',    'value': study_event['userId']}},
+        {'equals': {'key': 'folder_id',  'value': study_event['folderId']}},
+        {'in':     {'key': 'file_name',  'value': study_event['sourceFiles']}}
     ]}
 
+
+def build_part_prompt(study_event, part, sections):
+    """Extraction prompt for one part, asking only for the given sections."""
+    drug  = study_event['drugName']
+    study = study_event['studyName']
+    schema_json = json.dumps({sec: {k: "" for k in keys} for sec, keys in sections.items()}, indent=2)
+    if part == METADATA_PART:
+        return (
+            f'For study "{study}" ({drug}), extract metadata. '
+            "Output **only** valid JSON.\n\n"
+            f'{schema_json}'
+        )
+    return (
+        f'For **{drug}** ({study}), extract the fields. '
+        "Output **only** valid JSON.\n\n"
+        f'{schema_json}'
+    )
+
+
+def assemble_summary_doc(study_event, responses, schema, pruned=()):
+    study = study_event['studyName']
+    resp1, resp2, resp3 = responses["Part1"], responses["Part2"], responses["Metadata"]
+    data1, data2, data3 = resp1["data"], resp2["data"], resp3["data"]
+
     # Base document skeleton
     summary_doc = {
         "ProductOverview": {
-            "DrugName": drug,
-            "Company": company,
-            "MechanismOfAction": moa
+            "DrugName": study_event['drugName'],
+            "Company": study_event['companyName'],
+            "MechanismOfAction": study_event['mechanismOfAction']
         },
         "StudyDetails": {
             "StudyType": study
         }
     }
 
-    # Part 1: Efficacy + Attack Rates
-    prompt1_schema = {sec: {k: "" for k in keys} for sec, keys in SECTION_BUCKETS_PART1.items()}
-    prompt1 = (
-        f'For **{drug}** ({study}), extract the fields. '
-        "Output **only** valid JSON.\n\n"
-        f'{json.dumps(prompt1_schema, indent=2)}'
-    )
-    resp1 = invoke_bedrock_with_retry(prompt1, dynamic_filter, "Part1")
-    data1 = extract_json_from_response(resp1["output"]["text"])
-    citations1 = resp1.get("citations", [])
-    time.sleep(PACING_DELAY_SECONDS)
-
-    # Part 2: Study Details + Outcomes
-    prompt2_schema = {sec: {k: "" for k in keys} for sec, keys in SECTION_BUCKETS_PART2.items()}
-    prompt2 = (
-        f'For **{drug}** ({study}), extract the fields. '
-        "Output **only** valid JSON.\n\n"
-        f'{json.dumps(prompt2_schema, indent=2)}'
-    )
-    resp2 = invoke_bedrock_with_retry(prompt2, dynamic_filter, "Part2")
-    data2 = extract_json_from_response(resp2["output"]["text"])
-    citations2 = resp2.get("citations", [])
-    time.sleep(PACING_DELAY_SECONDS)
-
-    # Part 3: High-Level Metadata
-    prompt3_schema = {sec: {k: "" for k in keys} for sec, keys in METADATA_BUCKET.items()}
-    prompt3 = (
-        f'For study "{study}" ({drug}), extract metadata. '
-        "Output **only** valid JSON.\n\n"
-        f'{json.dumps(prompt3_schema, indent=2)}'
-    )
-    resp3 = invoke_bedrock_with_retry(prompt3, dynamic_filter, "Metadata")
-    data3 = extract_json_from_response(resp3["output"]["text"])
-    citations3 = resp3.get("citations", [])
-
     # Merge clinical data
     all_clinical = {**data1, **data2}
-    for section, keys in {**SECTION_BUCKETS_PART1, **SECTION_BUCKETS_PART2}.items():
-        top_key = KEY_MAP_DEFINITION[keys[0]][0]
+    for section, keys in clinical_sections(schema).items():
+        top_key = KEY_MAP[keys[0]][0]
         if top_key not in summary_doc:
             summary_doc[top_key] = {}
         bucket = all_clinical.get(section, {})
         if isinstance(bucket, dict):
             for llm_key, val in bucket.items():
-                if llm_key in KEY_MAP_DEFINITION:
-                    _, pretty = KEY_MAP_DEFINITION[llm_key]
+                if llm_key in KEY_MAP:
+                    _, pretty = KEY_MAP[llm_key]
                     summary_doc[top_key][pretty] = val
 
     # Override StudyType
@@ -259,38 +526,247 @@ def lambda_handler(event, context):
 
     # Merge metadata
     metadata_map = {}
-    for sec, keys in METADATA_BUCKET.items():
+    for sec in schema["parts"][METADATA_PART]:
         bucket = data3.get(sec, {})
         if isinstance(bucket, dict):
             metadata_map.update(bucket)
     summary_doc["trialMetadataSummary"] = metadata_map
 
-    # Citations
-    summary_doc["__citations__"] = {
-        "clinical_part1_citations": citations1,
-        "clinical_part2_citations": citations2,
-        "metadata_citations": citations3
-    }
+    # Citations: unique chunks live in __references__, sections point at them by ID
+    summary_doc["__citations__"], summary_doc["__references__"] = normalize_citations({
+        "clinical_part1_citations": resp1.get("citations", []),
+        "clinical_part2_citations": resp2.get("citations", []),
+        "metadata_citations": resp3.get("citations", [])
+    })
+    summary_doc["__schema__"] = schema_tag(schema, pruned)
+    return summary_doc
 
+
+def save_summary_doc(study_event, summary_doc):
     # Save JSON to S3
     ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-    safe_name = sanitize_filename(study)
-    parts = folder_id.split("/", 1)
-    prefix = f"{S3_SUMMARY_PREFIX}/{user_id}/{parts[0]}"
+    safe_name = sanitize_filename(study_event['studyName'])
+    parts = study_event['folderId'].split("/", 1)
+    prefix = f"{S3_SUMMARY_PREFIX}/{study_event['userId']}/{parts[0]}"
     if len(parts) > 1:
         prefix += f"/{parts[1]}"
     key = f"{prefix}/summary_{safe_name}_{ts}.json"
+    body = json.dumps(summary_doc, indent=2).encode("utf-8")
 
     s3_client.put_object(
         Bucket=S3_BUCKET_NAME,
         Key=key,
-        Body=json.dumps(summary_doc, indent=2).encode("utf-8"),
+        Body=body,
         ContentType="application/json"
     )
     print(f"✅ Saved summary to s3://{S3_BUCKET_NAME}/{key}")
+    try:
+        # Readers find the study's latest summary without listing the prefix (see summary_pointers)
+        record_summary(file_metadata_table, study_event['userId'], study_event['folderId'],
+                       study_scope(study_event['studyName']), key, len(body), {"studyName": study_event['studyName']})
+    except Exception as e:
+        print(f"⚠️ Could not record the summary pointer of {study_event['studyName']}: {e}")
+    return key
+
+
+def publish_progressive_summary(study_event, pointer):
+    """
+    Adds the study's pointer to the folder item's progressiveSummaries map as
+    soon as it is written, so list/summary endpoints can serve it before the
+    whole folder is aggregated. studiesCompleted only counts a study the first
+    time it shows up in the map; a re-summarized study just replaces its pointer.
+    Either way the study leaves failedStudies.
+    """
+    folder_key = {
+        'userId': study_event['userId'],
+        'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{study_event['folderId']}#{FOLDER_ITEM_FILENAME_MARKER}"
+    }
+    entry = {**pointer, "completedAtUtc": datetime.now(timezone.utc).isoformat()}
+    names = {'#ps': 'progressiveSummaries', '#study': study_event['studyName'], '#failed': 'failedStudies'}
+    study = {study_event['studyName']}
+    client_exceptions = dynamodb_resource.meta.client.exceptions
+    try:
+        for _ in range(2):
+            try:
+                file_metadata_table.update_item(
+                    Key=folder_key,
+                    UpdateExpression="SET #ps.#study = :entry ADD studiesCompleted :one DELETE #failed :study",
+                    ConditionExpression="attribute_exists(#ps) AND attribute_not_exists(#ps.#study)",
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues={':entry': entry, ':one': 1, ':study': study}
+                )
+                bump_change_version(file_metadata_table, study_event['userId'])
+                return
+            except client_exceptions.ConditionalCheckFailedException:
+                pass
+            try:
+                # Already counted: point at the newer summary
+                file_metadata_table.update_item(
+                    Key=folder_key,
+                    UpdateExpression="SET #ps.#study = :entry DELETE #failed :study",
+                    ConditionExpression="attribute_exists(#ps.#study)",
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues={':entry': entry, ':study': study}
+                )
+                bump_change_version(file_metadata_table, study_event['userId'])
+                return
+            except client_exceptions.ConditionalCheckFailedException:
+                # No progressive map yet for this folder (run not started via InitiateFolderProcessing)
+                file_metadata_table.update_item(
+                    Key=folder_key,
+                    UpdateExpression="SET #ps = if_not_exists(#ps, :empty)",
+                    ExpressionAttributeNames={'#ps': 'progressiveSummaries'},
+                    ExpressionAttributeValues={':empty': {}}
+                )
+    except Exception as e:
+        # Progressive results are best effort; the aggregate at the end is authoritative
+        print(f"⚠️ Could not publish progressive summary for {study_event['studyName']}: {e}")
+
+
+def record_study_failure(study_event):
+    """Adds the study to the folder item's failedStudies set; a retried failure is not counted twice."""
+    try:
+        file_metadata_table.update_item(
+            Key=HedgeBudget.folder_key((study_event['userId'], study_event['folderId'])),
+            UpdateExpression="ADD failedStudies :study",
+            ExpressionAttributeValues={':study': {study_event['studyName']}}
+        )
+    except Exception as e:
+        print(f"⚠️ Could not record the failure of {study_event['studyName']}: {e}")
+
+
+def summarize_studies(studies):
+    """
+    Schedules the extraction prompts of every study through one shared,
+    rate-limited executor. Each summary is written to S3 as soon as its last
+    prompt finishes. Returns (pointers, failures).
+    """
+    pending = {idx: {} for idx in range(len(studies))}
+    pruned = {}
+    failed = {}
+    pointers = []
+    for study_event in studies:
+        mark_source_files(study_event, SUMMARIZING)
+    file_statuses.flush()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, BEDROCK_MAX_CONCURRENCY)) as executor:
+            schemas = [get_schema(study_event.get('schema')) for study_event in studies]
+            filters = [build_study_filter(study_event) for study_event in studies]
+            # Pools are submitted before any part so no worker waits on a retrieval still queued behind it.
+            pools = {}
+            if LOCAL_RERANK or SCHEMA_PRUNING:
+                for idx, study_event in enumerate(studies):
+                    pools[idx] = executor.submit(retrieve_study_passages, study_event, filters[idx], schemas[idx])
+
+            futures = {}
+            for idx, study_event in enumerate(studies):
+                scope = (study_event['userId'], study_event['folderId'])
+                for part in schemas[idx]["parts"]:
+                    futures[executor.submit(
+                        extract_part, study_event, schemas[idx], part, filters[idx], scope, pools.get(idx)
+                    )] = (idx, part)
+
+            for future in as_completed(futures):
+                idx, part = futures[future]
+                if idx in failed:
+                    continue
+                study_event = studies[idx]
+                try:
+                    pending[idx][part], dropped = future.result()
+                    pruned.setdefault(idx, []).extend(dropped)
+                    if len(pending[idx]) < len(schemas[idx]["parts"]):
+                        continue
+                    summary_doc = assemble_summary_doc(study_event, pending.pop(idx), schemas[idx], pruned.pop(idx))
+                    key = save_summary_doc(study_event, summary_doc)
+                    pointers.append({"s3_key": key, "studyName": study_event['studyName']})
+                    publish_progressive_summary(study_event, pointers[-1])
+                    mark_source_files(study_event, SUMMARIZED)
+                except Exception as e:
+                    print(f"❌ Failed to summarize {study_event['studyName']} ({part}): {e}")
+                    failed[idx] = str(e)
+                    pending.pop(idx, None)
+                    pruned.pop(idx, None)
+                    record_study_failure(study_event)
+                    release_source_files(study_event)
+    except Exception:
+        # The batch died: files of the studies still in flight must not stay summarizing
+        for idx in pending:
+            release_source_files(studies[idx])
+        raise
+    finally:
+        bedrock_calls.flush()
+        file_statuses.flush()
+    failures = [{"studyName": studies[idx]['studyName'], "error": err} for idx, err in failed.items()]
+    return pointers, failures
+
+
+def record_registry_outcome(study_event, pointer=None, error=None):
+    """
+    Pipelined mode: stores the outcome on the study registry item, but only if
+    the registry is still at the version this summary was built from. A newer
+    version means another file joined the study and a fresh summary is on its way.
+    """
+    version = int(study_event['registryVersion'])
+    if pointer:
+        update = "SET summarizedVersion = :v, summaryS3Key = :key, summarizedAtUtc = :now REMOVE failedVersion, lastError"
+        values = {':v': version, ':key': pointer['s3_key'], ':now': datetime.now(timezone.utc).isoformat()}
+    else:
+        update = "SET failedVersion = :v, lastError = :err, failedAtUtc = :now"
+        values = {':v': version, ':err': str(error)[:1000], ':now': datetime.now(timezone.utc).isoformat()}
+    try:
+        file_metadata_table.update_item(
+            Key={'userId': study_event['userId'], 'sessionId#fileName': study_event['registryKey']},
+            UpdateExpression=update,
+            ConditionExpression="version = :v",
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Registry for {study_event['studyName']} moved past v{version}; outcome not recorded.")
+        return False
+
+
+# --- Lambda entry point ---
+def lambda_handler(event, context):
+    """
+    Accepts a single study event, {"studies": [...]}, or a Map ItemBatcher
+    batch ({"Items": [...], "BatchInput": {...}}). A single study returns its
+    {s3_key, studyName} pointer; a batch returns the list of pointers.
+    Study events dispatched from the pipelined study registry carry
+    registryKey/registryVersion and report their outcome there instead of raising.
+    """
+    hedge_budget.reset()
+    bedrock_router.reset_stats()
+    if 'registryKey' in event:
+        pointers, failures = summarize_studies([event])
+        record_registry_outcome(event, pointer=pointers[0] if pointers else None,
+                                error=failures[0]['error'] if failures else None)
+        return pointers[0] if pointers else {"studyName": event['studyName'], "error": failures[0]['error']}
+
+    if 'studies' not in event and 'Items' not in event:
+        pointers, failures = summarize_studies([event])
+        if failures:
+            raise RuntimeError(f"Failed to summarize {event['studyName']}: {failures[0]['error']}")
+        # ←── **Return only the S3 pointer** ──→
+        return pointers[0]
+
+    batch_input = event.get('BatchInput') or {}
+    studies = [{**batch_input, **study} for study in event.get('studies', event.get('Items', []))]
+    print(f"Summarizing batch of {len(studies)} studies.")
+
+    pointers, failures = summarize_studies(studies)
+    print(f"Batch finished: {len(pointers)} summarized, {len(failures)} failed.")
+    print(f"Model stats: {json.dumps(bedrock_router.summary())}")
+    print(f"JSON parse stages: {json.dumps(stage_counts())}")
+    if BEDROCK_HEDGING:
+        print(f"Hedging: {json.dumps(hedge_budget.stats())}")
+    if studies and not pointers:
+        raise RuntimeError(f"All {len(failures)} studies in the batch failed: {failures[0]['error']}")
 
-    # ←── **Return only the S3 pointer** ──→
     return {
-        "s3_key":    key,
-        "studyName": study
+        "summaries":     pointers,
+        "failedStudies": failures,
+        "hedging":       hedge_budget.stats(),
+        "modelStats":    bedrock_router.summary()
     }
@@ -2,6 +2,8 @@ import json
 import boto3
 import os
 from datetime import datetime, timezone
+from change_version import bump_change_version  # docrag_shared layer
+from summary_pointers import AGGREGATE_SCOPE, record_summary  # docrag_shared layer
 
 dynamodb_resource = boto3.resource('dynamodb')
 DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'FileMetadata')
@@ -17,6 +19,8 @@ def lambda_handler(event, context):
     user_defined_folder_name = event.get('folderId') 
     overall_status_from_sfn = event.get('status') 
     summary_s3_key = event.get('summaryS3Key') 
+    section_index_s3_key = event.get('sectionIndexS3Key')
+    summary_version = event.get('summaryVersion')
     error_details_from_sfn = event.get('errorDetails') 
 
     if not all([user_id, user_defined_folder_name, overall_status_from_sfn]):
@@ -47,6 +51,25 @@ def lambda_handler(event, context):
         expression_attribute_names["#fssk"] = "folderSummaryS3Key"
         expression_attribute_values[":summaryS3KeyVal"] = summary_s3_key
         remove_actions.append("folderProcessingErrorDetails") 
+        if section_index_s3_key:
+            set_actions.append("#fsik = :sectionIndexS3KeyVal")
+            expression_attribute_names["#fsik"] = "folderSectionIndexS3Key"
+            expression_attribute_values[":sectionIndexS3KeyVal"] = section_index_s3_key
+        else:
+            remove_actions.append("folderSectionIndexS3Key")
+
+        # The latest-summary pointer, unless AggregateResults already recorded it
+        if summary_version is None:
+            pointer_attributes = {"summaryCount": int(event.get('summaryCount') or 0)}
+            if section_index_s3_key:
+                pointer_attributes["sectionIndexS3Key"] = section_index_s3_key
+            summary_version = record_summary(
+                metadata_table, user_id, user_defined_folder_name, AGGREGATE_SCOPE,
+                summary_s3_key, event.get('aggregatedSizeBytes'), pointer_attributes
+            )
+        set_actions.append("#fsv = :summaryVersionVal")
+        expression_attribute_names["#fsv"] = "folderSummaryVersion"
+        expression_attribute_values[":summaryVersionVal"] = int(summary_version)
 
     # If errorDetails is an object, convert to string. If already string, use as is.
     if error_details_from_sfn: # Check if errorDetails is not None and not empty
@@ -60,6 +83,7 @@ def lambda_handler(event, context):
             expression_attribute_names["#fped"] = "folderProcessingErrorDetails"
             expression_attribute_values[":errorDetailsVal"] = error_str[:390 * 1024] 
             remove_actions.append("folderSummaryS3Key") 
+            remove_actions.append("folderSectionIndexS3Key")
 
     update_expression_clauses = []
     if set_actions:
@@ -96,6 +120,7 @@ def lambda_handler(event, context):
         print(f"ExpressionAttributeValues: {json.dumps(expression_attribute_values)}")
 
         metadata_table.update_item(**update_params)
+        bump_change_version(metadata_table, user_id)
         print(f"Successfully updated/created folder metadata item. Status set to: {overall_status_from_sfn}")
         
     except Exception as e:
@@ -0,0 +1,253 @@
+"""
+Fair admission of folder runs to the state machine.
+
+InitiateFolderProcessing does not start its execution directly: it queues
+the run (enqueue_run) and admits what the caps allow (admit_runs). The rest
+waits until a running execution finishes and AdmitFolderRuns, invoked by the
+execution's status change event, frees its slot and admits the next runs.
+The scheduler keeps its state next to the KB sync item:
+
+    __SYSTEM__, __RUN_QUEUE__#<userId>#<enqueuedAtMs>#<executionName>   input, folderId, costBytes, fileCount
+    __SYSTEM__, __RUN_TENANT__#<userId>                                 running = {executionName: admittedAtMs}, servedCost
+
+Slots go to users by weighted fair queuing. An admitted run adds its cost
+(run_cost: the bytes to ingest plus FILE_COST_BYTES per file) to its user's
+servedCost, and the next slot goes to the waiting user who has been served
+least. A user with one 500-file folder and users with a few small folders
+take turns rather than queuing in arrival order. A user returning from idle
+starts from the least servedCost among the users with work, so idling earns
+no burst. Within a user the cheapest run goes first, unless one has waited
+longer than max_wait_ms.
+
+A user has at most tenant_cap executions running; the check and the
+reservation are one conditional write. The global cap is checked against
+the snapshot admit_runs read, so concurrent admitters can exceed it by a
+run or two.
+
+A folder has at most one queued run: queuing a newer one replaces it.
+"""
+import json
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+
+from change_version import bump_change_version
+from folder_counters import folder_item_key
+
+SYSTEM_USER = "__SYSTEM__"
+SORT_KEY = "sessionId#fileName"
+RUN_QUEUE_MARKER = "__RUN_QUEUE__"
+RUN_TENANT_MARKER = "__RUN_TENANT__"
+# Extraction, chunking and the Bedrock calls cost about this much per file, whatever its size
+FILE_COST_BYTES = 1024 * 1024
+TERMINAL_STATUSES = ("SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED")
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def run_cost(size_bytes, file_count):
+    """Cost of a run; one without files to ingest still identifies and summarizes studies."""
+    return int(size_bytes or 0) + FILE_COST_BYTES * (int(file_count or 0) + 1)
+
+
+def tenant_key(user_id):
+    return {'userId': SYSTEM_USER, SORT_KEY: f"{RUN_TENANT_MARKER}#{user_id}"}
+
+
+def execution_arn(state_machine_arn, execution_name):
+    return f"{state_machine_arn.replace(':stateMachine:', ':execution:', 1)}:{execution_name}"
+
+
+def _query_prefix(table, prefix):
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(SYSTEM_USER) & Key(SORT_KEY).begins_with(prefix),
+        'ConsistentRead': True
+    }
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def reset_progressive_summary(table, user_id, folder_id, run_id):
+    """
+    Starts an empty progressive aggregate on the folder item. Study summaries
+    are added to it one by one while the run progresses; studiesTotal is filled
+    in once the studies are known. The run's Bedrock hedge counters and failed
+    studies start over too; the folder's usage counters are kept.
+    """
+    table.update_item(
+        Key=folder_item_key(user_id, folder_id),
+        UpdateExpression=(
+            "SET progressiveSummaries = :empty, studiesCompleted = :zero, "
+            "progressiveRunId = :run, progressiveStartedAtUtc = :now "
+            "REMOVE studiesTotal, hedgesIssued, hedgesWon, failedStudies"
+        ),
+        ExpressionAttributeValues={
+            ':empty': {}, ':zero': 0, ':run': run_id, ':now': datetime.now(timezone.utc).isoformat()
+        }
+    )
+    bump_change_version(table, user_id)
+
+
+def enqueue_run(table, user_id, folder_id, execution_name, sfn_input, size_bytes, file_count):
+    """Queues a folder run, replacing a queued run of the same folder. Returns the queue item."""
+    for item in _query_prefix(table, f"{RUN_QUEUE_MARKER}#{user_id}#"):
+        if item.get('folderId') == folder_id:
+            table.delete_item(Key={'userId': SYSTEM_USER, SORT_KEY: item[SORT_KEY]})
+            print(f"Queued run {item['executionName']} of folder '{folder_id}' replaced by {execution_name}.")
+
+    table.update_item(
+        Key=tenant_key(user_id),
+        UpdateExpression="SET running = if_not_exists(running, :empty), servedCost = if_not_exists(servedCost, :zero)",
+        ExpressionAttributeValues={':empty': {}, ':zero': 0}
+    )
+    enqueued_at = now_ms()
+    item = {
+        'userId': SYSTEM_USER,
+        SORT_KEY: f"{RUN_QUEUE_MARKER}#{user_id}#{enqueued_at:013d}#{execution_name}",
+        'tenant': user_id,
+        'folderId': folder_id,
+        'executionName': execution_name,
+        'input': json.dumps(sfn_input),
+        'costBytes': run_cost(size_bytes, file_count),
+        'fileCount': int(file_count or 0),
+        'enqueuedAtMs': enqueued_at
+    }
+    table.put_item(Item=item)
+    return item
+
+
+def release_run(table, user_id, execution_name):
+    """Frees the slot of a finished execution. Returns False if it held none (already released)."""
+    try:
+        table.update_item(
+            Key=tenant_key(user_id),
+            UpdateExpression="REMOVE running.#n",
+            ConditionExpression="attribute_exists(running.#n)",
+            ExpressionAttributeNames={'#n': execution_name}
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def reconcile_running(table, sfn_client, state_machine_arn, grace_ms=60_000):
+    """
+    Frees the slots of executions that are no longer running but whose status
+    change event was missed. Slots reserved within grace_ms are left alone;
+    their execution may not have been started yet. Returns how many were freed.
+    """
+    released = 0
+    cutoff = now_ms() - grace_ms
+    for item in _query_prefix(table, f"{RUN_TENANT_MARKER}#"):
+        user_id = item[SORT_KEY].split('#', 1)[1]
+        for name, admitted_at in (item.get('running') or {}).items():
+            if int(admitted_at) > cutoff:
+                continue
+            try:
+                status = sfn_client.describe_execution(executionArn=execution_arn(state_machine_arn, name))['status']
+            except sfn_client.exceptions.ExecutionDoesNotExist:
+                status = None
+            if status != "RUNNING" and release_run(table, user_id, name):
+                print(f"Freed the slot of {name} ({status or 'never started'}) for user {user_id}.")
+                released += 1
+    return released
+
+
+def _next_run(runs, now, max_wait_ms):
+    """The user's next run: the longest waiting one past max_wait_ms, else the cheapest."""
+    overdue = [run for run in runs if now - int(run['enqueuedAtMs']) > max_wait_ms]
+    if overdue:
+        return min(overdue, key=lambda run: int(run['enqueuedAtMs']))
+    return min(runs, key=lambda run: (int(run['costBytes']), int(run['enqueuedAtMs'])))
+
+
+def _start(table, sfn_client, state_machine_arn, run, user_id, tenant_cap, served_cost):
+    """Reserves a slot, claims the queue item and starts the execution. Returns its ARN, or None."""
+    name = run['executionName']
+    try:
+        table.update_item(
+            Key=tenant_key(user_id),
+            UpdateExpression="SET running.#n = :now, servedCost = :served",
+            ConditionExpression="size(running) < :cap",
+            ExpressionAttributeNames={'#n': name},
+            ExpressionAttributeValues={':now': now_ms(), ':served': served_cost, ':cap': tenant_cap}
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # Another admitter filled the user's last slot
+        return None
+    try:
+        table.delete_item(
+            Key={'userId': SYSTEM_USER, SORT_KEY: run[SORT_KEY]},
+            ConditionExpression="attribute_exists(#sk)",
+            ExpressionAttributeNames={'#sk': SORT_KEY}
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # Admitted elsewhere, or replaced by a newer run of the folder
+        release_run(table, user_id, name)
+        return None
+
+    arn = execution_arn(state_machine_arn, name)
+    try:
+        reset_progressive_summary(table, user_id, run['folderId'], name)
+        arn = sfn_client.start_execution(stateMachineArn=state_machine_arn, name=name, input=run['input'])['executionArn']
+    except sfn_client.exceptions.ExecutionAlreadyExists:
+        pass
+    except Exception:
+        table.put_item(Item=run)
+        release_run(table, user_id, name)
+        raise
+    return arn
+
+
+def admit_runs(table, sfn_client, state_machine_arn, tenant_cap, global_cap=0, max_wait_ms=15 * 60 * 1000):
+    """
+    Starts queued runs while the caps allow (global_cap 0: no global cap).
+    Returns the started runs as [{"userId", "folderId", "executionName", "executionArn"}].
+    """
+    tenants = {item[SORT_KEY].split('#', 1)[1]: item for item in _query_prefix(table, f"{RUN_TENANT_MARKER}#")}
+    queued = defaultdict(list)
+    for run in _query_prefix(table, f"{RUN_QUEUE_MARKER}#"):
+        queued[run['tenant']].append(run)
+    running = {user: len(item.get('running') or {}) for user, item in tenants.items()}
+    served = {user: int(item.get('servedCost') or 0) for user, item in tenants.items()}
+    slots = global_cap - sum(running.values()) if global_cap else None
+
+    admitted, now = [], now_ms()
+    while slots is None or slots > 0:
+        waiting = [user for user, runs in queued.items() if runs and running.get(user, 0) < tenant_cap]
+        if not waiting:
+            break
+        busy = [user for user in set(queued) | set(running) if queued.get(user) or running.get(user)]
+        floor = min(served.get(user, 0) for user in busy)
+        user = min(waiting, key=lambda u: (max(served.get(u, 0), floor), min(int(r['enqueuedAtMs']) for r in queued[u])))
+        run = _next_run(queued[user], now, max_wait_ms)
+        queued[user].remove(run)
+
+        served_cost = max(served.get(user, 0), floor) + int(run['costBytes'])
+        try:
+            arn = _start(table, sfn_client, state_machine_arn, run, user, tenant_cap, served_cost)
+        except Exception as e:
+            print(f"Could not start {run['executionName']}; it stays queued: {e}")
+            continue
+        if arn is None:
+            # The user's slots may be taken by another admitter; try again on the next event
+            queued[user] = []
+            continue
+        served[user] = served_cost
+        running[user] = running.get(user, 0) + 1
+        if slots is not None:
+            slots -= 1
+        admitted.append({"userId": user, "folderId": run['folderId'],
+                         "executionName": run['executionName'], "executionArn": arn})
+        print(f"Admitted {run['executionName']} of user {user} ({int(run['costBytes'])} cost bytes, "
+              f"waited {now - int(run['enqueuedAtMs'])} ms).")
+    return admitted
@@ -0,0 +1,63 @@
+"""
+Per-user change version for the metadata table.
+
+Every write that changes what ListUserFiles returns (file rows, ingestion
+records, folder status and progress) is followed by bump_change_version(),
+which increments a counter on one item per user:
+
+    userId = <user>, sessionId#fileName = "__CHANGES__", changeVersion = N
+
+ListUserFiles reads the counter before it queries and uses it in the
+listing's ETag and cache key, so an unchanged version means an unchanged
+listing and a poll costs one GetItem. The bump comes after the write it
+announces: a listing read between the two is tagged with the old version
+and replaced on the next poll.
+
+A bump can carry usage deltas (see folder_counters), which are added to the
+user's totals on the same item, so they cost no extra write.
+"""
+from datetime import datetime, timezone
+
+CHANGE_VERSION_SORT_KEY = "__CHANGES__"
+
+
+def change_version_key(user_id):
+    return {'userId': user_id, 'sessionId#fileName': CHANGE_VERSION_SORT_KEY}
+
+
+def bump_change_version(table, user_id, usage=None):
+    """usage: counter deltas to add to the user's totals in the same update."""
+    changes = {name: value for name, value in (usage or {}).items() if value}
+    add = ["changeVersion :one"] + [f"#u{i} :u{i}" for i in range(len(changes))]
+    update = {
+        'Key': change_version_key(user_id),
+        'UpdateExpression': f"ADD {', '.join(add)} SET lastChangeAtUtc = :now",
+        'ExpressionAttributeValues': {
+            ':one': 1, ':now': datetime.now(timezone.utc).isoformat(),
+            **{f":u{i}": value for i, value in enumerate(changes.values())}
+        }
+    }
+    if changes:
+        update['ExpressionAttributeNames'] = {f"#u{i}": name for i, name in enumerate(changes)}
+    table.update_item(**update)
+
+
+def bump_change_versions(table, user_ids, usage_by_user=None):
+    """One bump per distinct user, for writers that touch several rows at once."""
+    usage_by_user = usage_by_user or {}
+    for user_id in sorted(set(user_ids) | set(usage_by_user)):
+        bump_change_version(table, user_id, usage_by_user.get(user_id))
+
+
+def read_change_version(table, user_id):
+    """The user's current change version (0 before the first write). Strongly consistent, 1 RCU."""
+    item = table.get_item(
+        Key=change_version_key(user_id), ProjectionExpression="changeVersion", ConsistentRead=True
+    ).get('Item')
+    return int(item['changeVersion']) if item else 0
+
+
+def read_user_usage(table, user_id):
+    """(change version, the item's usage totals) in one strongly consistent GetItem."""
+    item = table.get_item(Key=change_version_key(user_id), ConsistentRead=True).get('Item') or {}
+    return int(item.get('changeVersion', 0)), item
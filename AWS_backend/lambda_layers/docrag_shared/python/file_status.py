@@ -0,0 +1,211 @@
+"""
+One status model for uploaded files.
+
+A file's row is the one RecordS3FileMetadata writes,
+
+    userId = <user>, sessionId#fileName = "<session>#<userFolder>#<path within the folder>"
+
+and every stage records its progress on that row: there are no separate
+ingestion records. status moves through
+
+    unprocessed    uploaded (RecordS3FileMetadata)
+    ingesting      chunks written, KB ingestion job started (IngestFileToBedrockKB)
+    ingested       the job completed (CheckIngestionJobs, ExtractFileStudies in pipelined mode)
+    ingest_failed  extraction or the job failed; processingError says why
+    summarizing    a study citing the file is being summarized (SummarizeSingleStudy)
+    summarized     a study citing the file was summarized
+    deleted        removed from S3 after it was ingested; a tombstone until the
+                   next folder run detaches it from its studies and drops the row.
+                   Only a new upload of the file moves it out of this state.
+
+Every transition carries statusAtMs, the time of the event it reports
+(epoch milliseconds), and is written only over an older one. A redelivered
+or late event never moves a file back to an earlier state, whatever order
+the stages' writes land in.
+
+StatusWriter is the write path for stages after the upload. emit() only
+buffers a transition, coalescing transitions of the same row (the newest
+wins, attributes accumulate). flush() writes each row with one conditional
+update_item, in parallel through the table's (thread-safe) client, adjusts the folder counters by the rows' previous
+state (see folder_counters) and bumps the users' change versions once.
+It flushes by itself once max_pending rows are buffered and when it is
+used as a context manager.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from change_version import bump_change_versions
+from folder_counters import add_delta, apply_folder_counters, report_counter_failure, row_contribution
+
+UNPROCESSED   = "unprocessed"
+INGESTING     = "ingesting"
+INGESTED      = "ingested"
+INGEST_FAILED = "ingest_failed"
+SUMMARIZING   = "summarizing"
+SUMMARIZED    = "summarized"
+DELETED       = "deleted"
+
+SORT_KEY = "sessionId#fileName"
+# Set on the row by ingestion; a re-upload keeps them (RecordS3FileMetadata)
+INGESTION_ATTRIBUTES = (
+    'folderId', 'sourceS3Key', 'sourceETag', 'sourceSize', 'sourceLastModified', 'chunksCount',
+    'pagesCount', 'ingestionJobId', 'ingestionJobStatus', 'startedAtUtc', 'completedAtUtc'
+)
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def event_time_ms(value):
+    """Epoch milliseconds of an ISO timestamp such as an S3 eventTime ("2024-05-01T12:00:00.123Z")."""
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def file_parts(folder_id, relative_name):
+    """(sessionId, userFolder, path within it) as RecordS3FileMetadata splits the object key."""
+    session_id, user_folder, name = f"{folder_id}/{relative_name}".split('/', 2)
+    return session_id, user_folder, name
+
+
+def file_key(user_id, folder_id, relative_name):
+    """Key of the row of the file at <userId>/<folderId>/<relative_name>."""
+    session_id, user_folder, name = file_parts(folder_id, relative_name)
+    return {'userId': user_id, SORT_KEY: f"{session_id}#{user_folder}#{name}"}
+
+
+def row_folder_id(row):
+    return f"{row['sessionId']}/{row['userFolder']}" if row.get('sessionId') and row.get('userFolder') else None
+
+
+class StatusWriter:
+    """Write-behind buffer of status transitions; see the module docstring."""
+
+    def __init__(self, table, max_pending=100, max_workers=8):
+        self.table = table
+        self.max_pending = max_pending
+        self.max_workers = max_workers
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def emit(self, key, status, at_ms=None, attributes=None, remove=(), create=False, from_statuses=()):
+        """
+        Buffers status (with attributes to SET and names to REMOVE) for the
+        row at key. Without create, a row that does not exist is left alone;
+        with from_statuses, so is a row in any other status.
+        """
+        self._buffer(key, {
+            "status": status, "at": at_ms or now_ms(), "set": dict(attributes or {}),
+            "remove": set(remove), "create": create, "from": tuple(from_statuses)
+        })
+
+    def emit_delete(self, key, at_ms=None):
+        """Buffers the removal of the row at key, unless it has moved on since at_ms."""
+        self._buffer(key, {"status": None, "at": at_ms or now_ms(), "set": {}, "remove": set(), "create": False, "from": ()})
+
+    def _buffer(self, key, transition):
+        row = (key['userId'], key[SORT_KEY])
+        with self.lock:
+            earlier = self.pending.get(row)
+            if earlier is not None and earlier["at"] > transition["at"]:
+                earlier, transition = transition, earlier
+            if earlier is not None and transition["status"] is not None and earlier["status"] is not None:
+                transition = {
+                    **transition,
+                    "set": {**earlier["set"], **transition["set"]},
+                    "remove": (earlier["remove"] - set(transition["set"])) | transition["remove"],
+                    "create": earlier["create"] or transition["create"]
+                }
+            self.pending[row] = transition
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def _write(self, row, transition):
+        """One conditional write. Returns (previous row, new row) or None if the write was refused."""
+        key = {'userId': row[0], SORT_KEY: row[1]}
+        # Unlike the Table resource, its client is thread-safe; it (de)serializes values the same way
+        client = self.table.meta.client
+        condition, names = "(attribute_not_exists(statusAtMs) OR statusAtMs < :at)", {}
+        if not transition["create"]:
+            condition += " AND attribute_exists(#sk)"
+            names['#sk'] = SORT_KEY
+        try:
+            if transition["status"] is None:
+                old = client.delete_item(
+                    TableName=self.table.name, Key=key, ConditionExpression=condition, ExpressionAttributeNames=names,
+                    ExpressionAttributeValues={':at': transition["at"]}, ReturnValues="ALL_OLD"
+                ).get('Attributes') or {}
+                return old, {}
+
+            condition += " AND (attribute_not_exists(#st) OR #st <> :deleted)"
+            names['#st'] = 'status'
+            allowed = {f":f{i}": status for i, status in enumerate(transition["from"])}
+            if allowed:
+                condition += f" AND #st IN ({', '.join(allowed)})"
+            values = {**transition["set"], 'status': transition["status"], 'statusAtMs': transition["at"]}
+            names.update({f"#s{i}": name for i, name in enumerate(values)})
+            expression = "SET " + ", ".join(f"#s{i} = :s{i}" for i in range(len(values)))
+            removed = sorted(transition["remove"] - set(values))
+            if removed:
+                names.update({f"#r{i}": name for i, name in enumerate(removed)})
+                expression += " REMOVE " + ", ".join(f"#r{i}" for i in range(len(removed)))
+            old = client.update_item(
+                TableName=self.table.name, Key=key, UpdateExpression=expression, ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={**{f":s{i}": value for i, value in enumerate(values.values())},
+                                           ':at': transition["at"], ':deleted': DELETED, **allowed},
+                ReturnValues="ALL_OLD"
+            ).get('Attributes') or {}
+            new = {**{name: value for name, value in old.items() if name not in removed}, **key, **values}
+            return old, new
+        except client.exceptions.ConditionalCheckFailedException:
+            return None
+
+    def flush(self):
+        """Writes every buffered transition. Returns the writer's running {"written", "skipped"} counts."""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return dict(self.stats)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batch)))) as executor:
+            outcomes = list(executor.map(lambda item: self._write(*item), batch.items()))
+
+        deltas, users = defaultdict(Counter), set()
+        for (user_id, _), outcome in zip(batch, outcomes):
+            if outcome is None:
+                # A newer state is already recorded, or the row is gone
+                self.stats["skipped"] += 1
+                continue
+            self.stats["written"] += 1
+            users.add(user_id)
+            old, new = outcome
+            folder_id = row_folder_id(new) or row_folder_id(old)
+            if folder_id:
+                add_delta(deltas, user_id, folder_id, row_contribution(new), row_contribution(old))
+
+        usage = None
+        try:
+            usage = apply_folder_counters(self.table, deltas)
+        except Exception as e:
+            report_counter_failure(deltas, e)
+        if users:
+            bump_change_versions(self.table, users, usage)
+        print(f"Status flush: {len(batch)} row(s), {self.stats['written']} written and "
+              f"{self.stats['skipped']} skipped so far.")
+        return dict(self.stats)
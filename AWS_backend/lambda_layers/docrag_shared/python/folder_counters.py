@@ -0,0 +1,152 @@
+"""
+Progress and usage counters on the folder item.
+
+The folder item (__FOLDER_INFO__#<folderId>#__METADATA__) carries running
+totals that the writers keep current with ADD updates, so a progress view
+reads one item instead of every file row of the folder:
+
+    filesUploaded, bytesUploaded        user files in S3
+    filesIngested, bytesIngested,
+    pagesIngested, chunksIngested       files whose chunks are in the KB
+    filesFailed                         files whose last ingestion failed
+    bedrockCalls                        model requests made for the folder (SummarizeSingleStudy)
+
+All but bedrockCalls follow from the files' rows (see file_status).
+
+Studies done are the existing studiesCompleted; failed studies are the
+failedStudies string set, so a retried failure is not counted twice and a
+study that succeeds later leaves it. Both are reset with each run.
+
+A row's share of the totals is derived from the row itself
+(row_contribution), and a writer adds the difference between the new and
+the previous share of every row it writes.
+Rewriting a row that is already counted, as a redelivered S3 event or a
+retried batch does, adds nothing.
+
+The same deltas, summed per user, are added to the user's totals on the
+change version item in the write that bumps it (see change_version), so the
+dashboard is one GetItem too.
+
+Writers do not fail a batch whose rows are written when the counter update
+fails (a retry would not recount them). They call report_counter_failure,
+which logs the folders with an ERROR line and a FolderCounterFailures
+metric (CloudWatch embedded metric format) so an alarm can trigger
+scripts/backfill_folder_counters.py.
+"""
+import json
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+FOLDER_ITEM_SESSION_MARKER = "__FOLDER_INFO__"
+FOLDER_ITEM_FILENAME_MARKER = "__METADATA__"
+COUNTERS = (
+    "filesUploaded", "bytesUploaded", "filesIngested", "bytesIngested",
+    "pagesIngested", "chunksIngested", "filesFailed", "bedrockCalls"
+)
+BATCH_GET_MAX_KEYS = 100
+# What row_contribution reads; writers project previous rows onto it
+CONTRIBUTION_ATTRIBUTES = ('status', 'fileType', 'fileSize', 'sessionId', 'userFolder',
+                           'sourceETag', 'sourceSize', 'pagesCount', 'chunksCount')
+
+
+def folder_item_key(user_id, folder_id):
+    return {'userId': user_id, 'sessionId#fileName': f"{FOLDER_ITEM_SESSION_MARKER}#{folder_id}#{FOLDER_ITEM_FILENAME_MARKER}"}
+
+
+def row_contribution(row):
+    """
+    Share of a file's row. Summaries under folder-summaries/ are not user
+    files, and a deleted file's tombstone counts for nothing. Its chunks
+    count while the row has the sourceETag of the ingested object.
+    """
+    if not row or row.get('fileType', 'main') != 'main' or row.get('status') == "deleted":
+        return Counter()
+    share = Counter(filesUploaded=1, bytesUploaded=int(row.get('fileSize') or 0))
+    if 'sourceETag' in row:
+        share.update(
+            filesIngested=1, bytesIngested=int(row.get('sourceSize') or 0),
+            pagesIngested=int(row.get('pagesCount') or 0), chunksIngested=int(row.get('chunksCount') or 0)
+        )
+    if row.get('status') == "ingest_failed":
+        share.update(filesFailed=1)
+    return share
+
+
+def previous_items(table, keys, attributes):
+    """
+    The current version of each key's row (BatchGetItem, 100 keys a request),
+    as {(userId, sessionId#fileName): item}; keys without a row are left out.
+    """
+    unique = list({(key['userId'], key['sessionId#fileName']): key for key in keys}.values())
+    client = table.meta.client
+    names = {f"#p{i}": attr for i, attr in enumerate(['userId', 'sessionId#fileName', *attributes])}
+    found = {}
+    for start in range(0, len(unique), BATCH_GET_MAX_KEYS):
+        request = {table.name: {
+            'Keys': unique[start:start + BATCH_GET_MAX_KEYS],
+            'ProjectionExpression': ", ".join(names), 'ExpressionAttributeNames': names
+        }}
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            # The table's client (de)serializes attribute values like the Table resource does
+            for item in response.get('Responses', {}).get(table.name, []):
+                found[(item['userId'], item['sessionId#fileName'])] = item
+            request = response.get('UnprocessedKeys') or None
+    return found
+
+
+def add_delta(deltas, user_id, folder_id, new, old):
+    """deltas[(userId, folderId)] += new share - previous share."""
+    delta = deltas[(user_id, folder_id)]
+    delta.update(new)
+    delta.subtract(old)
+
+
+def apply_folder_counters(table, deltas):
+    """
+    One ADD update per folder with a non-zero delta. Returns the deltas summed
+    per user, for bump_change_versions(..., usage_by_user=...).
+    """
+    usage_by_user = defaultdict(Counter)
+    now = datetime.now(timezone.utc).isoformat()
+    for (user_id, folder_id), delta in deltas.items():
+        changes = {name: value for name, value in delta.items() if value}
+        if not changes:
+            continue
+        names = {f"#c{i}": name for i, name in enumerate(changes)}
+        values = {f":c{i}": value for i, value in enumerate(changes.values())}
+        table.update_item(
+            Key=folder_item_key(user_id, folder_id),
+            UpdateExpression="ADD " + ", ".join(f"#c{i} :c{i}" for i in range(len(changes))) + " SET countersUpdatedAtUtc = :now",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={**values, ':now': now}
+        )
+        usage_by_user[user_id].update(changes)
+    return dict(usage_by_user)
+
+
+def report_counter_failure(deltas, error):
+    """Logs the folders whose counters missed their deltas; see the module docstring."""
+    folders = sorted({f"{user_id}#{folder_id}" for (user_id, folder_id), delta in deltas.items()
+                      if any(delta.values())})
+    print(f"ERROR folder counters not updated ({error}); recount with backfill_folder_counters.py: "
+          f"{json.dumps(folders)}")
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{"Namespace": "DocRAG", "Dimensions": [[]],
+                                   "Metrics": [{"Name": "FolderCounterFailures", "Unit": "Count"}]}]
+        },
+        "FolderCounterFailures": len(folders),
+        "folders": folders
+    }))
+
+
+def counter_values(item):
+    """The counters of a folder item or a user's change version item, 0 where never written."""
+    values = {name: int(item.get(name) or 0) for name in COUNTERS}
+    if 'studiesCompleted' in item or 'failedStudies' in item:
+        values["studiesCompleted"] = int(item.get('studiesCompleted') or 0)
+        values["studiesFailed"] = len(item.get('failedStudies') or ())
+    return values
@@ -0,0 +1,126 @@
+"""
+Parse cascade for JSON objects in model output.
+
+parse_json_object() tries, cheapest first:
+
+  strict  json.loads of the text, with any ``` fence stripped
+  scan    one pass over the text collecting brace-balanced top-level
+          objects (string- and escape-aware), keeping the largest that parses;
+          handles prose around the JSON and several objects in one answer.
+          An object cut off by the token limit is closed after its last
+          complete member, so the sections that did finish are kept
+  repair  json_repair (the json_repair layer) from the first '{'; handles
+          trailing commas, single quotes, unquoted keys and truncated output
+
+and always returns a dict, so a bad answer costs milliseconds instead of a
+failed study. missing_sections() tells the caller which sections to re-ask
+for. Stage counts are kept for the life of the container.
+"""
+import json
+import re
+import threading
+from collections import Counter
+
+try:
+    import json_repair  # json_repair layer
+except ImportError:
+    json_repair = None
+
+FENCE_PATTERN = re.compile(r'^\s*```(?:json)?\s*(.*?)\s*```\s*$', re.DOTALL | re.IGNORECASE)
+
+_stage_counts = Counter()
+_stage_lock = threading.Lock()
+
+
+def _count(stage):
+    with _stage_lock:
+        _stage_counts[stage] += 1
+
+
+def stage_counts():
+    with _stage_lock:
+        return dict(_stage_counts)
+
+
+def strict_parse(text):
+    match = FENCE_PATTERN.match(text)
+    try:
+        data = json.loads(match.group(1) if match else text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def balanced_objects(text):
+    """
+    Returns (spans, truncated): every brace-balanced top-level {...} span of
+    text, ignoring braces inside strings, and, if the last object never
+    closes, that object cut after its last complete nested object and closed.
+    """
+    spans, depth, start, member_end, in_string, escaped = [], 0, None, None, False, False
+    for idx, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            if depth:
+                in_string = True
+        elif ch == '{':
+            if depth == 0:
+                start, member_end = idx, None
+            depth += 1
+        elif ch == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                spans.append(text[start:idx + 1])
+            elif depth == 1:
+                member_end = idx
+    truncated = text[start:member_end + 1] + '}' if depth and member_end is not None else None
+    return spans, truncated
+
+
+def scan_parse(text):
+    spans, truncated = balanced_objects(text)
+    best = None
+    for candidate in spans + ([truncated] if truncated else []):
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(data, dict) and (best is None or len(candidate) > best[0]):
+            best = (len(candidate), data)
+    return best[1] if best else None
+
+
+def repair_parse(text):
+    if json_repair is None:
+        return None
+    start = text.find('{')
+    if start == -1:
+        return None
+    try:
+        data = json_repair.loads(text[start:])
+    except Exception:
+        return None
+    return data if isinstance(data, dict) and data else None
+
+
+def parse_json_object(text):
+    """Returns (data, stage) with stage one of strict/scan/repair/failed; data is {} on failure."""
+    text = text or ""
+    for stage, parse in (("strict", strict_parse), ("scan", scan_parse), ("repair", repair_parse)):
+        data = parse(text)
+        if data is not None:
+            _count(stage)
+            return data, stage
+    _count("failed")
+    return {}, "failed"
+
+
+def missing_sections(data, sections):
+    """Sections that did not come back as an object."""
+    return [section for section in sections if not isinstance(data.get(section), dict)]
@@ -0,0 +1,107 @@
+"""
+Removing objects from the Knowledge Base data source and syncing it once.
+
+A source file's chunks live under "<kb prefix>/<source key>/" (chunk_NNNN.txt
+plus .metadata.json, written by IngestFileToBedrockKB). delete_keys()
+removes any number of keys with delete_objects, 1000 per request.
+
+Removing chunks from S3 only drops them from the vector index at the next
+ingestion job. Rather than one job per deleted file, deleters call
+request_kb_sync(), which counts pending changes on a single table item:
+
+    userId = "__SYSTEM__", sessionId#fileName = "__KB_SYNC__", pendingChanges = N
+
+run_pending_kb_sync() starts one job for everything pending. If a job is
+already running the request stays pending, and the next call, such as the
+scheduled CleanupStaleArtifacts run, picks it up. Only the changes the new
+job covers are cleared, so a request that arrives meanwhile is kept.
+
+IngestFileToBedrockKB does the same when its batch's job conflicts with a
+running one: the batch's rows are recorded with ingestionJobStatus
+SYNC_PENDING, and the CheckIngestionJobs barrier waits on covering_sync_job().
+"""
+import uuid
+from datetime import datetime, timezone
+
+KB_SYNC_KEY = {'userId': '__SYSTEM__', 'sessionId#fileName': '__KB_SYNC__'}
+DELETE_OBJECTS_MAX_KEYS = 1000
+# Stands in for the ingestion job status of changes waiting for a sync job
+SYNC_PENDING = "SYNC_PENDING"
+# Data source prefix of the chunks when KB_S3_SOURCE_PREFIX / DESTINATION_S3_PREFIX is not set
+DEFAULT_KB_SOURCE_PREFIX = "kb-source"
+
+
+def chunk_prefix(kb_prefix, source_key):
+    return f"{kb_prefix.strip('/')}/{source_key}/"
+
+
+def list_keys(s3_client, bucket, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def delete_keys(s3_client, bucket, keys):
+    """Deletes keys in batches of DELETE_OBJECTS_MAX_KEYS. Returns (deleted, errors)."""
+    keys = list(keys)
+    deleted, errors = 0, []
+    for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+        batch = keys[start:start + DELETE_OBJECTS_MAX_KEYS]
+        response = s3_client.delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+        )
+        # Quiet mode only reports the keys that failed
+        batch_errors = response.get('Errors', [])
+        errors.extend(batch_errors)
+        deleted += len(batch) - len(batch_errors)
+    return deleted, errors
+
+
+def request_kb_sync(table, changes, reason):
+    table.update_item(
+        Key=KB_SYNC_KEY,
+        UpdateExpression="ADD pendingChanges :n SET requestedAtUtc = :now, lastReason = :reason",
+        ExpressionAttributeValues={':n': changes, ':now': datetime.now(timezone.utc).isoformat(), ':reason': reason}
+    )
+
+
+def run_pending_kb_sync(table, agent_client, knowledge_base_id, data_source_id):
+    """Starts one ingestion job if changes are pending. Returns its job ID, or None if nothing was started."""
+    item = table.get_item(Key=KB_SYNC_KEY, ConsistentRead=True).get('Item') or {}
+    pending = int(item.get('pendingChanges', 0))
+    if pending <= 0:
+        return None
+    try:
+        job = agent_client.start_ingestion_job(
+            knowledgeBaseId=knowledge_base_id,
+            dataSourceId=data_source_id,
+            clientToken=str(uuid.uuid4()),
+            description=f"Coalesced sync of {pending} removed object(s)"
+        )['ingestionJob']
+    except agent_client.exceptions.ConflictException:
+        print(f"An ingestion job is already running; {pending} pending change(s) wait for the next sync.")
+        return None
+    table.update_item(
+        Key=KB_SYNC_KEY,
+        UpdateExpression="ADD pendingChanges :done SET lastSyncJobId = :job, lastSyncAtUtc = :now",
+        ExpressionAttributeValues={
+            ':done': -pending, ':job': job['ingestionJobId'], ':now': datetime.now(timezone.utc).isoformat()
+        }
+    )
+    print(f"Started ingestion job {job['ingestionJobId']} for {pending} pending change(s).")
+    return job['ingestionJobId']
+
+
+def covering_sync_job(table, agent_client, knowledge_base_id, data_source_id):
+    """
+    The ID of a job started after every change requested so far, starting one
+    if changes are pending. None while they still wait for a running job.
+    """
+    job_id = run_pending_kb_sync(table, agent_client, knowledge_base_id, data_source_id)
+    if job_id:
+        return job_id
+    item = table.get_item(Key=KB_SYNC_KEY, ConsistentRead=True).get('Item') or {}
+    if int(item.get('pendingChanges', 0)) > 0:
+        return None
+    return item.get('lastSyncJobId')
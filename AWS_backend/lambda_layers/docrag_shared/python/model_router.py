@@ -0,0 +1,189 @@
+"""
+Per-task Bedrock model routing with throttle failover.
+
+Each prompt type is mapped to an ordered list of model candidates, read from
+the BEDROCK_MODEL_ROUTES environment variable (JSON):
+
+    {
+      "classification": ["anthropic.claude-3-haiku-20240307-v1:0", "us.anthropic.claude-3-haiku-20240307-v1:0"],
+      "extraction":     ["anthropic.claude-3-sonnet-20240229-v1:0", "us.anthropic.claude-3-sonnet-20240229-v1:0"]
+    }
+
+Task names (product_list, normalization, study_names, file_lookup) fall back
+to their family (classification), then to "default", then to
+BEDROCK_SUMMARY_MODEL_ID. A candidate is a foundation model ID, a
+cross-region inference profile ID (us./eu./apac. prefix, which spreads
+requests over that geography's regions) or a full ARN.
+
+On ThrottlingException the model is put in a short cool-down and the next
+candidate is tried at once, so a call draws on several quota pools before
+the caller's own backoff kicks in. Latency and throttle counts are kept per
+model; a handler calls reset_stats() on entry so summary() reports its own
+invocation, while cool-downs carry over for the life of the container.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import boto3
+
+AWS_REGION          = os.environ.get('AWS_REGION', boto3.session.Session().region_name)
+DEFAULT_MODEL_ID    = os.environ.get('BEDROCK_SUMMARY_MODEL_ID')
+COOLDOWN_SECONDS    = float(os.environ.get('BEDROCK_THROTTLE_COOLDOWN_SECONDS', 5))
+COOLDOWN_MAX_SECONDS = float(os.environ.get('BEDROCK_THROTTLE_COOLDOWN_MAX_SECONDS', 60))
+LATENCY_WINDOW_SIZE = 200
+
+TASK_FAMILIES = {
+    "product_list":  "classification",
+    "normalization": "classification",
+    "study_names":   "classification",
+    "file_lookup":   "classification",
+    "extraction":    "extraction",
+}
+
+INFERENCE_PROFILE_PATTERN = re.compile(r'^(us|eu|apac|us-gov|global)\.')
+
+
+def load_routes():
+    raw = os.environ.get('BEDROCK_MODEL_ROUTES', '').strip()
+    routes = json.loads(raw) if raw else {}
+    return {task: [models] if isinstance(models, str) else list(models) for task, models in routes.items()}
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.throttles = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW_SIZE)
+        self.cooldown_until = 0.0
+        self.consecutive_throttles = 0
+
+    def reset_counts(self):
+        self.calls = 0
+        self.throttles = 0
+        self.errors = 0
+        self.latencies.clear()
+
+    def summary(self):
+        ordered = sorted(self.latencies)
+        return {
+            "calls":        self.calls,
+            "throttles":    self.throttles,
+            "errors":       self.errors,
+            "throttleRate": round(self.throttles / self.calls, 3) if self.calls else 0.0,
+            "p50LatencyMs": int(ordered[len(ordered) // 2] * 1000) if ordered else None,
+            "p95LatencyMs": int(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000) if ordered else None,
+        }
+
+
+class ModelRouter:
+    """Routes retrieve_and_generate/converse calls by task and fails over on throttling."""
+
+    def __init__(self, client, routes=None, region=AWS_REGION, default_model=DEFAULT_MODEL_ID, runtime_client=None):
+        self.client = client
+        self.runtime_client = runtime_client
+        self.routes = load_routes() if routes is None else routes
+        self.region = region
+        self.default_model = default_model
+        self.stats = {}
+        self.lock = threading.Lock()
+        self._account_id = os.environ.get('AWS_ACCOUNT_ID')
+
+    def candidates(self, task):
+        for key in (task, TASK_FAMILIES.get(task), "default"):
+            if key and self.routes.get(key):
+                return self.routes[key]
+        return [self.default_model]
+
+    def model_arn(self, model_id):
+        if model_id.startswith("arn:"):
+            return model_id
+        if INFERENCE_PROFILE_PATTERN.match(model_id):
+            if self._account_id is None:
+                self._account_id = boto3.client('sts').get_caller_identity()['Account']
+            return f"arn:aws:bedrock:{self.region}:{self._account_id}:inference-profile/{model_id}"
+        return f"arn:aws:bedrock:{self.region}::foundation-model/{model_id}"
+
+    def _stats(self, model_id):
+        with self.lock:
+            return self.stats.setdefault(model_id, ModelStats())
+
+    def _ordered(self, task):
+        """Candidates in configured order, with cooling-down models moved behind the available ones."""
+        now = time.monotonic()
+        models = self.candidates(task)
+        ready = [m for m in models if self._stats(m).cooldown_until <= now]
+        cooling = sorted((m for m in models if m not in ready), key=lambda m: self._stats(m).cooldown_until)
+        return ready + cooling
+
+    def _with_failover(self, task, client, call, desc):
+        """
+        One pass over the task's candidates. Raises the last ThrottlingException
+        if every candidate is throttled, leaving the backoff to the caller.
+        """
+        last_throttle = None
+        for model_id in self._ordered(task):
+            stats = self._stats(model_id)
+            start = time.monotonic()
+            try:
+                response = call(model_id)
+            except client.exceptions.ThrottlingException as e:
+                with self.lock:
+                    stats.calls += 1
+                    stats.throttles += 1
+                    stats.consecutive_throttles += 1
+                    cooldown = min(COOLDOWN_SECONDS * (2 ** (stats.consecutive_throttles - 1)), COOLDOWN_MAX_SECONDS)
+                    stats.cooldown_until = time.monotonic() + cooldown
+                print(f"{model_id} throttled during {desc}; cooling down {cooldown:.0f}s and failing over.")
+                last_throttle = e
+                continue
+            except Exception:
+                with self.lock:
+                    stats.calls += 1
+                    stats.errors += 1
+                raise
+            with self.lock:
+                stats.calls += 1
+                stats.consecutive_throttles = 0
+                stats.latencies.append(time.monotonic() - start)
+            return response
+        raise last_throttle
+
+    def retrieve_and_generate(self, task, prompt_text, knowledge_base_id, vector_search_config, desc=""):
+        return self._with_failover(task, self.client, lambda model_id: self.client.retrieve_and_generate(
+            input={'text': prompt_text},
+            retrieveAndGenerateConfiguration={
+                'type': 'KNOWLEDGE_BASE',
+                'knowledgeBaseConfiguration': {
+                    'knowledgeBaseId': knowledge_base_id,
+                    'modelArn': self.model_arn(model_id),
+                    'retrievalConfiguration': {'vectorSearchConfiguration': vector_search_config}
+                }
+            }
+        ), desc)
+
+    def converse(self, task, system_text, user_text, desc="", max_tokens=4096):
+        """Plain generation (bedrock-runtime Converse) for prompts that already carry their passages."""
+        if self.runtime_client is None:
+            self.runtime_client = boto3.client('bedrock-runtime', region_name=self.region)
+        client = self.runtime_client
+        return self._with_failover(task, client, lambda model_id: client.converse(
+            modelId=model_id,
+            system=[{'text': system_text}],
+            messages=[{'role': 'user', 'content': [{'text': user_text}]}],
+            inferenceConfig={'maxTokens': max_tokens, 'temperature': 0.0}
+        ), desc)
+
+    def reset_stats(self):
+        """Starts this invocation's counts; a warm container keeps the router and its cool-downs."""
+        with self.lock:
+            for stats in self.stats.values():
+                stats.reset_counts()
+
+    def summary(self):
+        with self.lock:
+            return {model_id: stats.summary() for model_id, stats in self.stats.items() if stats.calls}
@@ -0,0 +1,154 @@
+"""
+Retrieval depth and local re-ranking for knowledge-base prompts.
+
+retrieval_depth() picks numberOfResults from the prompt type and a token
+budget instead of a fixed 30: a file lookup needs a handful of chunks, the
+extraction schemas need many. An extraction prompt's budget grows with the
+fields it asks for (field_token_budget), so a 50-field part is not held to
+the chunks that suit a 10-field one; the extraction depths themselves only
+stop at the Retrieve limit of 100.
+
+For extraction, a study's passages can be fetched once with a large k
+(bedrock-agent-runtime Retrieve) and re-ranked locally for each section
+family by lexical (BM25) overlap with that family's section and field names,
+so every prompt only carries the passages relevant to its fields.
+build_passage_prompt() and passage_citations() turn a selection into a
+Converse prompt and into citations shaped like RetrieveAndGenerate's.
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+
+KB_CHUNK_TOKENS        = int(os.environ.get('KB_CHUNK_TOKENS', 300))  # ~MAX_WORDS_PER_CHUNK words of ingestion
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get('RETRIEVAL_TOKEN_BUDGET', 9000))
+RERANK_POOL_SIZE       = int(os.environ.get('RERANK_POOL_SIZE', 80))
+RERANK_TOKEN_BUDGET    = int(os.environ.get('RERANK_TOKEN_BUDGET', 6000))
+# Evidence an extraction prompt needs per requested field: about one chunk
+RETRIEVAL_TOKENS_PER_FIELD = int(os.environ.get('RETRIEVAL_TOKENS_PER_FIELD', KB_CHUNK_TOKENS))
+MAX_RETRIEVAL_RESULTS  = 100  # Retrieve / RetrieveAndGenerate numberOfResults limit
+
+DEFAULT_DEPTHS = {
+    "file_lookup":   8,
+    "product_list":  15,
+    "normalization": 15,
+    "study_names":   25,
+    "extraction":    MAX_RETRIEVAL_RESULTS,
+    "rerank_pool":   MAX_RETRIEVAL_RESULTS,
+}
+
+STOPWORDS = {"the", "and", "for", "with", "from", "other", "per", "of", "in", "to", "or", "by", "vs"}
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+CAMEL_PATTERN = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+VECTOR_SCORE_WEIGHT = 0.3
+
+
+def load_depths():
+    raw = os.environ.get('BEDROCK_RETRIEVAL_DEPTHS', '').strip()
+    return {**DEFAULT_DEPTHS, **(json.loads(raw) if raw else {})}
+
+
+def field_token_budget(field_count, floor=RETRIEVAL_TOKEN_BUDGET):
+    """Token budget of a prompt asking for field_count fields; never below floor."""
+    return max(floor, field_count * RETRIEVAL_TOKENS_PER_FIELD)
+
+
+def retrieval_depth(task, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """numberOfResults for a prompt type, capped by how many chunks fit the token budget."""
+    depth = load_depths().get(task, DEFAULT_DEPTHS["extraction"])
+    return max(1, min(depth, token_budget // max(1, KB_CHUNK_TOKENS), MAX_RETRIEVAL_RESULTS))
+
+
+def rerank_pool_size(field_count):
+    """Passages to retrieve for a study's re-ranking pool: RERANK_POOL_SIZE, more for large schemas."""
+    return max(min(RERANK_POOL_SIZE, MAX_RETRIEVAL_RESULTS),
+               retrieval_depth("rerank_pool", field_token_budget(field_count)))
+
+
+def fold(token):
+    """Crude plural folding so "endpoint" matches "endpoints" and "rate" matches "rates"."""
+    return token[:-1] if len(token) > 4 and token.endswith('s') and not token.endswith('ss') else token
+
+
+def tokenize(text):
+    return [fold(t) for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 2 and t not in STOPWORDS]
+
+
+def section_terms(buckets, *extra):
+    """Query terms of a section family: its section names, field names and any extra words (drug, study)."""
+    words = []
+    for section, fields in buckets.items():
+        for name in [section, *fields]:
+            words.extend(tokenize(CAMEL_PATTERN.sub(' ', name).replace('_', ' ')))
+    for text in extra:
+        words.extend(tokenize(text or ""))
+    return set(words)
+
+
+def passage_text(passage):
+    return (passage.get("content") or {}).get("text", "")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def rerank(passages, terms, token_budget=RERANK_TOKEN_BUDGET):
+    """
+    Scores passages by BM25 over `terms` (IDF computed within the retrieved
+    pool) plus a small share of the vector score, and keeps the best ones
+    that fit in token_budget. Returns them best first.
+    """
+    if not passages:
+        return []
+    docs = [Counter(tokenize(passage_text(p))) for p in passages]
+    avg_len = sum(sum(d.values()) for d in docs) / len(docs) or 1.0
+    df = Counter(t for d in docs for t in terms if t in d)
+    idf = {t: math.log(1 + (len(docs) - df[t] + 0.5) / (df[t] + 0.5)) for t in terms}
+    max_vector = max((p.get("score") or 0.0) for p in passages) or 1.0
+
+    scored = []
+    for idx, (passage, doc) in enumerate(zip(passages, docs)):
+        length = sum(doc.values())
+        bm25 = sum(
+            idf[t] * doc[t] * (BM25_K1 + 1) / (doc[t] + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len))
+            for t in terms if t in doc
+        )
+        scored.append((bm25, (passage.get("score") or 0.0) / max_vector, idx))
+    max_bm25 = max(s[0] for s in scored) or 1.0
+    ranked = sorted(scored, key=lambda s: -(s[0] / max_bm25 + VECTOR_SCORE_WEIGHT * s[1]))
+
+    selected, used = [], 0
+    for _, _, idx in ranked:
+        cost = estimate_tokens(passage_text(passages[idx]))
+        if selected and used + cost > token_budget:
+            continue
+        selected.append(passages[idx])
+        used += cost
+    return selected
+
+
+def build_passage_prompt(prompt, passages):
+    """Prepends the selected passages, numbered, to an extraction prompt."""
+    lines = []
+    for n, passage in enumerate(passages, 1):
+        metadata = passage.get("metadata") or {}
+        source = metadata.get("file_name", "")
+        pages = metadata.get("page_numbers")
+        label = f"{source} p.{pages}" if pages else source
+        lines.append(f"[{n}] ({label}) {passage_text(passage)}")
+    return "Passages:\n" + "\n\n".join(lines) + "\n\n" + prompt
+
+
+def passage_citations(output_text, passages):
+    """RetrieveAndGenerate-shaped citations: the generated text backed by the passages it was given."""
+    return [{
+        "generatedResponsePart": {"textResponsePart": {"text": output_text, "span": {"start": 0, "end": len(output_text)}}},
+        "retrievedReferences": [
+            {k: passage[k] for k in ("content", "location", "metadata") if k in passage} for passage in passages
+        ]
+    }]
@@ -0,0 +1,76 @@
+"""
+S3 event notifications delivered in SQS batches.
+
+The bucket notifies an SQS queue instead of invoking the metadata Lambdas
+directly. The queue's event source mapping hands a Lambda up to batch_size
+messages at once and, with ReportBatchItemFailures, retries only the
+messages named in batchItemFailures; a message that keeps failing ends up in
+the queue's dead-letter queue.
+
+unpack_s3_event() flattens a batch into (messageId, S3 record) pairs.
+write_batch() applies unconditional puts and deletes through one
+batch_writer (25 items per BatchWriteItem); DeleteS3FileMetadata uses it.
+If that fails, the writes are replayed one by one, which is idempotent, so
+only the messages whose own write fails are retried. RecordS3FileMetadata
+needs a conditional write per row (an upload must not overwrite a newer
+state) and makes one update_item per record instead; it reports its
+failures through batch_response() the same way. A direct S3 invocation (messageId None) is still
+accepted; batch_response() raises on its failures so S3's own retry applies.
+"""
+import json
+
+
+def unpack_s3_event(event):
+    """Returns ([(messageId, S3 record)], failed messageIds). s3:TestEvent messages carry no records."""
+    pairs, failed = [], set()
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            pairs.append((None, record))
+            continue
+        try:
+            body = json.loads(record['body'])
+        except ValueError:
+            print(f"Message {record.get('messageId')} is not JSON; leaving it to the dead-letter queue.")
+            failed.add(record['messageId'])
+            continue
+        pairs.extend((record['messageId'], s3_record) for s3_record in body.get('Records', []))
+    return pairs, failed
+
+
+def write_batch(table, operations, key_names):
+    """
+    operations: [(messageId, "put", item) or (messageId, "delete", key)].
+    Returns the messageIds whose write failed. Later operations on the same
+    key win, as they would have one call at a time.
+    """
+    if not operations:
+        return set()
+    try:
+        with table.batch_writer(overwrite_by_pkeys=key_names) as writer:
+            for _, action, payload in operations:
+                if action == "put":
+                    writer.put_item(Item=payload)
+                else:
+                    writer.delete_item(Key=payload)
+        return set()
+    except Exception as e:
+        print(f"Batch write of {len(operations)} item(s) failed ({e}); retrying them one by one.")
+
+    failed = set()
+    for message_id, action, payload in operations:
+        try:
+            if action == "put":
+                table.put_item(Item=payload)
+            else:
+                table.delete_item(Key=payload)
+        except Exception as e:
+            print(f"Write for message {message_id} failed: {e}")
+            failed.add(message_id)
+    return failed
+
+
+def batch_response(failed_message_ids):
+    failed = set(failed_message_ids)
+    if None in failed:
+        raise RuntimeError("Direct S3 invocation had failed records; failing it so S3 retries.")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in sorted(failed)]}
@@ -0,0 +1,207 @@
+"""
+Versioned extraction schemas, one per indication.
+
+A schema names its extraction prompts ("parts") and, for each part, the
+sections and LLM field keys the prompt asks for. KEY_MAP gives every LLM key
+its (top-level section, field name) in the summary document. The schema used
+for a study is the event's "schema" field, else EXTRACTION_SCHEMA, else "hae".
+Bump a schema's version whenever its fields change; the name and version are
+stored in every summary (__schema__) so documents stay attributable.
+
+Sections may list evidence phrases. With a passage pool at hand,
+prune_sections() drops the sections whose phrases appear in none of the
+passages, so their fields are never asked for; a part left with no sections
+is not sent at all. Sections without evidence phrases are always kept.
+"""
+import os
+
+DEFAULT_SCHEMA = os.environ.get('EXTRACTION_SCHEMA', 'hae')
+
+PARTS = ("Part1", "Part2", "Metadata")
+METADATA_PART = "Metadata"
+
+KEY_MAP = {
+    "PRODUCT_OVERVIEW_DRUG_NAME": ("ProductOverview", "DrugName"),
+    "PRODUCT_OVERVIEW_MECHANISM_OF_ACTION": ("ProductOverview", "MechanismOfAction"),
+    "PRODUCT_OVERVIEW_ROUTE_OF_ADMINISTRATION": ("ProductOverview", "RouteOfAdministration"),
+    "PRODUCT_OVERVIEW_COMPANY": ("ProductOverview", "Company"),
+    "PRODUCT_OVERVIEW_LONG_TERM_REGISTRY_NUMBER": ("ProductOverview", "LongTermClinicalTrialRegistryNumber"),
+    "STUDY_DETAILS_STUDY_TYPE": ("StudyDetails", "StudyType"),
+    "STUDY_DETAILS_REGISTRY_NUMBER": ("StudyDetails", "ClinicalTrialRegistryNumber"),
+    "STUDY_DETAILS_LONG_TERM_DETAILS": ("StudyDetails", "LongTermStudyDetails"),
+    "STUDY_DETAILS_DESIGN": ("StudyDetails", "StudyDesign"),
+    "STUDY_DETAILS_ELIGIBILITY_CRITERIA": ("StudyDetails", "EligibilityCriteria"),
+    "STUDY_DETAILS_TRIAL_DURATION_WEEKS": ("StudyDetails", "TrialDurationWeeks"),
+    "STUDY_DETAILS_NUMBER_OF_PATIENTS": ("StudyDetails", "NumberOfPatients"),
+    "STUDY_DETAILS_STATUS": ("StudyDetails", "StudyStatus"),
+    "EFFICACY_PRIMARY_ENDPOINTS": ("EfficacyEndpoints", "PrimaryEndpoints"),
+    "EFFICACY_SECONDARY_ENDPOINTS": ("EfficacyEndpoints", "SecondaryEndpoints"),
+    "EFFICACY_EXPLORATORY_ENDPOINTS": ("EfficacyEndpoints", "ExploratoryEndpoints"),
+    "ATTACK_RATES_MEAN_HAE_PER_MONTH": ("AttackRates", "MeanHAEAttacksPerMonth"),
+    "ATTACK_RATES_LSM_HAE_PER_MONTH": ("AttackRates", "LSMHAEAttacksPerMonth"),
+    "ATTACK_RATES_MEDIAN_HAE_PER_MONTH": ("AttackRates", "MedianHAEAttacksPerMonth"),
+    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_VS_PLACEBO": ("AttackRates", "PercentReductionMeanActiveVsPlacebo"),
+    "ATTACK_RATES_PERCENT_REDUCTION_LSM_VS_PLACEBO": ("AttackRates", "PercentReductionLSMActiveVsPlacebo"),
+    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_VS_PLACEBO": ("AttackRates", "PercentReductionMedianActiveVsPlacebo"),
+    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "PercentReductionMeanFromBaseline"),
+    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE": ("AttackRates", "PercentReductionMedianFromBaseline"),
+    "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE": ("AttackRates", "NumericalReductionMeanFromBaseline"),
+    "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN": ("AttackRates", "PercentPatients100ReductionVsRunIn"),
+    "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION": ("AttackRates", "PercentPatients90PlusReduction"),
+    "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION": ("AttackRates", "PercentPatients70PlusReduction"),
+    "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION": ("AttackRates", "PercentPatients50PlusReduction"),
+    "ATTACK_RATES_OTHER_TIME_FRAMES": ("AttackRates", "AttackRateOtherTimeFrames"),
+    "ATTACK_RATES_BY_BASELINE_RATE": ("AttackRates", "AttackRateByBaselineRate"),
+    "RESCUE_MED_MEAN_PER_MONTH": ("RescueMedicationUse", "MeanRescueMedicationsPerMonth"),
+    "RESCUE_MED_ATTACKS_REQUIRING_RESCUE": ("RescueMedicationUse", "AttacksPerMonthRequiringRescue"),
+    "ATTACK_PARAMETERS_SEVERITY": ("AttackParameters", "SeverityOfAttacks"),
+    "ATTACK_PARAMETERS_DURATION": ("AttackParameters", "DurationOfAttacks"),
+    "ATTACK_PARAMETERS_DAYS_SWELLING": ("AttackParameters", "DaysOfSwellingSymptoms"),
+    "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK": ("AttackParameters", "TimeToFirstAttack"),
+    "ATTACK_PARAMETERS_BY_LOCATION": ("AttackParameters", "AttacksByLocation"),
+    "PRO_DATA_AE_QOL_CHANGE": ("PatientReportedOutcomes", "AEQOLScoreChange"),
+    "PRO_DATA_PERCENT_GOOD_ON_SGART": ("PatientReportedOutcomes", "PercentRatingGoodOnSGART"),
+    "PRO_DATA_AECT_SCORE_WEEK_25": ("PatientReportedOutcomes", "AECTScoreWeek25"),
+    "PRO_DATA_TSQM_DETAILS": ("PatientReportedOutcomes", "TSQMDetails"),
+    "PK_PD_SUMMARY": ("PharmacokineticsPharmacodynamics", "PKPDDataSummary"),
+    "ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS": ("AdditionalExploratoryEndpointsDetails", "Details"),
+    "REFERENCES_LIST": ("ReferencesAndFootnotes", "ReferencesList"),
+    "FOOTNOTES_LIST": ("ReferencesAndFootnotes", "FootnotesList")
+}
+
+EFFICACY_ENDPOINTS = [
+    "EFFICACY_PRIMARY_ENDPOINTS",
+    "EFFICACY_SECONDARY_ENDPOINTS",
+    "EFFICACY_EXPLORATORY_ENDPOINTS"
+]
+
+STUDY_DETAILS = [
+    "STUDY_DETAILS_STUDY_TYPE",
+    "STUDY_DETAILS_REGISTRY_NUMBER",
+    "STUDY_DETAILS_LONG_TERM_DETAILS",
+    "STUDY_DETAILS_DESIGN",
+    "STUDY_DETAILS_ELIGIBILITY_CRITERIA",
+    "STUDY_DETAILS_TRIAL_DURATION_WEEKS",
+    "STUDY_DETAILS_NUMBER_OF_PATIENTS",
+    "STUDY_DETAILS_STATUS"
+]
+
+SCHEMAS = {
+    # Hereditary angioedema: the schema the pipeline was built around.
+    "hae": {
+        "version": 1,
+        "parts": {
+            "Part1": {
+                "EfficacyEndpoints": EFFICACY_ENDPOINTS,
+                "AttackRates": [
+                    "ATTACK_RATES_MEAN_HAE_PER_MONTH",
+                    "ATTACK_RATES_LSM_HAE_PER_MONTH",
+                    "ATTACK_RATES_MEDIAN_HAE_PER_MONTH",
+                    "ATTACK_RATES_PERCENT_REDUCTION_MEAN_FROM_BASELINE",
+                    "ATTACK_RATES_PERCENT_REDUCTION_MEDIAN_FROM_BASELINE",
+                    "ATTACK_RATES_NUMERICAL_REDUCTION_MEAN_FROM_BASELINE",
+                    "ATTACK_RATES_PERCENT_PATIENTS_100_REDUCTION_VS_RUNIN",
+                    "ATTACK_RATES_PERCENT_PATIENTS_90_PLUS_REDUCTION",
+                    "ATTACK_RATES_PERCENT_PATIENTS_70_PLUS_REDUCTION",
+                    "ATTACK_RATES_PERCENT_PATIENTS_50_PLUS_REDUCTION",
+                    "ATTACK_RATES_OTHER_TIME_FRAMES",
+                    "ATTACK_RATES_BY_BASELINE_RATE"
+                ],
+                "AttackParameters": [
+                    "ATTACK_PARAMETERS_SEVERITY",
+                    "ATTACK_PARAMETERS_DURATION",
+                    "ATTACK_PARAMETERS_DAYS_SWELLING",
+                    "ATTACK_PARAMETERS_TIME_TO_FIRST_ATTACK",
+                    "ATTACK_PARAMETERS_BY_LOCATION"
+                ],
+            },
+            "Part2": {
+                "StudyDetails": STUDY_DETAILS,
+                "PatientReportedOutcomes": [
+                    "PRO_DATA_AE_QOL_CHANGE",
+                    "PRO_DATA_PERCENT_GOOD_ON_SGART",
+                    "PRO_DATA_AECT_SCORE_WEEK_25",
+                    "PRO_DATA_TSQM_DETAILS"
+                ],
+                "RescueMedicationUse": [
+                    "RESCUE_MED_MEAN_PER_MONTH",
+                    "RESCUE_MED_ATTACKS_REQUIRING_RESCUE"
+                ],
+                "PharmacokineticsPharmacodynamics": ["PK_PD_SUMMARY"],
+                "AdditionalExploratoryEndpointsDetails": ["ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS"],
+                "ReferencesAndFootnotes": ["REFERENCES_LIST", "FOOTNOTES_LIST"],
+            },
+            "Metadata": {
+                "TrialAndProduct": ["NCT", "TrialName", "ProductName", "StartDate", "EndDate", "MechanismOfAction"],
+                "PatientCriteria": ["Age", "HAESubtype", "GeographicalLocation", "SexRestriction", "EthnicityRaceRestriction", "OtherRelevantRestriction"],
+                "Documentation": ["References", "Footnotes"]
+            },
+        },
+        "evidence": {
+            "AttackRates": ["attack"],
+            "AttackParameters": ["attack", "swelling"],
+            "PatientReportedOutcomes": ["quality of life", "aeqol", "ae-qol", "sgart", "aect", "tsqm", "patient-reported", "patient reported"],
+            "RescueMedicationUse": ["rescue", "on-demand"],
+            "PharmacokineticsPharmacodynamics": ["pharmacokinetic", "pharmacodynamic", "plasma concentration", "cmax", "half-life"],
+            "AdditionalExploratoryEndpointsDetails": ["exploratory"],
+        },
+    },
+    # Indication-neutral fallback: endpoints, design and metadata only.
+    "generic": {
+        "version": 1,
+        "parts": {
+            "Part1": {
+                "EfficacyEndpoints": EFFICACY_ENDPOINTS,
+                "AdditionalExploratoryEndpointsDetails": ["ADDITIONAL_EXPLORATORY_ENDPOINTS_DETAILS"],
+            },
+            "Part2": {
+                "StudyDetails": STUDY_DETAILS,
+                "PharmacokineticsPharmacodynamics": ["PK_PD_SUMMARY"],
+                "ReferencesAndFootnotes": ["REFERENCES_LIST", "FOOTNOTES_LIST"],
+            },
+            "Metadata": {
+                "TrialAndProduct": ["NCT", "TrialName", "ProductName", "StartDate", "EndDate", "MechanismOfAction"],
+                "PatientCriteria": ["Age", "GeographicalLocation", "SexRestriction", "EthnicityRaceRestriction", "OtherRelevantRestriction"],
+                "Documentation": ["References", "Footnotes"]
+            },
+        },
+        "evidence": {
+            "PharmacokineticsPharmacodynamics": ["pharmacokinetic", "pharmacodynamic", "plasma concentration", "cmax", "half-life"],
+            "AdditionalExploratoryEndpointsDetails": ["exploratory"],
+        },
+    },
+}
+
+
+def get_schema(name=None):
+    """The named schema (falling back to EXTRACTION_SCHEMA), with its name filled in."""
+    name = (name or DEFAULT_SCHEMA).lower()
+    if name not in SCHEMAS:
+        print(f"⚠️ Unknown extraction schema '{name}', using '{DEFAULT_SCHEMA}'.")
+        name = DEFAULT_SCHEMA
+    return {"name": name, **SCHEMAS[name]}
+
+
+def clinical_sections(schema):
+    """Every non-metadata section of the schema, in prompt order."""
+    return {sec: keys for part, sections in schema["parts"].items() if part != METADATA_PART for sec, keys in sections.items()}
+
+
+def prune_sections(schema, part, passages):
+    """
+    Returns (kept, dropped) for one part: the sections worth asking for given
+    the retrieved passages, and the names of those with no evidence in them.
+    """
+    text = " ".join(((p.get("content") or {}).get("text") or "") for p in passages).lower()
+    kept, dropped = {}, []
+    for section, keys in schema["parts"][part].items():
+        phrases = schema.get("evidence", {}).get(section)
+        if phrases and not any(phrase in text for phrase in phrases):
+            dropped.append(section)
+        else:
+            kept[section] = keys
+    return kept, dropped
+
+
+def schema_tag(schema, pruned=()):
+    return {"name": schema["name"], "version": schema["version"], "prunedSections": sorted(pruned)}
@@ -0,0 +1,95 @@
+"""
+Latest-summary pointers.
+
+Summaries are written under timestamped S3 keys (summary_<study>_<ts>.json,
+aggregated-summaries/<ts>.json), so finding the current one used to mean
+listing an ever-growing prefix. Every writer now records what it wrote in
+the metadata table instead:
+
+    __SUMMARY__#<folderId>#<scope>                     s3Key, version, sizeBytes, writtenAtUtc
+    __SUMMARY_VERSION__#<folderId>#<scope>#<version>   the same, one item per version written
+
+scope is "__AGGREGATE__" for the folder's aggregated summary (with its
+section index) or the study's key for a study summary. Reading the latest
+summary is one GetItem (latest_summary); older versions are a Query on the
+version items (summary_versions), newest first.
+
+The pointer only moves forward: a write whose writtenAtUtc is older than the
+recorded one, e.g. a slow retry of a superseded summary, still gets a
+version item but leaves the pointer alone.
+"""
+import re
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+
+SUMMARY_ITEM_MARKER = "__SUMMARY__"
+SUMMARY_VERSION_MARKER = "__SUMMARY_VERSION__"
+AGGREGATE_SCOPE = "__AGGREGATE__"
+SORT_KEY = "sessionId#fileName"
+
+
+def study_scope(study_name):
+    """The study's key, as in the pipelined study registry (ExtractFileStudies)."""
+    return re.sub(r'[^a-z0-9]+', '-', study_name.lower()).strip('-') or "unnamed"
+
+
+def pointer_key(user_id, folder_id, scope=AGGREGATE_SCOPE):
+    return {'userId': user_id, SORT_KEY: f"{SUMMARY_ITEM_MARKER}#{folder_id}#{scope}"}
+
+
+def version_key(user_id, folder_id, scope, version):
+    return {'userId': user_id, SORT_KEY: f"{SUMMARY_VERSION_MARKER}#{folder_id}#{scope}#{int(version):08d}"}
+
+
+def record_summary(table, user_id, folder_id, scope, s3_key, size_bytes, attributes=None):
+    """
+    Records s3_key as the newest version of the folder's (or study's)
+    summary. attributes are stored with it (e.g. studyName,
+    sectionIndexS3Key). Returns the version number given to it.
+    """
+    written_at = datetime.now(timezone.utc).isoformat()
+    values = {**(attributes or {}), 's3Key': s3_key, 'sizeBytes': int(size_bytes or 0), 'writtenAtUtc': written_at}
+    names = {f"#a{i}": name for i, name in enumerate(values)}
+    key = pointer_key(user_id, folder_id, scope)
+    try:
+        version = table.update_item(
+            Key=key,
+            UpdateExpression="SET " + ", ".join(f"#a{i} = :a{i}" for i in range(len(values))) + " ADD version :one",
+            ConditionExpression="attribute_not_exists(writtenAtUtc) OR writtenAtUtc <= :w",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={**{f":a{i}": value for i, value in enumerate(values.values())},
+                                       ':one': 1, ':w': written_at},
+            ReturnValues="UPDATED_NEW"
+        )['Attributes']['version']
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # A newer summary is already the latest; only number this one
+        version = table.update_item(
+            Key=key, UpdateExpression="ADD version :one", ExpressionAttributeValues={':one': 1},
+            ReturnValues="UPDATED_NEW"
+        )['Attributes']['version']
+    table.put_item(Item={**version_key(user_id, folder_id, scope, version), **values, 'version': version})
+    return int(version)
+
+
+def latest_summary(table, user_id, folder_id, scope=AGGREGATE_SCOPE):
+    """The pointer item ({s3Key, version, sizeBytes, writtenAtUtc, ...}), or None if nothing was recorded."""
+    return table.get_item(Key=pointer_key(user_id, folder_id, scope)).get('Item')
+
+
+def summary_versions(table, user_id, folder_id, scope=AGGREGATE_SCOPE, limit=None):
+    """The recorded versions of a summary, newest first."""
+    query_kwargs = {
+        'KeyConditionExpression': Key('userId').eq(user_id)
+                                  & Key(SORT_KEY).begins_with(f"{SUMMARY_VERSION_MARKER}#{folder_id}#{scope}#"),
+        'ScanIndexForward': False
+    }
+    versions = []
+    while True:
+        if limit:
+            query_kwargs['Limit'] = limit - len(versions)
+        response = table.query(**query_kwargs)
+        versions.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response or (limit and len(versions) >= limit):
+            return versions
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -0,0 +1,126 @@
+"""
+Recomputes the folder counters (see folder_counters in the docrag_shared
+layer) from the rows of an existing metadata table.
+
+The writers keep the counters current with ADD updates from the moment they
+are deployed; folders with files from before then start from zero. This
+scans every row, sums each file's row into its folder exactly as the
+writers count them (row_contribution), and SETs the totals on the folder
+items and on each user's change version item:
+
+  filesUploaded, bytesUploaded, filesIngested, bytesIngested, pagesIngested, chunksIngested, filesFailed
+
+bedrockCalls has no source rows and is left as it is. pagesIngested only
+covers files ingested since pagesCount was recorded. Run
+migrate_ingestion_records.py first on tables that still hold separate
+ingestion records; they are not counted.
+
+Run it as well when a writer reports a FolderCounterFailures metric (its
+ERROR log line lists the folders concerned).
+
+The totals overwrite the counters, so run it while no uploads, deletes or
+ingestion runs are in flight; an ADD landing between the scan and the SET
+would be lost. Re-running it is safe.
+
+Usage:
+
+    python AWS_backend/scripts/backfill_folder_counters.py --table <name>-<env>-metadata [--segments 8] [--dry-run]
+"""
+import argparse
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'docrag_shared', 'python'))
+from change_version import bump_change_version, change_version_key  # noqa: E402
+from folder_counters import folder_item_key, row_contribution  # noqa: E402
+
+SORT_KEY = "sessionId#fileName"
+INTERNAL_PREFIXES = ("__FOLDER_INFO__#", "__STUDY__#", "__SUMMARY__#", "__SUMMARY_VERSION__#", "__CHANGES__", "__KB_SYNC__",
+                     "__RUN_QUEUE__#", "__RUN_TENANT__#")
+RECOMPUTED = ("filesUploaded", "bytesUploaded", "filesIngested", "bytesIngested",
+              "pagesIngested", "chunksIngested", "filesFailed")
+
+
+def contribution(item):
+    """(folderId, the row's share) for file rows, else None."""
+    if item[SORT_KEY].startswith(INTERNAL_PREFIXES):
+        return None
+    if item.get('userFolder') and item.get('sessionId'):
+        return f"{item['sessionId']}/{item['userFolder']}", row_contribution(item)
+    return None
+
+
+def scan_segment(table, segment, total_segments, totals, lock):
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': 'userId, #sk, #st, sessionId, userFolder, fileSize, fileType, '
+                                'sourceETag, sourceSize, pagesCount, chunksCount',
+        'ExpressionAttributeNames': {'#sk': SORT_KEY, '#st': 'status'}
+    }
+    local = defaultdict(Counter)
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            counted = contribution(item)
+            if counted:
+                folder_id, share = counted
+                local[(item['userId'], folder_id)].update(share)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    with lock:
+        for key, share in local.items():
+            totals[key].update(share)
+
+
+def set_counters(table, key, values):
+    names = {f"#c{i}": name for i, name in enumerate(RECOMPUTED)}
+    table.update_item(
+        Key=key,
+        UpdateExpression="SET " + ", ".join(f"#c{i} = :c{i}" for i in range(len(RECOMPUTED))),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues={f":c{i}": values.get(name, 0) for i, name in enumerate(RECOMPUTED)}
+    )
+
+
+def backfill(table, segments=8, dry_run=False):
+    totals, lock = defaultdict(Counter), threading.Lock()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(scan_segment, table, seg, segments, totals, lock) for seg in range(segments)]
+        for future in futures:
+            future.result()
+
+    per_user = defaultdict(Counter)
+    for (user_id, _), values in totals.items():
+        per_user[user_id].update(values)
+    if not dry_run:
+        for (user_id, folder_id), values in totals.items():
+            set_counters(table, folder_item_key(user_id, folder_id), values)
+        for user_id, values in per_user.items():
+            set_counters(table, change_version_key(user_id), values)
+            # Cached listings and usage views are keyed by the version
+            bump_change_version(table, user_id)
+    return {"folders": len(totals), "users": len(per_user), "totals": dict(sum(per_user.values(), Counter()))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--region', default=None)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    report = backfill(table, max(1, args.segments), args.dry_run)
+    print(f"{'Dry run' if args.dry_run else 'Backfill'} of {args.table}: {report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Backfills folderKey, the FolderIndex GSI key, on an existing metadata table.
+
+New rows get folderKey when they are written (RecordS3FileMetadata for
+uploaded files, IngestFileToBedrockKB for ingestion records). Rows written
+before FolderIndex existed are invisible to it until this has run:
+
+  uploaded files     folderKey = "<userId>#<sessionId>/<userFolder>"
+  ingestion records  folderKey = "<userId>#<folderId>"
+
+Folder items (__FOLDER_INFO__#...), study registry items (__STUDY__#...) and
+summary pointers (__SUMMARY__#...) are left out on purpose; they are read
+from the base table.
+
+The scan is split into parallel segments and only reads rows without
+folderKey, and every update is conditional on the row still existing and
+still lacking folderKey, so the tool is safe to re-run or to run while the
+application is live. Once it reports no remaining rows, set
+folder_index_reads = true in Terraform so the Lambdas query the index.
+
+Usage:
+
+    python AWS_backend/scripts/backfill_folder_index.py --table <name>-<env>-metadata [--segments 8] [--dry-run]
+"""
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+SORT_KEY = "sessionId#fileName"
+INTERNAL_PREFIXES = ("__FOLDER_INFO__#", "__STUDY__#", "__SUMMARY__#", "__SUMMARY_VERSION__#", "__RUN_QUEUE__#", "__RUN_TENANT__#")
+
+
+def folder_key(item):
+    """The folderKey a row should carry, or None for rows that stay out of the index."""
+    sort_key = item[SORT_KEY]
+    if sort_key.startswith(INTERNAL_PREFIXES):
+        return None
+    if item.get('folderId'):
+        return f"{item['userId']}#{item['folderId']}"
+    if item.get('sessionId') and item.get('userFolder'):
+        return f"{item['userId']}#{item['sessionId']}/{item['userFolder']}"
+    return None
+
+
+def backfill_segment(table, segment, total_segments, dry_run, counts, lock):
+    client_exceptions = table.meta.client.exceptions
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'FilterExpression': Attr('folderKey').not_exists(),
+        'ProjectionExpression': 'userId, #sk, folderId, sessionId, userFolder',
+        'ExpressionAttributeNames': {'#sk': SORT_KEY}
+    }
+    local = Counter()
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            key_value = folder_key(item)
+            if key_value is None:
+                local['skipped'] += 1
+                continue
+            if dry_run:
+                local['would_update'] += 1
+                continue
+            try:
+                table.update_item(
+                    Key={'userId': item['userId'], SORT_KEY: item[SORT_KEY]},
+                    UpdateExpression="SET folderKey = :fk",
+                    ConditionExpression="attribute_exists(#sk) AND attribute_not_exists(folderKey)",
+                    ExpressionAttributeNames={'#sk': SORT_KEY},
+                    ExpressionAttributeValues={':fk': key_value}
+                )
+                local['updated'] += 1
+            except client_exceptions.ConditionalCheckFailedException:
+                # Deleted or given a folderKey by the application since the scan
+                local['raced'] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    with lock:
+        counts.update(local)
+
+
+def backfill(table, segments=8, dry_run=False):
+    counts, lock = Counter(), threading.Lock()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(backfill_segment, table, seg, segments, dry_run, counts, lock) for seg in range(segments)]
+        for future in futures:
+            future.result()
+    return dict(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--region', default=None)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    counts = backfill(table, max(1, args.segments), args.dry_run)
+    print(f"{'Dry run' if args.dry_run else 'Backfill'} of {args.table}: {counts}")
+
+
+if __name__ == '__main__':
+    main()
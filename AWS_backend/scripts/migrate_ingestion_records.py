@@ -0,0 +1,155 @@
+"""
+Folds the separate ingestion records of an existing metadata table onto the
+files' rows (see file_status in the docrag_shared layer).
+
+IngestFileToBedrockKB used to write its outcome to a record of its own,
+
+    sessionId#fileName = "<session>#<path within the folder>"
+
+next to the file's row ("<session>#<userFolder>#<path>"), so the row never
+left "unprocessed". This copies every such record's ingestion fields onto
+the file's row, maps its job status to the row's status and deletes it:
+
+  COMPLETE                        ingested
+  FAILED, STOPPED or an error     ingest_failed (processingError = error)
+  anything else                   ingesting
+
+A record whose file row is gone (the file was deleted from S3) becomes a
+"deleted" tombstone, so the folder's next run still detaches the file from
+its studies. A row that has a newer status than the record is not
+overwritten; the record is dropped all the same.
+
+The folder counters are not adjusted; run backfill_folder_counters.py
+afterwards. Re-running it is safe: migrated records no longer exist.
+
+Usage:
+
+    python AWS_backend/scripts/migrate_ingestion_records.py --table <name>-<env>-metadata [--segments 8] [--dry-run]
+"""
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'docrag_shared', 'python'))
+from change_version import bump_change_version  # noqa: E402
+from file_status import (  # noqa: E402
+    DELETED, INGEST_FAILED, INGESTED, INGESTING, INGESTION_ATTRIBUTES, event_time_ms, file_key, file_parts
+)
+
+SORT_KEY = "sessionId#fileName"
+INTERNAL_PREFIXES = ("__FOLDER_INFO__#", "__STUDY__#", "__SUMMARY__#", "__SUMMARY_VERSION__#", "__CHANGES__", "__KB_SYNC__",
+                     "__RUN_QUEUE__#", "__RUN_TENANT__#")
+
+
+def migrated_status(record):
+    """(status, statusAtMs) of the file row for a legacy record."""
+    job_status = record.get('status')
+    if job_status in ('FAILED', 'STOPPED') or record.get('error'):
+        status = INGEST_FAILED
+    elif job_status == 'COMPLETE':
+        status = INGESTED
+    else:
+        status = INGESTING
+    at = record.get('completedAtUtc') or record.get('startedAtUtc')
+    return status, event_time_ms(at) if at else 1
+
+
+def fold_record(table, record):
+    """Moves one record onto its file's row. Returns what happened, for the report."""
+    folder_id, relative_name = record['folderId'], record[SORT_KEY].split('#', 1)[1]
+    key = file_key(record['userId'], folder_id, relative_name)
+    session_id, user_folder, file_name = file_parts(folder_id, relative_name)
+    status, at_ms = migrated_status(record)
+
+    values = {name: record[name] for name in INGESTION_ATTRIBUTES if record.get(name) is not None}
+    values.update({'ingestionJobStatus': record.get('status'), 'statusAtMs': at_ms,
+                   'folderKey': f"{record['userId']}#{folder_id}"})
+    if record.get('error'):
+        values['processingError'] = record['error']
+
+    outcome = "merged"
+    existing = table.get_item(Key=key, ProjectionExpression="#sk", ExpressionAttributeNames={'#sk': SORT_KEY}).get('Item')
+    if existing:
+        values['status'] = status
+    else:
+        # Without the file there are no chunks to count; the tombstone only drives detaching
+        values.update({'status': DELETED, 'sessionId': session_id, 'userFolder': user_folder,
+                       'fileName': file_name, 'fileType': 'main', 'originalS3Key': record['sourceS3Key']})
+        values.pop('sourceETag', None)
+        outcome = "tombstoned"
+
+    names = {f"#s{i}": name for i, name in enumerate(values)}
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression="SET " + ", ".join(f"#s{i} = :s{i}" for i in range(len(values))),
+            ConditionExpression="attribute_not_exists(statusAtMs) OR statusAtMs < :at",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={**{f":s{i}": value for i, value in enumerate(values.values())}, ':at': at_ms}
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        outcome = "superseded"
+    table.delete_item(Key={'userId': record['userId'], SORT_KEY: record[SORT_KEY]})
+    return outcome
+
+
+def migrate_segment(table, segment, total_segments, dry_run, counts, users, lock):
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        # Ingestion records carry the folder and source but, unlike file rows, no userFolder
+        'FilterExpression': Attr('sourceS3Key').exists() & Attr('folderId').exists() & Attr('userFolder').not_exists()
+    }
+    local, local_users = Counter(), set()
+    while True:
+        response = table.scan(**scan_kwargs)
+        for record in response.get('Items', []):
+            if record[SORT_KEY].startswith(INTERNAL_PREFIXES):
+                continue
+            if dry_run:
+                local['would_migrate'] += 1
+                continue
+            local[fold_record(table, record)] += 1
+            local_users.add(record['userId'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    with lock:
+        counts.update(local)
+        users.update(local_users)
+
+
+def migrate(table, segments=8, dry_run=False):
+    counts, users, lock = Counter(), set(), threading.Lock()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(migrate_segment, table, seg, segments, dry_run, counts, users, lock)
+                   for seg in range(segments)]
+        for future in futures:
+            future.result()
+    for user_id in users:
+        # Cached listings are keyed by the version
+        bump_change_version(table, user_id)
+    return {**counts, "users": len(users)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--region', default=None)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    report = migrate(table, max(1, args.segments), args.dry_run)
+    print(f"{'Dry run' if args.dry_run else 'Migration'} of {args.table}: {report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,11 @@ resource "aws_apigatewayv2_api" "rag_api" {
 
   # The CORS configuration is now defined directly on the API resource.
   cors_configuration {
-    allow_origins = ["http://localhost:3000", "https://meddocs.sriganesh.blog"] # Added both known URLs
-    allow_methods = ["GET", "OPTIONS", "POST"]
-    allow_headers = ["authorization", "content-type", "x-amz-date", "x-api-key", "x-amz-security-token"]
-    max_age       = 3600
+    allow_origins  = ["http://localhost:3000", "https://meddocs.sriganesh.blog"] # Added both known URLs
+    allow_methods  = ["GET", "OPTIONS", "POST"]
+    allow_headers  = ["authorization", "content-type", "x-amz-date", "x-api-key", "x-amz-security-token", "if-none-match"]
+    expose_headers = ["etag"]
+    max_age        = 3600
   }
 
   tags = {
@@ -50,6 +51,14 @@ resource "aws_apigatewayv2_integration" "process_folder_integration" {
   timeout_milliseconds   = 30000
 }
 
+resource "aws_apigatewayv2_integration" "query_summary_integration" {
+  api_id                 = aws_apigatewayv2_api.rag_api.id
+  integration_type       = "AWS_PROXY"
+  integration_uri        = aws_lambda_function.query_aggregated_summary_lambda.invoke_arn
+  payload_format_version = "2.0"
+  timeout_milliseconds   = 30000
+}
+
 # --- Routes for the API ---
 
 resource "aws_apigatewayv2_route" "myfiles_get_route" {
@@ -70,6 +79,15 @@ resource "aws_apigatewayv2_route" "processfolder_post_route" {
   authorizer_id      = aws_apigatewayv2_authorizer.cognito_authorizer.id
 }
 
+resource "aws_apigatewayv2_route" "summary_sections_get_route" {
+  api_id    = aws_apigatewayv2_api.rag_api.id
+  route_key = "GET /summary/sections"
+  target    = "integrations/${aws_apigatewayv2_integration.query_summary_integration.id}"
+
+  authorization_type = "JWT"
+  authorizer_id      = aws_apigatewayv2_authorizer.cognito_authorizer.id
+}
+
 # This defines the default stage and enables auto-deployment.
 resource "aws_apigatewayv2_stage" "rag_api_stage" {
   api_id      = aws_apigatewayv2_api.rag_api.id
@@ -106,5 +124,14 @@ resource "aws_lambda_permission" "apigw_invoke_initiate_folder_processing_lambda
   source_arn = "${aws_apigatewayv2_api.rag_api.execution_arn}/*"
 }
 
+resource "aws_lambda_permission" "apigw_invoke_query_aggregated_summary_lambda" {
+  statement_id  = "AllowAPIGWInvokeQueryAggregatedSummary"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.query_aggregated_summary_lambda.function_name
+  principal     = "apigateway.amazonaws.com"
+
+  source_arn = "${aws_apigatewayv2_api.rag_api.execution_arn}/*"
+}
+
 
 # REMOVED: All S3 event notification resources have been moved to s3.tf
@@ -17,6 +17,21 @@ resource "aws_dynamodb_table" "file_metadata_table" {
     name = "sessionId#fileName"
     type = "S"
   }
+  attribute {
+    name = "folderKey"
+    type = "S"
+  }
+
+  # Sparse index of the per-file rows of one folder (uploaded files and their
+  # ingestion records), keyed "<userId>#<folderId>". Only rows carrying
+  # folderKey are indexed; folder items themselves are read from the base
+  # table under the __FOLDER_INFO__# sort-key prefix.
+  global_secondary_index {
+    name            = "FolderIndex"
+    hash_key        = "folderKey"
+    range_key       = "sessionId#fileName"
+    projection_type = "ALL"
+  }
 
   tags = {
     Project     = var.project_name
@@ -37,14 +37,20 @@ resource "aws_iam_policy" "lambda_custom_policy" {
         Effect   = "Allow",
         Action   = [
           "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:GetItem",
-          "dynamodb:Query", "dynamodb:DeleteItem"
+          "dynamodb:Query", "dynamodb:DeleteItem", "dynamodb:BatchWriteItem",
+          # Writers read the rows they replace to keep the folder counters exact
+          "dynamodb:BatchGetItem"
         ],
-        Resource = aws_dynamodb_table.file_metadata_table.arn
+        Resource = [
+          aws_dynamodb_table.file_metadata_table.arn,
+          "${aws_dynamodb_table.file_metadata_table.arn}/index/*"
+        ]
       },
       {
         Effect   = "Allow",
         Action   = [
-          "s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:ListBucket"
+          "s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:ListBucket",
+          "s3:AbortMultipartUpload"
         ],
         Resource = [
           aws_s3_bucket.main_bucket.arn,
@@ -64,8 +70,9 @@ resource "aws_iam_policy" "lambda_custom_policy" {
         ],
         Resource = [
           "arn:aws:bedrock:${var.aws_region}:${data.aws_caller_identity.current.account_id}:knowledge-base/*",
-          "arn:aws:bedrock:${var.aws_region}::foundation-model/*",
-          "arn:aws:bedrock:${var.aws_region}::inference-profile/*"
+          # Cross-region inference profiles route to foundation models in other regions
+          "arn:aws:bedrock:*::foundation-model/*",
+          "arn:aws:bedrock:${var.aws_region}:${data.aws_caller_identity.current.account_id}:inference-profile/*"
         ]
       },
       {
@@ -80,6 +87,24 @@ resource "aws_iam_policy" "lambda_custom_policy" {
         Effect   = "Allow",
         Action   = "states:StartExecution",
         Resource = aws_sfn_state_machine.folder_processing_state_machine.id
+      },
+      {
+        # AdmitFolderRuns frees the admission slots of executions that have ended
+        Effect   = "Allow",
+        Action   = "states:DescribeExecution",
+        Resource = "arn:aws:states:${var.aws_region}:${data.aws_caller_identity.current.account_id}:execution:${var.project_name}-FolderProcessingStateMachine:*"
+      },
+      {
+        # S3 event queues consumed by the metadata Lambdas' event source mappings
+        Effect   = "Allow",
+        Action   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ChangeMessageVisibility"],
+        Resource = [for queue in aws_sqs_queue.s3_event_queue : queue.arn]
+      },
+      {
+        # Pipelined mode dispatches study summaries asynchronously
+        Effect   = "Allow",
+        Action   = "lambda:InvokeFunction",
+        Resource = aws_lambda_function.summarize_single_study_lambda.arn
       }
     ]
   })
@@ -127,7 +152,11 @@ resource "aws_iam_policy" "sfn_lambda_invoke_policy" {
           aws_lambda_function.update_folder_metadata_lambda.arn,
           aws_lambda_function.identify_studies_lambda.arn,
           aws_lambda_function.summarize_single_study_lambda.arn,
-          aws_lambda_function.aggregate_results_lambda.arn
+          aws_lambda_function.aggregate_results_lambda.arn,
+          aws_lambda_function.summarize_folder_lambda.arn,
+          aws_lambda_function.check_ingestion_jobs_lambda.arn,
+          aws_lambda_function.extract_file_studies_lambda.arn,
+          aws_lambda_function.check_study_registry_lambda.arn
         ]
       },
       {
@@ -135,6 +164,18 @@ resource "aws_iam_policy" "sfn_lambda_invoke_policy" {
         Effect   = "Allow"
         Action   = "states:StartExecution"
         Resource = aws_sfn_state_machine.folder_processing_state_machine.id
+      },
+      {
+        Sid      = "DistributedMapChildExecutions"
+        Effect   = "Allow"
+        Action   = ["states:DescribeExecution", "states:StopExecution"]
+        Resource = "arn:aws:states:${var.aws_region}:${data.aws_caller_identity.current.account_id}:execution:${var.project_name}-FolderProcessingStateMachine/*"
+      },
+      {
+        Sid      = "ReadProcessingManifests"
+        Effect   = "Allow"
+        Action   = "s3:GetObject"
+        Resource = "${aws_s3_bucket.main_bucket.arn}/${var.s3_manifest_prefix}/*"
       }
     ]
   })
@@ -62,6 +62,42 @@ data "archive_file" "aggregate_results_zip" {
   output_path = "${path.module}/lambda_zips/AggregateResultsLambda.zip"
 }
 
+data "archive_file" "check_ingestion_jobs_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/CheckIngestionJobsLambda.py"
+  output_path = "${path.module}/lambda_zips/CheckIngestionJobsLambda.zip"
+}
+
+data "archive_file" "extract_file_studies_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/ExtractFileStudiesLambda.py"
+  output_path = "${path.module}/lambda_zips/ExtractFileStudiesLambda.zip"
+}
+
+data "archive_file" "check_study_registry_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/CheckStudyRegistryLambda.py"
+  output_path = "${path.module}/lambda_zips/CheckStudyRegistryLambda.zip"
+}
+
+data "archive_file" "query_aggregated_summary_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/QueryAggregatedSummaryLambda.py"
+  output_path = "${path.module}/lambda_zips/QueryAggregatedSummaryLambda.zip"
+}
+
+data "archive_file" "cleanup_stale_artifacts_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/CleanupStaleArtifactsLambda.py"
+  output_path = "${path.module}/lambda_zips/CleanupStaleArtifactsLambda.zip"
+}
+
+data "archive_file" "admit_folder_runs_zip" {
+  type        = "zip"
+  source_file = "../AWS_backend/lambda_functions/AdmitFolderRunsLambda.py"
+  output_path = "${path.module}/lambda_zips/AdmitFolderRunsLambda.zip"
+}
+
 
 # --- Lambda Functions ---
 
@@ -70,12 +106,17 @@ resource "aws_lambda_function" "record_s3_metadata_lambda" {
   handler          = "RecordS3FileMetadataToDynamoDB.lambda_handler"
   runtime          = "python3.12"
   role             = aws_iam_role.lambda_exec_role.arn
-  timeout          = 3
+  timeout          = 30
   memory_size      = 128
   filename         = data.archive_file.record_s3_metadata_zip.output_path
   source_code_hash = data.archive_file.record_s3_metadata_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
-    variables = { DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name }
+    variables = {
+      DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name
+      KB_S3_SOURCE_PREFIX = var.s3_kb_source_prefix
+      S3_MANIFEST_PREFIX  = var.s3_manifest_prefix
+    }
   }
   tags = { Project = var.project_name }
 }
@@ -85,12 +126,21 @@ resource "aws_lambda_function" "delete_s3_metadata_lambda" {
   handler          = "DeleteS3FileMetadataFromDynamoDB.lambda_handler"
   runtime          = "python3.12"
   role             = aws_iam_role.lambda_exec_role.arn
-  timeout          = 3
+  timeout          = 60
   memory_size      = 128
   filename         = data.archive_file.delete_s3_metadata_zip.output_path
   source_code_hash = data.archive_file.delete_s3_metadata_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
-    variables = { DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name }
+    variables = {
+      DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name
+      S3_BUCKET_NAME      = aws_s3_bucket.main_bucket.bucket
+      KB_S3_SOURCE_PREFIX = var.s3_kb_source_prefix
+      S3_MANIFEST_PREFIX  = var.s3_manifest_prefix
+      BEDROCK_REGION      = var.aws_region
+      KNOWLEDGE_BASE_ID   = var.knowledge_base_id
+      DATA_SOURCE_ID      = var.data_source_id
+    }
   }
   tags = { Project = var.project_name }
 }
@@ -104,8 +154,13 @@ resource "aws_lambda_function" "list_user_files_lambda" {
   memory_size      = 128
   filename         = data.archive_file.list_user_files_zip.output_path
   source_code_hash = data.archive_file.list_user_files_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
-    variables = { DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name }
+    variables = {
+      DYNAMODB_TABLE_NAME    = aws_dynamodb_table.file_metadata_table.name
+      FOLDER_INDEX_NAME      = var.folder_index_reads ? "FolderIndex" : ""
+      LIST_CACHE_TTL_SECONDS = var.list_cache_ttl_seconds
+    }
   }
   tags = { Project = var.project_name }
 }
@@ -119,10 +174,18 @@ resource "aws_lambda_function" "initiate_folder_processing_lambda" {
   memory_size      = 500
   filename         = data.archive_file.initiate_folder_processing_zip.output_path
   source_code_hash = data.archive_file.initiate_folder_processing_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
     variables = {
-      S3_BUCKET_NAME    = aws_s3_bucket.main_bucket.bucket
-      STATE_MACHINE_ARN = aws_sfn_state_machine.folder_processing_state_machine.id
+      S3_BUCKET_NAME             = aws_s3_bucket.main_bucket.bucket
+      STATE_MACHINE_ARN          = aws_sfn_state_machine.folder_processing_state_machine.id
+      DYNAMODB_TABLE_NAME        = aws_dynamodb_table.file_metadata_table.name
+      S3_MANIFEST_PREFIX         = var.s3_manifest_prefix
+      PIPELINED_SUMMARIZATION    = var.pipelined_summarization
+      FOLDER_INDEX_NAME          = var.folder_index_reads ? "FolderIndex" : ""
+      TENANT_MAX_RUNNING_FOLDERS = var.tenant_max_running_folders
+      MAX_RUNNING_FOLDERS        = var.max_running_folders
+      ADMISSION_MAX_WAIT_SECONDS = var.admission_max_wait_seconds
     }
   }
   tags = { Project = var.project_name }
@@ -143,21 +206,23 @@ resource "aws_lambda_function" "ingest_file_to_bedrock_kb_lambda" {
     aws_lambda_layer_version.textractor.arn,
     "arn:aws:lambda:${var.aws_region}:336392948345:layer:AWSSDKPandas-Python312:17",
     aws_lambda_layer_version.json_repair.arn,
+    aws_lambda_layer_version.docrag_shared.arn,
   ]
   
   environment {
     variables = {
-      BEDROCK_REGION        = var.aws_region
-      DYNAMODB_TABLE_NAME   = aws_dynamodb_table.file_metadata_table.name
-      KB_ID                 = var.knowledge_base_id
-      KB_DATASOURCE_ID      = var.data_source_id
-      KB_S3_SOURCE_BUCKET   = aws_s3_bucket.main_bucket.bucket
-      KB_S3_SOURCE_PREFIX   = var.s3_kb_source_prefix
-      S3_BUCKET_NAME        = aws_s3_bucket.main_bucket.bucket
-      DATA_SOURCE_ID        = var.data_source_id
-      DESTINATION_S3_BUCKET = aws_s3_bucket.main_bucket.bucket
-      DESTINATION_S3_PREFIX = "${var.s3_kb_source_prefix}/"
-      KNOWLEDGE_BASE_ID     = var.knowledge_base_id
+      BEDROCK_REGION           = var.aws_region
+      DYNAMODB_TABLE_NAME      = aws_dynamodb_table.file_metadata_table.name
+      KB_ID                    = var.knowledge_base_id
+      KB_DATASOURCE_ID         = var.data_source_id
+      KB_S3_SOURCE_BUCKET      = aws_s3_bucket.main_bucket.bucket
+      KB_S3_SOURCE_PREFIX      = var.s3_kb_source_prefix
+      S3_BUCKET_NAME           = aws_s3_bucket.main_bucket.bucket
+      DATA_SOURCE_ID           = var.data_source_id
+      DESTINATION_S3_BUCKET    = aws_s3_bucket.main_bucket.bucket
+      DESTINATION_S3_PREFIX    = "${var.s3_kb_source_prefix}/"
+      KNOWLEDGE_BASE_ID        = var.knowledge_base_id
+      INGEST_BATCH_CONCURRENCY = var.ingest_batch_concurrency
     }
   }
   tags = { Project = var.project_name }
@@ -176,16 +241,22 @@ resource "aws_lambda_function" "summarize_folder_lambda" {
   ephemeral_storage { size = 3000 }
 
   # UPDATED: Layer is now attached.
-  layers = [aws_lambda_layer_version.json_repair.arn]
+  layers = [
+    aws_lambda_layer_version.json_repair.arn,
+    aws_lambda_layer_version.docrag_shared.arn,
+  ]
 
   environment {
     variables = {
-      BEDROCK_SUMMARY_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
-      DYNAMODB_TABLE_NAME      = aws_dynamodb_table.file_metadata_table.name
-      S3_BUCKET_NAME           = aws_s3_bucket.main_bucket.bucket
-      S3_SUMMARY_PREFIX        = var.s3_folder_summaries_prefix
-      SUMMARY_MODEL_ID         = "anthropic.claude-3-sonnet-20240229-v1:0"
-      KB_ID                    = var.knowledge_base_id
+      BEDROCK_SUMMARY_MODEL_ID  = "anthropic.claude-3-sonnet-20240229-v1:0"
+      BEDROCK_MODEL_ROUTES      = jsonencode(var.bedrock_model_routes)
+      DYNAMODB_TABLE_NAME       = aws_dynamodb_table.file_metadata_table.name
+      S3_BUCKET_NAME            = aws_s3_bucket.main_bucket.bucket
+      S3_SUMMARY_PREFIX         = var.s3_folder_summaries_prefix
+      SUMMARY_MODEL_ID          = "anthropic.claude-3-sonnet-20240229-v1:0"
+      KB_ID                     = var.knowledge_base_id
+      DEADLINE_SAFETY_MARGIN_MS = 150000
+      EXTRACTION_SCHEMA         = var.extraction_schema
     }
   }
   tags = { Project = var.project_name }
@@ -200,6 +271,7 @@ resource "aws_lambda_function" "update_folder_metadata_lambda" {
   memory_size      = 500
   filename         = data.archive_file.update_folder_metadata_zip.output_path
   source_code_hash = data.archive_file.update_folder_metadata_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
     variables = { DYNAMODB_TABLE_NAME = aws_dynamodb_table.file_metadata_table.name }
   }
@@ -217,10 +289,13 @@ resource "aws_lambda_function" "identify_studies_lambda" {
   memory_size      = 200
   filename         = data.archive_file.identify_studies_zip.output_path
   source_code_hash = data.archive_file.identify_studies_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
   environment {
     variables = {
       BEDROCK_SUMMARY_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+      BEDROCK_MODEL_ROUTES     = jsonencode(var.bedrock_model_routes)
       KB_ID                    = var.knowledge_base_id
+      DYNAMODB_TABLE_NAME      = aws_dynamodb_table.file_metadata_table.name
     }
   }
   tags = { Project = var.project_name }
@@ -238,11 +313,28 @@ resource "aws_lambda_function" "summarize_single_study_lambda" {
 
   ephemeral_storage { size = 1000 }
 
+  layers = [
+    aws_lambda_layer_version.json_repair.arn,
+    aws_lambda_layer_version.docrag_shared.arn,
+  ]
+
   environment {
     variables = {
-      BEDROCK_SUMMARY_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
-      KB_ID                    = var.knowledge_base_id
-      S3_BUCKET_NAME           = aws_s3_bucket.main_bucket.bucket
+      BEDROCK_SUMMARY_MODEL_ID        = "anthropic.claude-3-sonnet-20240229-v1:0"
+      BEDROCK_MODEL_ROUTES            = jsonencode(var.bedrock_model_routes)
+      KB_ID                           = var.knowledge_base_id
+      S3_BUCKET_NAME                  = aws_s3_bucket.main_bucket.bucket
+      DYNAMODB_TABLE_NAME             = aws_dynamodb_table.file_metadata_table.name
+      BEDROCK_MAX_CONCURRENCY         = var.bedrock_max_concurrency
+      BEDROCK_REQUESTS_PER_SECOND     = var.bedrock_requests_per_second
+      BEDROCK_HEDGING                 = var.bedrock_hedging
+      BEDROCK_HEDGE_BUDGET_PER_FOLDER = var.bedrock_hedge_budget_per_folder
+      LOCAL_RERANK                    = var.local_rerank
+      RERANK_POOL_SIZE                = var.rerank_pool_size
+      RERANK_TOKEN_BUDGET             = var.rerank_token_budget
+      EXTRACTION_SCHEMA               = var.extraction_schema
+      SCHEMA_PRUNING                  = var.schema_pruning
+      JSON_REASK_MAX                  = 1
     }
   }
   tags = { Project = var.project_name }
@@ -257,16 +349,242 @@ resource "aws_lambda_function" "aggregate_results_lambda" {
   memory_size      = 200
   filename         = data.archive_file.aggregate_results_zip.output_path
   source_code_hash = data.archive_file.aggregate_results_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
+
+  environment {
+    variables = {
+      S3_BUCKET_NAME              = aws_s3_bucket.main_bucket.bucket
+      DYNAMODB_TABLE_NAME         = aws_dynamodb_table.file_metadata_table.name
+      AGGREGATE_FETCH_CONCURRENCY = 8
+      AGGREGATE_OUTPUT_FORMAT     = "json"
+      AGGREGATE_SECTION_INDEX     = "true"
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_lambda_function" "check_ingestion_jobs_lambda" {
+  function_name    = "${var.project_name}-CheckIngestionJobs"
+  handler          = "CheckIngestionJobsLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 60
+  memory_size      = 128
+  filename         = data.archive_file.check_ingestion_jobs_zip.output_path
+  source_code_hash = data.archive_file.check_ingestion_jobs_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
+
+  environment {
+    variables = {
+      BEDROCK_REGION                 = var.aws_region
+      DYNAMODB_TABLE_NAME            = aws_dynamodb_table.file_metadata_table.name
+      KNOWLEDGE_BASE_ID              = var.knowledge_base_id
+      DATA_SOURCE_ID                 = var.data_source_id
+      INGESTION_POLL_MIN_SECONDS     = var.ingestion_poll_min_seconds
+      INGESTION_POLL_MAX_SECONDS     = var.ingestion_poll_max_seconds
+      INGESTION_BARRIER_MAX_ATTEMPTS = 60
+      FOLDER_INDEX_NAME              = var.folder_index_reads ? "FolderIndex" : ""
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_lambda_function" "extract_file_studies_lambda" {
+  function_name    = "${var.project_name}-ExtractFileStudies"
+  handler          = "ExtractFileStudiesLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 900
+  memory_size      = 200
+  filename         = data.archive_file.extract_file_studies_zip.output_path
+  source_code_hash = data.archive_file.extract_file_studies_zip.output_base64sha256
+
+  layers = [aws_lambda_layer_version.docrag_shared.arn]
+
+  environment {
+    variables = {
+      BEDROCK_SUMMARY_MODEL_ID      = "anthropic.claude-3-sonnet-20240229-v1:0"
+      BEDROCK_MODEL_ROUTES          = jsonencode(var.bedrock_model_routes)
+      KB_ID                         = var.knowledge_base_id
+      DYNAMODB_TABLE_NAME           = aws_dynamodb_table.file_metadata_table.name
+      SUMMARIZE_STUDY_FUNCTION_NAME = aws_lambda_function.summarize_single_study_lambda.function_name
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_lambda_function" "check_study_registry_lambda" {
+  function_name    = "${var.project_name}-CheckStudyRegistry"
+  handler          = "CheckStudyRegistryLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 60
+  memory_size      = 128
+  filename         = data.archive_file.check_study_registry_zip.output_path
+  source_code_hash = data.archive_file.check_study_registry_zip.output_base64sha256
+  layers           = [aws_lambda_layer_version.docrag_shared.arn]
+
+  environment {
+    variables = {
+      DYNAMODB_TABLE_NAME           = aws_dynamodb_table.file_metadata_table.name
+      SUMMARIZE_STUDY_FUNCTION_NAME = aws_lambda_function.summarize_single_study_lambda.function_name
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_lambda_function" "query_aggregated_summary_lambda" {
+  function_name    = "${var.project_name}-QueryAggregatedSummary"
+  handler          = "QueryAggregatedSummaryLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 30
+  memory_size      = 256
+  filename         = data.archive_file.query_aggregated_summary_zip.output_path
+  source_code_hash = data.archive_file.query_aggregated_summary_zip.output_base64sha256
+
+  environment {
+    variables = {
+      S3_BUCKET_NAME                 = aws_s3_bucket.main_bucket.bucket
+      DYNAMODB_TABLE_NAME            = aws_dynamodb_table.file_metadata_table.name
+      QUERY_RANGE_COALESCE_GAP_BYTES = 65536
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+# Scheduled cleanup: prunes superseded summaries and orphaned KB chunks, and
+# starts the coalesced KB sync that deletions leave pending.
+resource "aws_lambda_function" "cleanup_stale_artifacts_lambda" {
+  function_name    = "${var.project_name}-CleanupStaleArtifacts"
+  handler          = "CleanupStaleArtifactsLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 900
+  memory_size      = 512
+  filename         = data.archive_file.cleanup_stale_artifacts_zip.output_path
+  source_code_hash = data.archive_file.cleanup_stale_artifacts_zip.output_base64sha256
+
+  layers = [aws_lambda_layer_version.docrag_shared.arn]
 
   environment {
     variables = {
       S3_BUCKET_NAME           = aws_s3_bucket.main_bucket.bucket
+      DYNAMODB_TABLE_NAME      = aws_dynamodb_table.file_metadata_table.name
+      S3_SUMMARY_PREFIX        = var.s3_folder_summaries_prefix
+      KB_S3_SOURCE_PREFIX      = var.s3_kb_source_prefix
+      BEDROCK_REGION           = var.aws_region
+      KNOWLEDGE_BASE_ID        = var.knowledge_base_id
+      DATA_SOURCE_ID           = var.data_source_id
+      SUMMARY_KEEP_VERSIONS    = var.summary_keep_versions
+      SUMMARY_MIN_AGE_DAYS     = var.summary_min_age_days
+      AGGREGATE_RETENTION_DAYS = var.aggregate_retention_days
+    }
+  }
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_cloudwatch_event_rule" "cleanup_stale_artifacts" {
+  for_each = {
+    gc      = var.artifact_gc_schedule
+    kb_sync = var.kb_sync_schedule
+  }
+  name                = "${var.project_name}-${var.environment}-cleanup-${replace(each.key, "_", "-")}"
+  schedule_expression = each.value
+  tags                = { Project = var.project_name }
+}
+
+resource "aws_cloudwatch_event_target" "cleanup_stale_artifacts" {
+  for_each = aws_cloudwatch_event_rule.cleanup_stale_artifacts
+  rule     = each.value.name
+  arn      = aws_lambda_function.cleanup_stale_artifacts_lambda.arn
+  input    = jsonencode({ task = each.key })
+}
+
+resource "aws_lambda_permission" "allow_events_to_invoke_cleanup" {
+  for_each      = aws_cloudwatch_event_rule.cleanup_stale_artifacts
+  statement_id  = "AllowEventBridgeInvokeCleanup-${each.key}"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.cleanup_stale_artifacts_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = each.value.arn
+}
+
+# Fair admission of folder runs: frees a user's slot when an execution ends and
+# starts the next queued runs; the schedule catches status change events that were missed.
+resource "aws_lambda_function" "admit_folder_runs_lambda" {
+  function_name    = "${var.project_name}-AdmitFolderRuns"
+  handler          = "AdmitFolderRunsLambda.lambda_handler"
+  runtime          = "python3.12"
+  role             = aws_iam_role.lambda_exec_role.arn
+  timeout          = 60
+  memory_size      = 256
+  filename         = data.archive_file.admit_folder_runs_zip.output_path
+  source_code_hash = data.archive_file.admit_folder_runs_zip.output_base64sha256
+
+  layers = [aws_lambda_layer_version.docrag_shared.arn]
+
+  environment {
+    variables = {
+      STATE_MACHINE_ARN          = aws_sfn_state_machine.folder_processing_state_machine.id
+      DYNAMODB_TABLE_NAME        = aws_dynamodb_table.file_metadata_table.name
+      TENANT_MAX_RUNNING_FOLDERS = var.tenant_max_running_folders
+      MAX_RUNNING_FOLDERS        = var.max_running_folders
+      ADMISSION_MAX_WAIT_SECONDS = var.admission_max_wait_seconds
     }
   }
 
   tags = { Project = var.project_name }
 }
 
+resource "aws_cloudwatch_event_rule" "folder_run_ended" {
+  name          = "${var.project_name}-${var.environment}-folder-run-ended"
+  event_pattern = jsonencode({
+    source      = ["aws.states"]
+    detail-type = ["Step Functions Execution Status Change"]
+    detail      = {
+      status          = ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]
+      stateMachineArn = [aws_sfn_state_machine.folder_processing_state_machine.id]
+    }
+  })
+  tags = { Project = var.project_name }
+}
+
+resource "aws_cloudwatch_event_rule" "admission_reconcile" {
+  name                = "${var.project_name}-${var.environment}-admission-reconcile"
+  schedule_expression = var.admission_reconcile_schedule
+  tags                = { Project = var.project_name }
+}
+
+resource "aws_cloudwatch_event_target" "folder_run_ended" {
+  rule = aws_cloudwatch_event_rule.folder_run_ended.name
+  arn  = aws_lambda_function.admit_folder_runs_lambda.arn
+}
+
+resource "aws_cloudwatch_event_target" "admission_reconcile" {
+  rule  = aws_cloudwatch_event_rule.admission_reconcile.name
+  arn   = aws_lambda_function.admit_folder_runs_lambda.arn
+  input = jsonencode({ task = "reconcile" })
+}
+
+resource "aws_lambda_permission" "allow_events_to_invoke_admission" {
+  for_each = {
+    run_ended = aws_cloudwatch_event_rule.folder_run_ended.arn
+    reconcile = aws_cloudwatch_event_rule.admission_reconcile.arn
+  }
+  statement_id  = "AllowEventBridgeInvokeAdmission-${each.key}"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.admit_folder_runs_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = each.value
+}
+
 # --- Asynchronous Invocation Configuration for all functions ---
 resource "aws_lambda_function_event_invoke_config" "record_s3_metadata_config" {
   function_name          = aws_lambda_function.record_s3_metadata_lambda.function_name
@@ -317,3 +635,28 @@ resource "aws_lambda_function_event_invoke_config" "aggregate_results_config" {
   function_name          = aws_lambda_function.aggregate_results_lambda.function_name
   maximum_retry_attempts = 2
 }
+
+resource "aws_lambda_function_event_invoke_config" "check_ingestion_jobs_config" {
+  function_name          = aws_lambda_function.check_ingestion_jobs_lambda.function_name
+  maximum_retry_attempts = 2
+}
+
+resource "aws_lambda_function_event_invoke_config" "extract_file_studies_config" {
+  function_name          = aws_lambda_function.extract_file_studies_lambda.function_name
+  maximum_retry_attempts = 2
+}
+
+resource "aws_lambda_function_event_invoke_config" "check_study_registry_config" {
+  function_name          = aws_lambda_function.check_study_registry_lambda.function_name
+  maximum_retry_attempts = 2
+}
+
+resource "aws_lambda_function_event_invoke_config" "query_aggregated_summary_config" {
+  function_name          = aws_lambda_function.query_aggregated_summary_lambda.function_name
+  maximum_retry_attempts = 2
+}
+
+resource "aws_lambda_function_event_invoke_config" "cleanup_stale_artifacts_config" {
+  function_name          = aws_lambda_function.cleanup_stale_artifacts_lambda.function_name
+  maximum_retry_attempts = 0
+}
@@ -15,3 +15,18 @@ resource "aws_lambda_layer_version" "textractor" {
   layer_name          = "${var.project_name}-textractor-py312"
   compatible_runtimes = ["python3.12"]
 }
+
+# Shared DocRAG modules (model_router, retrieval, change_version, ...) imported by the Lambdas.
+data "archive_file" "docrag_shared_layer_zip" {
+  type        = "zip"
+  source_dir  = "../AWS_backend/lambda_layers/docrag_shared"
+  excludes    = ["python/__pycache__"]
+  output_path = "${path.module}/lambda_zips/docrag_shared_layer.zip"
+}
+
+resource "aws_lambda_layer_version" "docrag_shared" {
+  filename            = data.archive_file.docrag_shared_layer_zip.output_path
+  source_code_hash    = data.archive_file.docrag_shared_layer_zip.output_base64sha256
+  layer_name          = "${var.project_name}-docrag_shared"
+  compatible_runtimes = ["python3.12"]
+}
@@ -72,3 +72,8 @@ output "step_functions_state_machine_arn" {
   description = "ARN of the Step Functions State Machine."
   value       = aws_sfn_state_machine.folder_processing_state_machine.id
 }
+
+output "summarize_folder_state_machine_arn" {
+  description = "ARN of the checkpointed SummarizeFolder Step Functions State Machine."
+  value       = aws_sfn_state_machine.summarize_folder_state_machine.id
+}
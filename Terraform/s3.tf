@@ -27,45 +27,54 @@ resource "aws_s3_bucket_ownership_controls" "main_bucket_ownership" {
   }
 }
 
+# Folder-processing manifests are only needed while their execution runs.
+resource "aws_s3_bucket_lifecycle_configuration" "main_bucket_lifecycle" {
+  bucket = aws_s3_bucket.main_bucket.id
+
+  rule {
+    id     = "expire-processing-manifests"
+    status = "Enabled"
+    filter {
+      prefix = "${var.s3_manifest_prefix}/"
+    }
+    expiration {
+      days = 7
+    }
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+
+  rule {
+    id     = "expire-summarize-folder-checkpoints"
+    status = "Enabled"
+    filter {
+      prefix = "${var.s3_folder_summaries_prefix}/_checkpoints/"
+    }
+    expiration {
+      days = 7
+    }
+  }
+}
+
 # --- CORRECTED: S3 Event Triggers for Lambdas ---
 
 # This single notification resource now handles both create and delete events.
 resource "aws_s3_bucket_notification" "main_bucket_notifications" {
   bucket = aws_s3_bucket.main_bucket.id
 
-  # Notification for when an object is created.
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.record_s3_metadata_lambda.arn
-    events              = ["s3:ObjectCreated:*"]
+  # Notification for when an object is created, batched through SQS (sqs.tf) into RecordS3FileMetadata.
+  queue {
+    queue_arn = aws_sqs_queue.s3_event_queue["object_created"].arn
+    events    = ["s3:ObjectCreated:*"]
   }
 
-  # Notification for when an object is deleted.
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.delete_s3_metadata_lambda.arn
-    events              = ["s3:ObjectRemoved:*"]
+  # Notification for when an object is deleted, batched through SQS into DeleteS3FileMetadata.
+  queue {
+    queue_arn = aws_sqs_queue.s3_event_queue["object_removed"].arn
+    events    = ["s3:ObjectRemoved:*"]
   }
 
-  # This resource must depend on both permissions being created first.
-  depends_on = [
-    aws_lambda_permission.allow_s3_to_invoke_record_metadata,
-    aws_lambda_permission.allow_s3_to_invoke_delete_metadata
-  ]
-}
-
-# This permission allows S3 to invoke the RecordS3FileMetadataLambda function.
-resource "aws_lambda_permission" "allow_s3_to_invoke_record_metadata" {
-  statement_id  = "AllowS3InvokeRecordMetadata"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.record_s3_metadata_lambda.function_name
-  principal     = "s3.amazonaws.com"
-  source_arn    = aws_s3_bucket.main_bucket.arn
-}
-
-# This permission allows S3 to invoke the DeleteS3FileMetadataLambda function.
-resource "aws_lambda_permission" "allow_s3_to_invoke_delete_metadata" {
-  statement_id  = "AllowS3InvokeDeleteMetadata"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.delete_s3_metadata_lambda.function_name
-  principal     = "s3.amazonaws.com"
-  source_arn    = aws_s3_bucket.main_bucket.arn
+  # S3 validates the destinations when the notification is saved, so the queue policies must exist first.
+  depends_on = [aws_sqs_queue_policy.s3_event_queue]
 }
@@ -0,0 +1,59 @@
+# terraform/sqs.tf
+
+# S3 notifications for the metadata Lambdas go through these queues, so a bulk
+# upload reaches RecordS3FileMetadata as a few large batches instead of one
+# invocation per object. Failed messages are retried on their own
+# (batchItemFailures) and land in the dead-letter queue after max_receive_count tries.
+
+locals {
+  s3_event_queues = {
+    object_created = aws_lambda_function.record_s3_metadata_lambda
+    object_removed = aws_lambda_function.delete_s3_metadata_lambda
+  }
+}
+
+resource "aws_sqs_queue" "s3_event_dlq" {
+  for_each                  = local.s3_event_queues
+  name                      = "${var.project_name}-${var.environment}-s3-${replace(each.key, "_", "-")}-dlq"
+  message_retention_seconds = 1209600 # 14 days, the SQS maximum
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_sqs_queue" "s3_event_queue" {
+  for_each = local.s3_event_queues
+  name     = "${var.project_name}-${var.environment}-s3-${replace(each.key, "_", "-")}"
+  # At least six times the consumer's timeout, as Lambda's SQS integration recommends
+  visibility_timeout_seconds = 6 * each.value.timeout
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.s3_event_dlq[each.key].arn
+    maxReceiveCount     = var.s3_event_max_receive_count
+  })
+
+  tags = { Project = var.project_name }
+}
+
+resource "aws_sqs_queue_policy" "s3_event_queue" {
+  for_each  = local.s3_event_queues
+  queue_url = aws_sqs_queue.s3_event_queue[each.key].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect    = "Allow"
+      Principal = { Service = "s3.amazonaws.com" }
+      Action    = "sqs:SendMessage"
+      Resource  = aws_sqs_queue.s3_event_queue[each.key].arn
+      Condition = { ArnEquals = { "aws:SourceArn" = aws_s3_bucket.main_bucket.arn } }
+    }]
+  })
+}
+
+resource "aws_lambda_event_source_mapping" "s3_event_queue" {
+  for_each                           = local.s3_event_queues
+  event_source_arn                   = aws_sqs_queue.s3_event_queue[each.key].arn
+  function_name                      = each.value.arn
+  batch_size                         = var.s3_event_batch_size
+  maximum_batching_window_in_seconds = var.s3_event_batch_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
@@ -8,36 +8,266 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
   # with all hardcoded ARNs replaced by dynamic Terraform references.
   definition = jsonencode({
     Comment = "Orchestrates Bedrock KB ingestion, then fans out to summarize each study reliably."
-    StartAt = "IngestFilesMap"
+    StartAt = "CheckForRemovedFiles"
     States = {
+      CheckForRemovedFiles = {
+        Type = "Choice",
+        Choices = [
+          {
+            Variable           = "$.filesToDeleteCount",
+            NumericGreaterThan = 0,
+            Next               = "RemoveDeletedFilesMap"
+          }
+        ],
+        Default = "CheckForFilesToIngest"
+      },
+      RemoveDeletedFilesMap = {
+        Type           = "Map",
+        Comment        = "Purges the KB chunks of files that were removed since the last folder run.",
+        MaxConcurrency = 1,
+        ResultPath     = null,
+        ItemReader = {
+          Resource     = "arn:aws:states:::s3:getObject",
+          ReaderConfig = {
+            InputType = "JSONL"
+          },
+          Parameters = {
+            "Bucket.$" = "$.manifest.bucket",
+            "Key.$"    = "$.manifest.deleteKey"
+          }
+        },
+        ItemProcessor = {
+          ProcessorConfig = {
+            Mode          = "DISTRIBUTED",
+            ExecutionType = "STANDARD"
+          },
+          StartAt = "RemoveSingleFileFromKB",
+          States = {
+            RemoveSingleFileFromKB = {
+              Type     = "Task",
+              Resource = "arn:aws:states:::lambda:invoke",
+              Parameters = {
+                "FunctionName" = aws_lambda_function.ingest_file_to_bedrock_kb_lambda.arn,
+                "Payload.$"    = "$"
+              },
+              Retry = [
+                {
+                  # Per-file failures come back in the result; only retry the invocation itself
+                  ErrorEquals     = ["Lambda.ServiceException", "Lambda.TooManyRequestsException", "Lambda.SdkClientException"],
+                  IntervalSeconds = 15,
+                  MaxAttempts     = 2,
+                  BackoffRate     = 1.5
+                }
+              ],
+              ResultPath = null,
+              End        = true
+            }
+          }
+        },
+        Next = "CheckForFilesToIngest",
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"],
+            Next        = "FolderProcessingFailed",
+            ResultPath  = "$.errorInfo"
+          }
+        ]
+      },
+      CheckForFilesToIngest = {
+        Type = "Choice",
+        Choices = [
+          {
+            And = [
+              { Variable = "$.pipelined", IsPresent = true },
+              { Variable = "$.pipelined", BooleanEquals = true },
+              { Variable = "$.filesToIngestCount", NumericGreaterThan = 0 }
+            ],
+            Next = "PipelinedIngestMap"
+          },
+          {
+            And = [
+              { Variable = "$.pipelined", IsPresent = true },
+              { Variable = "$.pipelined", BooleanEquals = true }
+            ],
+            Next = "StartStudyBarrier"
+          },
+          {
+            Variable           = "$.filesToIngestCount",
+            NumericGreaterThan = 0,
+            Next               = "IngestFilesMap"
+          }
+        ],
+        Default = "StartIngestionBarrier"
+      },
       IngestFilesMap = {
-        Type         = "Map",
-        Comment      = "Processes each S3 file to ingest it into the Knowledge Base.",
-        InputPath    = "$",
-        ItemsPath    = "$.s3ItemsToProcess",
+        Type           = "Map",
+        Comment        = "Reads the ingest manifest from S3 and processes its files in batches to ingest them into the Knowledge Base.",
         MaxConcurrency = 1,
-        ResultPath   = null,
-        Parameters = {
-          "s3Key.$"    = "$$.Map.Item.Value.s3Key",
-          "userId.$"   = "$$.Map.Item.Value.userId",
-          "folderId.$" = "$$.Map.Item.Value.folderId",
-          "sessionId.$"= "$$.Map.Item.Value.sessionId",
-          "fileName.$" = "$$.Map.Item.Value.fileName"
+        ResultPath     = null,
+        ItemReader = {
+          Resource     = "arn:aws:states:::s3:getObject",
+          ReaderConfig = {
+            InputType = "JSONL"
+          },
+          Parameters = {
+            "Bucket.$" = "$.manifest.bucket",
+            "Key.$"    = "$.manifest.ingestKey"
+          }
+        },
+        ItemBatcher = {
+          MaxItemsPerBatch = var.ingest_batch_size
         },
         ItemProcessor = {
           ProcessorConfig = {
             Mode          = "DISTRIBUTED",
             ExecutionType = "STANDARD"
           },
-          StartAt = "IngestSingleFileToKB",
+          StartAt = "IngestFileBatchToKB",
           States = {
-            IngestSingleFileToKB = {
+            IngestFileBatchToKB = {
               Type     = "Task",
+              Comment  = "Ingests a whole batch of files; per-file failures are reported in the result instead of failing the batch.",
               Resource = "arn:aws:states:::lambda:invoke",
               Parameters = {
                 "FunctionName" = aws_lambda_function.ingest_file_to_bedrock_kb_lambda.arn,
                 "Payload.$"    = "$"
               },
+              Retry = [
+                {
+                  # Per-file failures come back in the result; only retry the invocation itself
+                  ErrorEquals     = ["Lambda.ServiceException", "Lambda.TooManyRequestsException", "Lambda.SdkClientException"],
+                  IntervalSeconds = 15,
+                  MaxAttempts     = 2,
+                  BackoffRate     = 1.5
+                }
+              ],
+              ResultPath = null,
+              End        = true
+            }
+          }
+        },
+        Next = "StartIngestionBarrier",
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"],
+            Next        = "FolderProcessingFailed",
+            ResultPath  = "$.errorInfo"
+          }
+        ]
+      },
+      PipelinedIngestMap = {
+        Type           = "Map",
+        Comment        = "Pipelined mode: each batch is ingested, waits for its own ingestion job, then has its studies extracted and dispatched for summarization.",
+        MaxConcurrency = 1,
+        ResultPath     = null,
+        ItemReader = {
+          Resource     = "arn:aws:states:::s3:getObject",
+          ReaderConfig = {
+            InputType = "JSONL"
+          },
+          Parameters = {
+            "Bucket.$" = "$.manifest.bucket",
+            "Key.$"    = "$.manifest.ingestKey"
+          }
+        },
+        ItemBatcher = {
+          MaxItemsPerBatch = var.ingest_batch_size,
+          BatchInput = {
+            "userId.$"   = "$.userId",
+            "folderId.$" = "$.folderId"
+          }
+        },
+        ItemProcessor = {
+          ProcessorConfig = {
+            Mode          = "DISTRIBUTED",
+            ExecutionType = "STANDARD"
+          },
+          StartAt = "IngestPipelinedBatch",
+          States = {
+            IngestPipelinedBatch = {
+              Type     = "Task",
+              Resource = "arn:aws:states:::lambda:invoke",
+              Parameters = {
+                "FunctionName" = aws_lambda_function.ingest_file_to_bedrock_kb_lambda.arn,
+                "Payload.$"    = "$"
+              },
+              ResultSelector = {
+                "ingestionJobId.$" = "$.Payload.ingestionJobId",
+                "syncPending.$"    = "$.Payload.syncPending",
+                "results.$"        = "$.Payload.results"
+              },
+              ResultPath = "$.ingest",
+              Next       = "StartBatchIngestionWait",
+              Retry = [
+                {
+                  # Per-file failures come back in the result; only retry the invocation itself
+                  ErrorEquals     = ["Lambda.ServiceException", "Lambda.TooManyRequestsException", "Lambda.SdkClientException"],
+                  IntervalSeconds = 15,
+                  MaxAttempts     = 2,
+                  BackoffRate     = 1.5
+                }
+              ]
+            },
+            # A batch whose job conflicted with a running one gets it from the barrier (syncPending)
+            StartBatchIngestionWait = {
+              Type = "Pass",
+              Parameters = {
+                "attempt"           = 0,
+                "ingestionJobIds.$" = "States.Array($.ingest.ingestionJobId)",
+                "syncPending.$"     = "$.ingest.syncPending"
+              },
+              ResultPath = "$.batchBarrier",
+              Next       = "CheckBatchIngestion"
+            },
+            CheckBatchIngestion = {
+              Type     = "Task",
+              Resource = "arn:aws:states:::lambda:invoke",
+              Parameters = {
+                "FunctionName" = aws_lambda_function.check_ingestion_jobs_lambda.arn,
+                "Payload" = {
+                  "ingestionJobIds.$" = "$.batchBarrier.ingestionJobIds",
+                  "syncPending.$"     = "$.batchBarrier.syncPending",
+                  "attempt.$"         = "$.batchBarrier.attempt"
+                }
+              },
+              ResultSelector = {
+                "allComplete.$"     = "$.Payload.allComplete",
+                "attempt.$"         = "$.Payload.attempt",
+                "waitSeconds.$"     = "$.Payload.waitSeconds",
+                "ingestionJobIds.$" = "$.Payload.ingestionJobIds",
+                "syncPending.$"     = "$.Payload.syncPending"
+              },
+              ResultPath = "$.batchBarrier",
+              Next       = "BatchIngestionComplete"
+            },
+            BatchIngestionComplete = {
+              Type = "Choice",
+              Choices = [
+                {
+                  Variable      = "$.batchBarrier.allComplete",
+                  BooleanEquals = true,
+                  Next          = "ExtractBatchStudies"
+                }
+              ],
+              Default = "WaitForBatchIngestion"
+            },
+            WaitForBatchIngestion = {
+              Type        = "Wait",
+              SecondsPath = "$.batchBarrier.waitSeconds",
+              Next        = "CheckBatchIngestion"
+            },
+            ExtractBatchStudies = {
+              Type     = "Task",
+              Comment  = "Maps the batch's files to studies in the registry and dispatches each touched study's summary.",
+              Resource = "arn:aws:states:::lambda:invoke",
+              Parameters = {
+                "FunctionName" = aws_lambda_function.extract_file_studies_lambda.arn,
+                "Payload" = {
+                  "userId.$"   = "$.BatchInput.userId",
+                  "folderId.$" = "$.BatchInput.folderId",
+                  "results.$"  = "$.ingest.results"
+                }
+              },
               Retry = [
                 {
                   ErrorEquals     = ["States.ALL"],
@@ -51,7 +281,50 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
             }
           }
         },
-        Next = "IdentifyStudiesToSummarize",
+        Next = "StartStudyBarrier",
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"],
+            Next        = "FolderProcessingFailed",
+            ResultPath  = "$.errorInfo"
+          }
+        ]
+      },
+      StartStudyBarrier = {
+        Type       = "Pass",
+        Comment    = "Pipelined mode: waits until every registered study's current version is summarized.",
+        Result     = { attempt = 0 },
+        ResultPath = "$.studyBarrier",
+        Next       = "CheckStudyRegistry"
+      },
+      CheckStudyRegistry = {
+        Type     = "Task",
+        Resource = "arn:aws:states:::lambda:invoke",
+        Parameters = {
+          "FunctionName" = aws_lambda_function.check_study_registry_lambda.arn,
+          "Payload" = {
+            "userId.$"   = "$.userId",
+            "folderId.$" = "$.folderId",
+            "attempt.$"  = "$.studyBarrier.attempt"
+          }
+        },
+        ResultSelector = {
+          "allComplete.$"   = "$.Payload.allComplete",
+          "attempt.$"       = "$.Payload.attempt",
+          "waitSeconds.$"   = "$.Payload.waitSeconds",
+          "failedStudies.$" = "$.Payload.failedStudies",
+          "summaryRefs.$"   = "$.Payload.summaryRefs"
+        },
+        ResultPath = "$.studyBarrier",
+        Next       = "StudySummariesComplete",
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.TooManyRequestsException", "Lambda.SdkClientException"],
+            IntervalSeconds = 5,
+            MaxAttempts     = 3,
+            BackoffRate     = 2.0
+          }
+        ],
         Catch = [
           {
             ErrorEquals = ["States.ALL"],
@@ -60,6 +333,89 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
           }
         ]
       },
+      StudySummariesComplete = {
+        Type = "Choice",
+        Choices = [
+          {
+            Variable      = "$.studyBarrier.allComplete",
+            BooleanEquals = true,
+            Next          = "CollectPipelinedSummaries"
+          }
+        ],
+        Default = "WaitForStudySummaries"
+      },
+      WaitForStudySummaries = {
+        Type        = "Wait",
+        SecondsPath = "$.studyBarrier.waitSeconds",
+        Next        = "CheckStudyRegistry"
+      },
+      CollectPipelinedSummaries = {
+        Type       = "Pass",
+        InputPath  = "$.studyBarrier.summaryRefs",
+        ResultPath = "$.summaryRefs",
+        Next       = "AggregateResults"
+      },
+      StartIngestionBarrier = {
+        Type       = "Pass",
+        Comment    = "Starts the wait for this execution's KB ingestion jobs before studies are identified.",
+        Result     = { attempt = 0 },
+        ResultPath = "$.ingestionBarrier",
+        Next       = "CheckIngestionJobs"
+      },
+      CheckIngestionJobs = {
+        Type     = "Task",
+        Comment  = "Polls the ingestion jobs recorded for this folder once and returns the next adaptive wait.",
+        Resource = "arn:aws:states:::lambda:invoke",
+        Parameters = {
+          "FunctionName" = aws_lambda_function.check_ingestion_jobs_lambda.arn,
+          "Payload" = {
+            "userId.$"             = "$.userId",
+            "folderId.$"           = "$.folderId",
+            "executionStartTime.$" = "$$.Execution.StartTime",
+            "attempt.$"            = "$.ingestionBarrier.attempt"
+          }
+        },
+        ResultSelector = {
+          "allComplete.$"   = "$.Payload.allComplete",
+          "attempt.$"       = "$.Payload.attempt",
+          "waitSeconds.$"   = "$.Payload.waitSeconds",
+          "pendingJobIds.$" = "$.Payload.pendingJobIds",
+          "failedJobIds.$"  = "$.Payload.failedJobIds"
+        },
+        ResultPath = "$.ingestionBarrier",
+        Next       = "IngestionJobsComplete",
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.TooManyRequestsException", "Lambda.SdkClientException"],
+            IntervalSeconds = 5,
+            MaxAttempts     = 3,
+            BackoffRate     = 2.0
+          }
+        ],
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"],
+            Next        = "FolderProcessingFailed",
+            ResultPath  = "$.errorInfo"
+          }
+        ]
+      },
+      IngestionJobsComplete = {
+        Type = "Choice",
+        Choices = [
+          {
+            Variable      = "$.ingestionBarrier.allComplete",
+            BooleanEquals = true,
+            Next          = "IdentifyStudiesToSummarize"
+          }
+        ],
+        Default = "WaitForIngestionJobs"
+      },
+      WaitForIngestionJobs = {
+        Type        = "Wait",
+        SecondsPath = "$.ingestionBarrier.waitSeconds",
+        Next        = "CheckIngestionJobs"
+      },
       IdentifyStudiesToSummarize = {
         Type    = "Task",
         Comment = "Scans all documents to create a to-do list of studies to summarize.",
@@ -83,27 +439,32 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
       },
       ProcessStudiesInParallel = {
         Type           = "Map",
-        Comment        = "Processes 1 study at a time for maximum reliability.",
-        InputPath      = "$.studiesToProcess.Payload",
-        ItemsPath      = "$.studies",
+        Comment        = "Summarizes the studies in batches; each invocation shares one rate-limited Bedrock executor across its studies.",
+        ItemsPath      = "$.studiesToProcess.Payload.studies",
         MaxConcurrency = 1,
         ResultPath     = "$.summaryRefs",
-        Iterator = {
-          StartAt = "SummarizeSingleStudy",
+        ItemBatcher = {
+          MaxItemsPerBatch = var.summarize_batch_size
+        },
+        ItemProcessor = {
+          ProcessorConfig = {
+            Mode          = "DISTRIBUTED",
+            ExecutionType = "STANDARD"
+          },
+          StartAt = "SummarizeStudyBatch",
           States = {
-            SummarizeSingleStudy = {
+            SummarizeStudyBatch = {
               Type       = "Task",
-              Comment    = "Summarizes one single study and writes to S3.",
+              Comment    = "Summarizes a batch of studies and writes each summary to S3.",
               Resource   = "arn:aws:states:::lambda:invoke",
               Parameters = {
                 "FunctionName" = aws_lambda_function.summarize_single_study_lambda.arn,
                 "Payload.$"    = "$"
               },
               ResultSelector = {
-                "s3_key.$"    = "$.Payload.s3_key",
-                "studyName.$" = "$.Payload.studyName"
+                "summaries.$" = "$.Payload.summaries"
               },
-              ResultPath = "$",
+              OutputPath = "$.summaries",
               End        = true
             }
           }
@@ -123,7 +484,11 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
         Resource   = "arn:aws:states:::lambda:invoke",
         Parameters = {
           "FunctionName" = aws_lambda_function.aggregate_results_lambda.arn,
-          "Payload.$"    = "$.summaryRefs"
+          "Payload" = {
+            "userId.$"      = "$.userId",
+            "folderId.$"    = "$.folderId",
+            "summaryRefs.$" = "$.summaryRefs"
+          }
         },
         ResultPath = "$.aggregateOutput",
         Next       = "UpdateFolderStatusSuccess",
@@ -142,11 +507,14 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
         Parameters = {
           "FunctionName" = aws_lambda_function.update_folder_metadata_lambda.arn,
           "Payload" = {
-            "userId.$"       = "$.userId",
-            "folderId.$"     = "$.folderId",
-            "status"         = "folder_summarized",
-            "summaryCount.$" = "$.aggregateOutput.Payload.summaryCount",
-            "summaryS3Key.$" = "$.aggregateOutput.Payload.aggregatedS3Key"
+            "userId.$"              = "$.userId",
+            "folderId.$"            = "$.folderId",
+            "status"                = "folder_summarized",
+            "summaryCount.$"        = "$.aggregateOutput.Payload.summaryCount",
+            "summaryS3Key.$"        = "$.aggregateOutput.Payload.aggregatedS3Key",
+            "sectionIndexS3Key.$"   = "$.aggregateOutput.Payload.sectionIndexS3Key",
+            "aggregatedSizeBytes.$" = "$.aggregateOutput.Payload.aggregatedSizeBytes",
+            "summaryVersion.$"      = "$.aggregateOutput.Payload.summaryVersion"
           }
         },
         End = true
@@ -172,3 +540,109 @@ resource "aws_sfn_state_machine" "folder_processing_state_machine" {
     Project = var.project_name
   }
 }
+
+# Drives SummarizeFolderLambda across as many invocations as a large folder needs.
+# The Lambda checkpoints to S3 and returns status IN_PROGRESS with a continuation
+# token before its deadline; the execution name is used as that token so a retried
+# invocation also resumes from the last checkpoint.
+resource "aws_sfn_state_machine" "summarize_folder_state_machine" {
+  name     = "${var.project_name}-SummarizeFolderStateMachine"
+  role_arn = aws_iam_role.sfn_exec_role.arn
+
+  definition = jsonencode({
+    Comment = "Re-invokes SummarizeFolderLambda with its continuation token until the folder is fully summarized."
+    StartAt = "StartSummarizeRun"
+    States = {
+      StartSummarizeRun = {
+        Type = "Pass",
+        Parameters = {
+          "userId.$"            = "$.userId",
+          "folderId.$"          = "$.folderId",
+          "continuationToken.$" = "$$.Execution.Name"
+        },
+        Next = "SummarizeFolder"
+      },
+      SummarizeFolder = {
+        Type     = "Task",
+        Resource = "arn:aws:states:::lambda:invoke",
+        Parameters = {
+          "FunctionName" = aws_lambda_function.summarize_folder_lambda.arn,
+          "Payload.$"    = "$"
+        },
+        ResultPath = "$.summarizeOutput",
+        Next       = "CheckSummarizeProgress",
+        Retry = [
+          {
+            ErrorEquals     = ["States.TaskFailed"],
+            IntervalSeconds = 10,
+            MaxAttempts     = 2,
+            BackoffRate     = 2.0
+          }
+        ]
+      },
+      CheckSummarizeProgress = {
+        Type = "Choice",
+        Choices = [
+          {
+            And = [
+              { Variable = "$.summarizeOutput.Payload.status", IsPresent = true },
+              { Variable = "$.summarizeOutput.Payload.status", StringEquals = "IN_PROGRESS" }
+            ],
+            Next = "ContinueSummarizeRun"
+          }
+        ],
+        Default = "ReleaseSummarizeCheckpoint"
+      },
+      ContinueSummarizeRun = {
+        Type = "Pass",
+        Parameters = {
+          "userId.$"            = "$.userId",
+          "folderId.$"          = "$.folderId",
+          "continuationToken.$" = "$.summarizeOutput.Payload.continuationToken"
+        },
+        Next = "SummarizeFolder"
+      },
+      # The run's result is in hand; only now may its checkpoint go
+      ReleaseSummarizeCheckpoint = {
+        Type     = "Task",
+        Resource = "arn:aws:states:::lambda:invoke",
+        Parameters = {
+          "FunctionName" = aws_lambda_function.summarize_folder_lambda.arn,
+          "Payload" = {
+            "userId.$"            = "$.userId",
+            "folderId.$"          = "$.folderId",
+            "continuationToken.$" = "$.continuationToken",
+            "releaseCheckpoint"   = true
+          }
+        },
+        ResultPath = null,
+        Next       = "SummarizeRunComplete",
+        Retry = [
+          {
+            ErrorEquals     = ["States.TaskFailed"],
+            IntervalSeconds = 5,
+            MaxAttempts     = 2,
+            BackoffRate     = 2.0
+          }
+        ],
+        # A checkpoint left behind expires with the bucket's lifecycle rule
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"],
+            ResultPath  = "$.releaseError",
+            Next        = "SummarizeRunComplete"
+          }
+        ]
+      },
+      SummarizeRunComplete = {
+        Type       = "Pass",
+        OutputPath = "$.summarizeOutput.Payload",
+        End        = true
+      }
+    }
+  })
+
+  tags = {
+    Project = var.project_name
+  }
+}
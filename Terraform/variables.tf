@@ -48,6 +48,202 @@ variable "s3_folder_summaries_prefix" {
   # default     = "folder-summaries"
 }
 
+variable "s3_manifest_prefix" {
+  description = "The S3 prefix for the folder-processing item manifests read by the state machine."
+  type        = string
+  default     = "processing-manifests"
+}
+
+variable "ingest_batch_size" {
+  description = "Number of manifest items handed to each ingest child workflow by the Map ItemBatcher."
+  type        = number
+  default     = 10
+}
+
+variable "ingest_batch_concurrency" {
+  description = "Number of files from one batch that the ingest Lambda extracts and uploads concurrently."
+  type        = number
+  default     = 4
+}
+
+variable "summarize_batch_size" {
+  description = "Number of studies summarized per SummarizeSingleStudyLambda invocation."
+  type        = number
+  default     = 5
+}
+
+variable "pipelined_summarization" {
+  description = "Default processing mode: summarize each study as soon as its files are indexed instead of after the whole folder."
+  type        = bool
+  default     = false
+}
+
+variable "ingestion_poll_min_seconds" {
+  description = "First wait of the KB ingestion barrier; later waits back off from it."
+  type        = number
+  default     = 10
+}
+
+variable "ingestion_poll_max_seconds" {
+  description = "Longest wait between KB ingestion barrier polls."
+  type        = number
+  default     = 120
+}
+
+variable "bedrock_max_concurrency" {
+  description = "Concurrent Bedrock calls allowed inside one summarization invocation."
+  type        = number
+  default     = 3
+}
+
+variable "bedrock_requests_per_second" {
+  description = "Bedrock request rate shared by all prompts of one summarization invocation."
+  type        = number
+  default     = 1
+}
+
+variable "bedrock_model_routes" {
+  description = "Ordered model candidates per prompt type (task name, task family or \"default\"). Foundation model IDs, cross-region inference profile IDs or ARNs; throttled calls fail over to the next candidate."
+  type        = map(list(string))
+  default = {
+    classification = [
+      "anthropic.claude-3-haiku-20240307-v1:0",
+      "us.anthropic.claude-3-haiku-20240307-v1:0",
+      "anthropic.claude-3-sonnet-20240229-v1:0"
+    ]
+    extraction = [
+      "anthropic.claude-3-sonnet-20240229-v1:0",
+      "us.anthropic.claude-3-sonnet-20240229-v1:0"
+    ]
+  }
+}
+
+variable "bedrock_hedging" {
+  description = "Issue a duplicate summarization request once a call passes the rolling p95 latency; the first response wins."
+  type        = bool
+  default     = false
+}
+
+variable "bedrock_hedge_budget_per_folder" {
+  description = "Maximum number of hedged (duplicate) Bedrock requests per folder processing run."
+  type        = number
+  default     = 20
+}
+
+variable "local_rerank" {
+  description = "Retrieve each study's passages once and re-rank them locally per extraction prompt, instead of one RetrieveAndGenerate retrieval per prompt."
+  type        = bool
+  default     = false
+}
+
+variable "rerank_pool_size" {
+  description = "Passages retrieved per study when local_rerank is on."
+  type        = number
+  default     = 80
+}
+
+variable "rerank_token_budget" {
+  description = "Approximate passage tokens sent with each extraction prompt when local_rerank is on."
+  type        = number
+  default     = 6000
+}
+
+variable "extraction_schema" {
+  description = "Default extraction schema (indication) in the shared schema registry, e.g. hae or generic."
+  type        = string
+  default     = "hae"
+}
+
+variable "schema_pruning" {
+  description = "Retrieve each study's passages first and drop schema sections with no evidence in them before prompting."
+  type        = bool
+  default     = false
+}
+
+variable "folder_index_reads" {
+  description = "Read per-folder file rows through the FolderIndex GSI. Turn on after running AWS_backend/scripts/backfill_folder_index.py on an existing table."
+  type        = bool
+  default     = false
+}
+
+variable "list_cache_ttl_seconds" {
+  description = "How long a ListUserFiles container keeps a user's listing. Entries are keyed by the user's change version, so this only bounds memory."
+  type        = number
+  default     = 30
+}
+
+variable "s3_event_batch_size" {
+  description = "Most S3 event messages handed to RecordS3FileMetadata / DeleteS3FileMetadata per invocation."
+  type        = number
+  default     = 100
+}
+
+variable "s3_event_batch_window_seconds" {
+  description = "How long the S3 event queues gather messages before invoking the metadata Lambdas (bulk uploads arrive as fewer, larger batches)."
+  type        = number
+  default     = 5
+}
+
+variable "s3_event_max_receive_count" {
+  description = "Deliveries of an S3 event message before it is moved to its dead-letter queue."
+  type        = number
+  default     = 5
+}
+
+variable "artifact_gc_schedule" {
+  description = "EventBridge schedule of the CleanupStaleArtifacts GC run (superseded summaries, orphaned KB chunks)."
+  type        = string
+  default     = "rate(1 day)"
+}
+
+variable "kb_sync_schedule" {
+  description = "EventBridge schedule for starting the coalesced KB sync left pending by deletions while another ingestion job ran."
+  type        = string
+  default     = "rate(15 minutes)"
+}
+
+variable "tenant_max_running_folders" {
+  description = "Folder runs one user can have executing at once; further runs wait in the admission queue."
+  type        = number
+  default     = 2
+}
+
+variable "max_running_folders" {
+  description = "Folder runs executing at once across all users (0: no global cap)."
+  type        = number
+  default     = 10
+}
+
+variable "admission_max_wait_seconds" {
+  description = "A queued run waiting longer than this goes before its user's cheaper runs."
+  type        = number
+  default     = 900
+}
+
+variable "admission_reconcile_schedule" {
+  description = "EventBridge schedule for freeing admission slots of executions whose end event was missed."
+  type        = string
+  default     = "rate(5 minutes)"
+}
+
+variable "summary_keep_versions" {
+  description = "Newest summary versions kept per study by the GC run, besides any still referenced."
+  type        = number
+  default     = 3
+}
+
+variable "summary_min_age_days" {
+  description = "Study summaries younger than this are never collected."
+  type        = number
+  default     = 7
+}
+
+variable "aggregate_retention_days" {
+  description = "Unreferenced aggregated summaries older than this are collected."
+  type        = number
+  default     = 30
+}
+
 # variable "s3_textract_output_prefix" {
 #   description = "The S3 prefix for Textract raw output within the main bucket."
 #  type        = string
@@ -11,6 +11,15 @@ const s3 = new AWS.S3({
   region: process.env.AWS_REGION
 });
 
+// Latest-summary pointers written by the summarize Lambdas (see summary_pointers in the docrag_shared layer)
+const dynamoDb = new AWS.DynamoDB.DocumentClient({
+  accessKeyId: process.env.AWS_ACCESS_KEY_ID,
+  secretAccessKey: process.env.AWS_SECRET_ACCESS_KEY,
+  region: process.env.AWS_REGION
+});
+const SORT_KEY = 'sessionId#fileName';
+const AGGREGATE_SCOPE = '__AGGREGATE__';
+
 // Simple in-memory cache
 const cache = new Map();
 const CACHE_TTL = 5 * 60 * 1000; // 5 minutes
@@ -317,6 +326,40 @@ const mapCitationKeyToSummaryKey = (citationKey) => {
   return mappings[citationKey] || citationKey;
 };
 
+// Helper function to find a folder's latest aggregated summary pointer (one GetItem)
+const getFolderSummaryPointer = async (username, sessionId, folderName) => {
+  const tableName = config.aws.dynamoDB.tableName;
+  if (!tableName) return null;
+  const data = await dynamoDb.get({
+    TableName: tableName,
+    Key: { userId: username, [SORT_KEY]: `__SUMMARY__#${sessionId}/${folderName}#${AGGREGATE_SCOPE}` }
+  }).promise();
+  return data.Item || null;
+};
+
+// Helper function to find the aggregated summary pointers of every folder in a session, newest first
+const getSessionSummaryPointers = async (username, sessionId) => {
+  const tableName = config.aws.dynamoDB.tableName;
+  if (!tableName) return [];
+  const pointers = [];
+  let startKey;
+  do {
+    const data = await dynamoDb.query({
+      TableName: tableName,
+      KeyConditionExpression: 'userId = :u AND begins_with(#sk, :prefix)',
+      ExpressionAttributeNames: { '#sk': SORT_KEY },
+      ExpressionAttributeValues: { ':u': username, ':prefix': `__SUMMARY__#${sessionId}/` },
+      ExclusiveStartKey: startKey
+    }).promise();
+    pointers.push(...data.Items.filter(item => item[SORT_KEY].endsWith(`#${AGGREGATE_SCOPE}`)));
+    startKey = data.LastEvaluatedKey;
+  } while (startKey);
+  return pointers.sort((a, b) => (b.writtenAtUtc || '').localeCompare(a.writtenAtUtc || ''));
+};
+
+// Helper function to get a folder name from a pointer's sort key (__SUMMARY__#<session>/<folder>#<scope>)
+const pointerFolderName = (pointer) => pointer[SORT_KEY].split('#')[1].split('/').slice(1).join('/');
+
 // Helper function to fetch summary from S3
 const fetchSummaryFromS3 = async (username, sessionId, folderName, summaryKey) => {
   try {
@@ -392,7 +435,20 @@ const fetchSummaryFromS3 = async (username, sessionId, folderName, summaryKey) =
       }
     }
     
-    // Otherwise, search for the summary file
+    // Otherwise, look up the latest summary pointer
+    try {
+      const pointer = folderName
+        ? await getFolderSummaryPointer(username, sessionId, folderName)
+        : (await getSessionSummaryPointers(username, sessionId))[0];
+      if (pointer?.s3Key) {
+        const data = await s3.getObject({ Bucket: process.env.S3_BUCKET_NAME, Key: pointer.s3Key }).promise();
+        return JSON.parse(data.Body.toString());
+      }
+    } catch (pointerError) {
+      console.warn('Summary pointer lookup failed, listing S3 instead:', pointerError.message);
+    }
+
+    // Folders summarized before pointers were recorded: search for the summary file
     let prefix;
     
     if (folderName) {
@@ -460,6 +516,19 @@ router.get('/:sessionId/folders', async (req, res) => {
     setCachedData(key, folders);
     res.json({ success: true, folders });
   } catch (error) {
+    try {
+      const pointers = await getSessionSummaryPointers(username, sessionId);
+      if (pointers.length > 0) {
+        const folders = pointers.map(pointer => ({
+          name: pointerFolderName(pointer),
+          path: pointer.s3Key,
+          summaryKey: pointer.s3Key,
+          processed: true,
+          lastUpdated: pointer.writtenAtUtc
+        }));
+        return res.json({ success: true, folders });
+      }
+    } catch (pointerError) { /* fallback to S3 */ }
     try {
       const listParams = {
         Bucket: process.env.S3_BUCKET_NAME,
@@ -1,6 +1,12 @@
 import React from 'react';
 import './SummaryDisplay.css';
 
+// Citations written by the summarizer point into a shared per-summary reference table;
+// older summaries carry their retrievedReferences inline
+const getCitationReferences = (citation, referenceTable) =>
+    citation.retrievedReferences ||
+    (citation.referenceIds || []).map(id => referenceTable?.[id]).filter(Boolean);
+
 const SummaryDisplay = ({ summaryData }) => {
     if (!summaryData) {
         return <div className="summary-display-loading">Loading summary...</div>;
@@ -55,8 +61,11 @@ const SummaryDisplay = ({ summaryData }) => {
         );
     };
 
+    // Citations are a flat list in older summaries and grouped by prompt in __citations__
+    const citations = summaryData.Citations || Object.values(summaryData.__citations__ || {}).flat();
+
     // Render citations if present
-    const renderCitations = (citations) => {
+    const renderCitations = (citations, referenceTable) => {
 
         if (!citations || !Array.isArray(citations) || citations.length === 0) {
             return <div className="no-citations">No citations found in this summary.</div>;
@@ -64,29 +73,32 @@ const SummaryDisplay = ({ summaryData }) => {
         return (
             <section className="summary-section citations-section">
                 <h2>Citations</h2>
-                {citations.map((citation, idx) => (
-                    <div key={idx} className="citation-block">
-                        <div className="citation-text">
-                            <strong>Citation {idx + 1}:</strong> {citation.generatedResponsePart?.textResponsePart?.text}
-                        </div>
-                        {citation.retrievedReferences && citation.retrievedReferences.length > 0 && (
-                            <div className="citation-references">
-                                {citation.retrievedReferences.map((ref, refIdx) => (
-                                    <div key={refIdx} className="reference">
-                                        <strong>Reference:</strong> {ref.content?.text}
-                                        {ref.location?.s3Location?.uri && (
-                                            <div className="reference-uri">
-                                                <a href={ref.location.s3Location.uri} target="_blank" rel="noopener noreferrer">
-                                                    View Source
-                                                </a>
-                                            </div>
-                                        )}
-                                    </div>
-                                ))}
+                {citations.map((citation, idx) => {
+                    const references = getCitationReferences(citation, referenceTable);
+                    return (
+                        <div key={idx} className="citation-block">
+                            <div className="citation-text">
+                                <strong>Citation {idx + 1}:</strong> {citation.generatedResponsePart?.textResponsePart?.text}
                             </div>
-                        )}
-                    </div>
-                ))}
+                            {references.length > 0 && (
+                                <div className="citation-references">
+                                    {references.map((ref, refIdx) => (
+                                        <div key={refIdx} className="reference">
+                                            <strong>Reference:</strong> {ref.content?.text}
+                                            {ref.location?.s3Location?.uri && (
+                                                <div className="reference-uri">
+                                                    <a href={ref.location.s3Location.uri} target="_blank" rel="noopener noreferrer">
+                                                        View Source
+                                                    </a>
+                                                </div>
+                                            )}
+                                        </div>
+                                    ))}
+                                </div>
+                            )}
+                        </div>
+                    );
+                })}
             </section>
         );
     };
@@ -103,7 +115,7 @@ const SummaryDisplay = ({ summaryData }) => {
             {renderSection("Pharmacokinetics & Pharmacodynamics", PharmacokineticsPharmacodynamics)}
             {renderSection("Additional Exploratory Endpoints", AdditionalExploratoryEndpointsDetails)}
             {renderSection("References & Footnotes", ReferencesAndFootnotes)}
-            {renderCitations(summaryData.Citations)}
+            {renderCitations(citations, summaryData.__references__)}
         </div>
     );
 };
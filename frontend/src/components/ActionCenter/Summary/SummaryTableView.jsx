@@ -5,6 +5,11 @@ import PDFHighlighter from './PDFHighlighter';
 import ReferencePopup from './ReferencePopup';
 import * as XLSX from 'xlsx';
 
+// Citations written by the summarizer point into a shared per-summary reference table
+const getCitationReferences = (citation, referenceTable) =>
+  citation.retrievedReferences ||
+  (citation.referenceIds || []).map(id => referenceTable?.[id]).filter(Boolean);
+
 // Reference Indicator Component
 const ReferenceIndicator = ({ count, hasMultipleFiles, onClick }) => {
   if (count === 0) return null;
@@ -168,7 +173,7 @@ const SummaryTableView = ({ summaries }) => {
     let references = study._referenceMetadata?.[fieldKey] || [];    // If no references found in metadata, try to extract from citations
     if (references.length === 0 && study.__citations__) {
       console.log(`Getting references for ${categoryId}.${subcategoryId} from citations`);
-      references = extractReferencesFromCitations(study.__citations__, categoryId, subcategoryId);
+      references = extractReferencesFromCitations(study.__citations__, categoryId, subcategoryId, study.__references__);
     }
     
     const uniqueFiles = new Set(references.map(ref => ref.fileName).filter(Boolean));
@@ -181,7 +186,7 @@ const SummaryTableView = ({ summaries }) => {
       hasMultipleFiles: uniqueFiles.size > 1
     };
   };  // Extract references from new citations format
-  const extractReferencesFromCitations = (citations, categoryId, subcategoryId) => {
+  const extractReferencesFromCitations = (citations, categoryId, subcategoryId, referenceTable) => {
     const allReferences = [];
     
     // Since citations are not field-specific in your data format, 
@@ -189,24 +194,22 @@ const SummaryTableView = ({ summaries }) => {
     Object.values(citations).forEach(citationArray => {
       if (Array.isArray(citationArray)) {
         citationArray.forEach(citation => {
-          if (citation.retrievedReferences) {
-            citation.retrievedReferences.forEach(ref => {
-              // Create reference object compatible with existing format
-              const referenceObj = {
-                content: ref.content?.text || ref.content || 'No content available',
-                fileName: ref.metadata?.file_name || 'Unknown file',
-                s3Key: ref.metadata?.original_s3_key || '',
-                pageNumbers: ref.metadata?.page_numbers || '',
-                boundingBoxes: ref.metadata?.bounding_boxes || null,
-                bbox_left: ref.metadata?.bbox_left,
-                bbox_top: ref.metadata?.bbox_top,
-                bbox_width: ref.metadata?.bbox_width,
-                bbox_height: ref.metadata?.bbox_height
-              };
-              
-              allReferences.push(referenceObj);
-            });
-          }
+          getCitationReferences(citation, referenceTable).forEach(ref => {
+            // Create reference object compatible with existing format
+            const referenceObj = {
+              content: ref.content?.text || ref.content || 'No content available',
+              fileName: ref.metadata?.file_name || 'Unknown file',
+              s3Key: ref.metadata?.original_s3_key || '',
+              pageNumbers: ref.metadata?.page_numbers || '',
+              boundingBoxes: ref.metadata?.bounding_boxes || null,
+              bbox_left: ref.metadata?.bbox_left,
+              bbox_top: ref.metadata?.bbox_top,
+              bbox_width: ref.metadata?.bbox_width,
+              bbox_height: ref.metadata?.bbox_height
+            };
+            
+            allReferences.push(referenceObj);
+          });
         });
       }
     });
@@ -234,13 +237,11 @@ const SummaryTableView = ({ summaries }) => {
       Object.values(study.__citations__).forEach(citationArray => {
         if (Array.isArray(citationArray)) {
           citationArray.forEach(citation => {
-            if (citation.retrievedReferences) {
-              citation.retrievedReferences.forEach(ref => {
-                if (ref.metadata?.file_name) {
-                  fileNames.add(ref.metadata.file_name);
-                }
-              });
-            }
+            getCitationReferences(citation, study.__references__).forEach(ref => {
+              if (ref.metadata?.file_name) {
+                fileNames.add(ref.metadata.file_name);
+              }
+            });
           });
         }
       });
@@ -303,7 +304,7 @@ const SummaryTableView = ({ summaries }) => {
     // If no references found in metadata, try to extract from citations
     if (references.length === 0 && study.__citations__) {
       console.log(`Extracting references from citations...`);
-      references = extractReferencesFromCitations(study.__citations__, category.id, subcategory.id);
+      references = extractReferencesFromCitations(study.__citations__, category.id, subcategory.id, study.__references__);
     }
 
     console.log(`Final references:`, references);